@@ -1,6 +1,7 @@
 import auto_vp.datasets as datasets
 from auto_vp.wrapper import BaseWrapper
 from auto_vp.utilities import setup_device
+from auto_vp.execution import Execution_Policy, Precision_Policy
 from auto_vp.dataprepare import DataPrepare, Data_Scalability
 from auto_vp import programs
 from auto_vp.training_process import *
@@ -52,6 +53,10 @@ if __name__ == '__main__':
     p.add_argument('--scalibility_rio', type=int, choices=[1, 2, 4, 10, 100], default=1) 
     p.add_argument('--scalibility_mode', choices=["equal", "random"], default="equal") 
     p.add_argument('--baseline', choices=["LP", "FF", "Scartch", "CLIP_TP", "CLIP_LP"], default="CLIP_LP") 
+    p.add_argument('--feature_cache', type=int, choices=[0, 1], default=0) # LP/CLIP_LP: train the head on cached backbone features
+    p.add_argument('--cache_dir', type=str, default="./results/feature_cache/")
+    p.add_argument('--backbone_dtype', choices=["fp32", "bf16", "fp16"], default="fp32") # storage dtype of the frozen backbone (LP, CLIP_TP, CLIP_LP)
+    p.add_argument('--text_dtype', choices=["fp32", "bf16", "fp16"], default="fp32") # CLIP text embeddings
     args = p.parse_args()
 
     start_time = time.time()
@@ -62,6 +67,13 @@ if __name__ == '__main__':
     device, list_ids = setup_device(1)
     print("device: ", list_ids)
 
+    # the fine-tuned baselines update the backbone, so it stays fp32
+    if(args.baseline in ["FF", "Scartch"] and args.backbone_dtype != "fp32"):
+        print(f"Warning: {args.baseline} trains the backbone, backbone_dtype {args.backbone_dtype} ignored")
+        args.backbone_dtype = "fp32"
+    precision = Precision_Policy(args.backbone_dtype, args.text_dtype)
+    execution_policy = Execution_Policy(device, precision=precision)
+
     # Dataset Setting 
     channel = 3
     img_resize = 224 
@@ -91,20 +103,13 @@ if __name__ == '__main__':
         model = models.swin_t(weights=models.Swin_T_Weights.DEFAULT)
     elif args.pretrained == "clip" or args.pretrained == "clip_ViT_B_32":
         model, clip_preprocess = clip.load("ViT-B/32", device=device)
-        # https://github.com/openai/CLIP/issues/57
-        for p in model.parameters(): 
-            p.data = p.data.float() 
-            if p.grad:
-                p.grad.data = p.grad.data.float()
     elif args.pretrained == "clip_large":
         model, clip_preprocess = clip.load("ViT-L/14", device=device)
-        for p in model.parameters(): 
-            p.data = p.data.float() 
-            if p.grad:
-                p.grad.data = p.grad.data.float()
 
     else:
         raise NotImplementedError(f"{args.pretrained} not supported")
+    # https://github.com/openai/CLIP/issues/57
+    model = precision.cast_backbone(model)
     
     preprocess = transforms.Compose([
         transforms.Resize((224,224)),
@@ -130,7 +135,12 @@ if __name__ == '__main__':
         wild_dataset = False
 
     if(args.scalibility_rio != 1):
-        trainloader = Data_Scalability(trainset, args.scalibility_rio, BATCH_SIZE[args.dataset], mode=args.scalibility_mode, random_state=random_state, wild_dataset=wild_dataset) 
+        trainloader = Data_Scalability(trainset, args.scalibility_rio, BATCH_SIZE[args.dataset], mode=args.scalibility_mode, random_state=random_state, wild_dataset=wild_dataset, loader=trainloader, dataset_name=args.dataset) 
+
+    if(args.feature_cache > 0):
+        feature_cache_dir = args.cache_dir
+    else:
+        feature_cache_dir = None
 
     # Training
     best_val_acc = 0.
@@ -138,18 +148,18 @@ if __name__ == '__main__':
     if(args.pretrained[0:4] != "clip" and args.baseline[0:4] == "CLIP"):
         raise Exception(f"{args.pretrained} not supported {args.baseline}")
     elif(args.baseline == "LP"):
-        best_val_acc = LP(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset)
+        best_val_acc = LP(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset, feature_cache_dir=feature_cache_dir, dataset_name=args.dataset, execution_policy=execution_policy)
     elif(args.baseline == "FF"):
-        best_val_acc = Full_Finetune(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset)
+        best_val_acc = Full_Finetune(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset, execution_policy=execution_policy)
     elif(args.baseline == "Scartch"):   
         model = torchvision.models.resnet18(pretrained=False)
-        best_val_acc = Full_Finetune(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset)
+        best_val_acc = Full_Finetune(fname, model, args.pretrained, class_num, trainloader, testloader, args.epoch, args.lr, device, wild_dataset=wild_dataset, execution_policy=execution_policy)
     elif(args.baseline == "CLIP_TP"):  
-        best_val_acc = CLIP_Pure(model, testloader, class_names, device, wild_dataset=wild_dataset)
+        best_val_acc = CLIP_Pure(model, testloader, class_names, device, wild_dataset=wild_dataset, execution_policy=execution_policy)
     elif(args.baseline == "CLIP_LP" and args.pretrained == "clip_large"):  
-        best_val_acc = CLIP_LP(fname, model, trainloader, testloader, class_num, args.epoch, args.lr, device, b_l="l", wild_dataset=wild_dataset)
+        best_val_acc = CLIP_LP(fname, model, trainloader, testloader, class_num, args.epoch, args.lr, device, b_l="l", wild_dataset=wild_dataset, feature_cache_dir=feature_cache_dir, dataset_name=args.dataset, execution_policy=execution_policy)
     elif(args.baseline == "CLIP_LP" and (args.pretrained == "clip" or args.pretrained == "clip_ViT_B_32")): 
-        best_val_acc = CLIP_LP(fname, model, trainloader, testloader, class_num, args.epoch, args.lr, device, wild_dataset=wild_dataset)
+        best_val_acc = CLIP_LP(fname, model, trainloader, testloader, class_num, args.epoch, args.lr, device, wild_dataset=wild_dataset, feature_cache_dir=feature_cache_dir, dataset_name=args.dataset, execution_policy=execution_policy)
 
     print("Best Validation Accuracy: ", best_val_acc)
     print("Execution Time (minutes): ", time.time() - start_time)
@@ -1,6 +1,6 @@
 import os
+import io
 from PIL import Image
-import six
 import lmdb
 import pickle
 import json
@@ -20,33 +20,55 @@ def loads_data(buf):
     return pickle.loads(buf)
 
 
+def open_lmdb(db_path):
+    return lmdb.open(db_path, subdir=os.path.isdir(db_path),
+                     readonly=True, lock=False,
+                     readahead=False, meminit=False)
+
+
 class LMDBDataset(data.Dataset):
+    # The environment is opened lazily in each process that reads (main process or DataLoader
+    # worker), never inherited through fork, and keeps one read transaction for its lifetime.
+    # Values are unpickled straight from LMDB's memory map (buffers=True) and the image bytes
+    # are wrapped, not copied, for the decoder. With auto-batching, the DataLoader fetches a
+    # whole batch through __getitems__(): one cursor pass over the batch's keys in key order.
     def __init__(self, root, split='train', transform=None, target_transform=None):
         super().__init__()
-        db_path = os.path.join(root, f"{split}.lmdb")
-        self.env = lmdb.open(db_path, subdir=os.path.isdir(db_path),
-                             readonly=True, lock=False,
-                             readahead=False, meminit=False)
-        with self.env.begin(write=False) as txn:
+        self.db_path = os.path.join(root, f"{split}.lmdb")
+        env = open_lmdb(self.db_path)
+        with env.begin(write=False) as txn:
             self.length = loads_data(txn.get(b'__len__'))
             self.keys = loads_data(txn.get(b'__keys__'))
+        env.close()
+        self.env = None
+        self.txn = None
+        self.pid = None
+        self._targets = None
 
         self.transform = transform
         self.target_transform = target_transform
 
-    def __getitem__(self, index):
-        env = self.env
-        with env.begin(write=False) as txn:
-            byteflow = txn.get(self.keys[index])
-
+    def _begin(self):
+        if(self.txn == None or self.pid != os.getpid()):
+            self.env = open_lmdb(self.db_path)
+            self.txn = self.env.begin(write=False, buffers=True)
+            self.pid = os.getpid()
+        return self.txn
+
+    def __getstate__(self):
+        # workers open their own environment
+        state = self.__dict__.copy()
+        state["env"] = None
+        state["txn"] = None
+        state["pid"] = None
+        return state
+
+    def _sample(self, byteflow):
+        # byteflow is only valid until the next read on the transaction: unpickle it right away
         unpacked = loads_data(byteflow)
 
-        # load img
-        imgbuf = unpacked[0]
-        buf = six.BytesIO()
-        buf.write(imgbuf)
-        buf.seek(0)
-        img = Image.open(buf)
+        # load img (BytesIO shares the bytes object instead of copying it)
+        img = Image.open(io.BytesIO(unpacked[0]))
 
         # load label
         target = unpacked[1]
@@ -60,6 +82,33 @@ class LMDBDataset(data.Dataset):
         # return img, target
         return img, target
 
+    @property
+    def targets(self):
+        # labels in index order, read once in a cursor pass without decoding any image
+        if(self._targets == None):
+            cursor = self._begin().cursor()
+            order = sorted(range(len(self.keys)), key=lambda i: self.keys[i])
+            targets = [None for _ in order]
+            for i in order:
+                cursor.set_key(self.keys[i])
+                targets[i] = int(loads_data(cursor.value())[1])
+            cursor.close()
+            self._targets = targets
+        return self._targets
+
+    def __getitem__(self, index):
+        return self._sample(self._begin().get(self.keys[index]))
+
+    def __getitems__(self, indices):
+        cursor = self._begin().cursor()
+        samples = [None for _ in indices]
+        for i in sorted(range(len(indices)), key=lambda i: self.keys[indices[i]]):
+            if(cursor.set_key(self.keys[indices[i]]) == False):
+                raise KeyError(self.keys[indices[i]])
+            samples[i] = self._sample(cursor.value())
+        cursor.close()
+        return samples
+
     def __len__(self):
         return self.length
 
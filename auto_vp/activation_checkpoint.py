@@ -0,0 +1,119 @@
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
+
+# Activation checkpointing for the frozen backbone. The prompt gradient flows through the
+# whole backbone, so by default every intermediate activation is kept until backward.
+# Wrapped segments keep only their inputs and are recomputed during backward.
+# Either way the backbone forward is recomputed once per step; the granularity sets the
+# memory split between the saved segment inputs and the activations of one recomputed segment.
+# "block": every residual / transformer block is a segment (small recompute peak)
+# "stage": every stage (ResNet layerN, VGG conv blocks, Swin stage) or a group of
+#          transformer blocks is a segment (fewer saved inputs, larger recompute peak)
+
+DEFAULT_CHECKPOINT_GRANULARITY = {
+    "vgg16_bn": "stage",
+    "resnet18": "stage",
+    "resnet50": "stage",
+    "resnext101_32x8d": "block",
+    "ig_resnext101_32x8d": "block",
+    "vit_b_16": "block",
+    "swin_t": "block",
+    "clip": "block",
+    "clip_ViT_B_32": "block",
+    "clip_large": "block",
+}
+
+TRANSFORMER_STAGE_SEGMENTS = 4 # "stage" granularity for plain transformer stacks
+
+def Checkpoint_Module(module):
+    # recompute this module in backward; no-op under no_grad (evaluation, frequency mapping)
+    if getattr(module, "activation_checkpoint", False):
+        return
+    forward = module.forward
+    def checkpointed_forward(*args):
+        if(torch.is_grad_enabled() == True):
+            return checkpoint(forward, *args, use_reentrant=False)
+        return forward(*args)
+    module.forward = checkpointed_forward
+    module.activation_checkpoint = True
+    return
+
+def Checkpoint_Sequential(seq, segments):
+    # split an nn.Sequential into `segments` checkpointed chunks
+    if getattr(seq, "activation_checkpoint", False):
+        return
+    forward = seq.forward
+    segments = max(1, min(segments, len(seq)))
+    def checkpointed_forward(x):
+        if(torch.is_grad_enabled() == True):
+            return checkpoint_sequential(seq, segments, x, use_reentrant=False)
+        return forward(x)
+    seq.forward = checkpointed_forward
+    seq.activation_checkpoint = True
+    return
+
+def Checkpoint_Segments(seq, ends):
+    # split an nn.Sequential into checkpointed segments, each ending after one of the layer indices `ends`
+    if getattr(seq, "activation_checkpoint", False):
+        return
+    forward = seq.forward
+    bounds = sorted(set([0] + [i + 1 for i in ends if i + 1 < len(seq)] + [len(seq)]))
+    segments = [seq[bounds[k]:bounds[k+1]] for k in range(len(bounds) - 1)]
+    def checkpointed_forward(x):
+        if(torch.is_grad_enabled() == True):
+            for segment in segments:
+                x = checkpoint(segment, x, use_reentrant=False)
+            return x
+        return forward(x)
+    seq.forward = checkpointed_forward
+    seq.activation_checkpoint = True
+    return
+
+def Enable_Activation_Checkpointing(model_name, model, granularity=None):
+    if(granularity == None):
+        granularity = DEFAULT_CHECKPOINT_GRANULARITY.get(model_name, "block")
+    if(granularity not in ["stage", "block"]):
+        raise ValueError(f"Unknown activation checkpoint granularity: {granularity}")
+
+    if(model_name == "vgg16_bn"):
+        layers = list(model.features)
+        if(granularity == "stage"): # the five conv stages, each closed by its max pooling
+            ends = [i for i, layer in enumerate(layers) if isinstance(layer, nn.MaxPool2d)]
+        else: # conv-bn-relu blocks, the max pooling stays with the block before it
+            ends = [i for i, layer in enumerate(layers) if isinstance(layer, nn.MaxPool2d) or
+                    (isinstance(layer, nn.ReLU) and not (i + 1 < len(layers) and isinstance(layers[i+1], nn.MaxPool2d)))]
+        Checkpoint_Segments(model.features, ends)
+    elif(model_name in ["resnet18", "resnet50", "resnext101_32x8d", "ig_resnext101_32x8d"]): # torchvision and timm ResNets
+        for layer in [model.layer1, model.layer2, model.layer3, model.layer4]:
+            if(granularity == "stage"):
+                Checkpoint_Module(layer)
+            else:
+                for block in layer:
+                    Checkpoint_Module(block)
+    elif(model_name == "vit_b_16"):
+        if(granularity == "stage"):
+            Checkpoint_Sequential(model.encoder.layers, TRANSFORMER_STAGE_SEGMENTS)
+        else:
+            for block in model.encoder.layers:
+                Checkpoint_Module(block)
+    elif(model_name == "swin_t"):
+        # features: [patch embedding, stage 1, merging, stage 2, merging, stage 3, merging, stage 4]
+        for i in range(1, len(model.features), 2):
+            if(granularity == "stage"):
+                Checkpoint_Module(model.features[i])
+            else:
+                for block in model.features[i]:
+                    Checkpoint_Module(block)
+    elif(model_name[0:4] == "clip"):
+        blocks = model.visual.transformer.resblocks
+        if(granularity == "stage"):
+            Checkpoint_Sequential(blocks, TRANSFORMER_STAGE_SEGMENTS)
+        else:
+            for block in blocks:
+                Checkpoint_Module(block)
+    else:
+        print(f"Warning: no activation checkpointing for {model_name}")
+        return None
+    print(f"Activation checkpointing: {model_name}, granularity {granularity}")
+    return granularity
@@ -0,0 +1,2 @@
+from auto_vp.benchmark.synthetic import Synthetic, Synthetic_DataPrepare, SYNTHETIC_PREFIX
+from auto_vp.benchmark.runner import Benchmark_Cell, Run_Benchmark, Compare_Baseline, Save_Report, Load_Report, MAPPING_METHODS
@@ -0,0 +1,209 @@
+import os
+import gc
+import json
+import time
+import random
+import platform
+import resource
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+
+from auto_vp.const import MODEL_ZOO, IMG_SIZE, BATCH_SIZE, NETMEAN, NETSTD
+from auto_vp.dataprepare import DataPrepare
+from auto_vp.load_model import Load_Reprogramming_Model
+from auto_vp.training_process import FreqLabelMap
+from auto_vp.execution import Execution_Policy, Precision_Policy, Setup_CPU_Threads
+from auto_vp.benchmark.synthetic import SYNTHETIC_PREFIX, WILD_DATASETS
+
+# End-to-end training-step benchmark: synthetic data -> DataLoader -> prompt -> backbone ->
+# mapping -> loss -> backward -> optimizer, for a matrix of
+# backbone x mapping method x trainable resize on/off.
+# Each cell runs in a fresh process, so its peak RSS is its own.
+
+MAPPING_METHODS = ["fully_connected_layer_mapping", "frequency_based_mapping", "self_definded_mapping", "semantic_mapping"]
+
+def Cell_Key(result):
+    return f"{result['pretrained_model']}|{result['mapping_method']}|resize={int(result['train_resize'])}"
+
+def Percentile_ms(latencies, q):
+    return float(np.percentile(np.array(latencies) * 1000., q))
+
+def Peak_RSS_MB(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024. # KB on Linux
+
+def Fixed_Mapping(output_mapping):
+    # semantic/self-defined mappings have the frequency mapping's forward cost; a fixed map
+    # avoids the text model download of Semantic_mapping()
+    num_map = output_mapping.num_source_to_map
+    output_mapping.self_definded_map = [[(i*num_map + j) % output_mapping.source_class_num for j in range(num_map)] for i in range(output_mapping.target_class_num)]
+    output_mapping.sem_check = True
+    return
+
+def Benchmark_Cell(dataset, pretrained_model, mapping_method, train_resize, device="cpu", steps=20, warmup=5, batch_size=None,
+                   scale=1.0, num_map=1, seed=7, pretrained_weights=False, backbone_dtype="fp32", num_threads=-1):
+    result = {"pretrained_model": pretrained_model, "mapping_method": mapping_method, "train_resize": train_resize}
+    if(pretrained_model[0:4] == "clip" and mapping_method == "semantic_mapping"):
+        result.update({"status": "skipped", "reason": "CLIP not support semantic mapping"})
+        return result
+    if(pretrained_model[0:4] == "clip" and pretrained_weights == False):
+        # clip.load() has no random-weight path and downloads the checkpoint, which offline hosts cannot do
+        result.update({"status": "skipped", "reason": "CLIP needs its checkpoint, run with pretrained_weights"})
+        return result
+
+    device = torch.device(device)
+    if(device.type == "cpu"):
+        Setup_CPU_Threads(num_threads)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if(batch_size == None):
+        batch_size = BATCH_SIZE[dataset]
+    wild_dataset = (dataset in WILD_DATASETS)
+
+    start = time.perf_counter()
+    policy = Execution_Policy(device, precision=Precision_Policy(backbone_dtype))
+    model = Load_Reprogramming_Model(dataset, device, mapping_method=mapping_method, set_train_resize=train_resize, pretrained_model=pretrained_model,
+                                     scale=scale, num_map=num_map, execution_policy=policy, pretrained_weights=pretrained_weights)
+    img_resize = IMG_SIZE[dataset]
+    if(train_resize == False):
+        img_resize = min(int(img_resize*scale), 224)
+    clip_transform = model.clip_preprocess if pretrained_model[0:4] == "clip" else None
+    trainloader, testloader, class_names, trainset = DataPrepare(dataset_name=SYNTHETIC_PREFIX + dataset, dataset_dir="", target_size=(img_resize, img_resize),
+                                                                 mean=NETMEAN[pretrained_model], std=NETSTD[pretrained_model], download=False,
+                                                                 batch_size=batch_size, random_state=seed, clip_transform=clip_transform)
+    if(pretrained_model[0:4] == "clip"):
+        model.CLIP_Text_Embedding(class_names, 0)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+    else:
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    if(mapping_method == "frequency_based_mapping"):
+        FreqLabelMap(model, testloader, device, wild_dataset=wild_dataset) # the smaller split, setup cost only
+    elif(mapping_method in ["self_definded_mapping", "semantic_mapping"]):
+        Fixed_Mapping(model.output_mapping)
+    setup_sec = time.perf_counter() - start
+
+    criterion = nn.CrossEntropyLoss()
+    scaler = policy.grad_scaler()
+    model.train()
+    batches = iter(trainloader)
+    latencies, data_latencies = [], []
+    for i in range(warmup + steps):
+        t0 = time.perf_counter()
+        try:
+            pb = next(batches)
+        except StopIteration:
+            batches = iter(trainloader)
+            pb = next(batches)
+        imgs, labels = pb[0].to(device), pb[1].to(device)
+        t1 = time.perf_counter()
+
+        optimizer.zero_grad()
+        with policy.autocast():
+            logits = model(imgs)
+            loss = criterion(logits, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if(model.no_trainable_resize == 0):
+            with torch.no_grad():
+                model.train_resize.scale = model.train_resize.scale.clamp_(0.1, 5.0)
+        loss.item() # wait for the step (also on CUDA)
+        t2 = time.perf_counter()
+        if(i >= warmup):
+            latencies.append(t2 - t0)
+            data_latencies.append(t1 - t0)
+
+    # RUSAGE_CHILDREN only counts reaped processes: shut the (persistent) DataLoader workers down first
+    del batches, trainloader, testloader, trainset
+    gc.collect()
+    result.update({
+        "status": "ok",
+        "batch_size": batch_size,
+        "steps": steps,
+        "setup_sec": setup_sec,
+        "samples_per_sec": batch_size * len(latencies) / sum(latencies),
+        "latency_ms": {"p50": Percentile_ms(latencies, 50), "p90": Percentile_ms(latencies, 90), "p99": Percentile_ms(latencies, 99), "mean": float(np.mean(latencies) * 1000.)},
+        "data_wait_ms": {"p50": Percentile_ms(data_latencies, 50), "p90": Percentile_ms(data_latencies, 90)},
+        "peak_rss_mb": Peak_RSS_MB(),
+        "peak_rss_workers_mb": Peak_RSS_MB(resource.RUSAGE_CHILDREN), # largest DataLoader worker
+    })
+    if(device.type == "cuda"):
+        result["peak_cuda_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    return result
+
+def Safe_Benchmark_Cell(*args, **kwargs):
+    # one failing cell (e.g. missing weights) must not stop the matrix
+    try:
+        return Benchmark_Cell(*args, **kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        return {"pretrained_model": args[1], "mapping_method": args[2], "train_resize": args[3], "status": "error", "error": repr(e)}
+
+def Environment(device):
+    env = {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "device": str(device),
+    }
+    if(torch.cuda.is_available()):
+        env["cuda_device"] = torch.cuda.get_device_name(0)
+    return env
+
+def Run_Benchmark(dataset, backbones=None, mapping_methods=None, train_resize=(True, False), device="cpu", isolate=True, **cell_kwargs):
+    backbones = MODEL_ZOO if backbones == None else backbones
+    mapping_methods = MAPPING_METHODS if mapping_methods == None else mapping_methods
+    results = []
+    for pretrained_model in backbones:
+        for mapping_method in mapping_methods:
+            for resize in train_resize:
+                print(f"Benchmark: {dataset}, {pretrained_model}, {mapping_method}, train_resize={resize}")
+                args = (dataset, pretrained_model, mapping_method, resize, str(device))
+                if(isolate == True):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                        result = pool.submit(Safe_Benchmark_Cell, *args, **cell_kwargs).result()
+                else:
+                    result = Safe_Benchmark_Cell(*args, **cell_kwargs)
+                if(result["status"] == "ok"):
+                    print(f"    {result['samples_per_sec']:.1f} samples/s, p50 {result['latency_ms']['p50']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+                else:
+                    print(f"    {result['status']}: {result.get('reason', result.get('error'))}")
+                results.append(result)
+    config = {"dataset": dataset, "device": str(device), "isolate": isolate}
+    config.update(cell_kwargs)
+    return {"config": config, "environment": Environment(device), "results": results}
+
+def Compare_Baseline(report, baseline, tolerance=0.1):
+    # regressions beyond `tolerance` (relative): lower samples/sec, higher p50 latency or peak RSS
+    base = {Cell_Key(r): r for r in baseline["results"] if r["status"] == "ok"}
+    regressions = []
+    for r in report["results"]:
+        key = Cell_Key(r)
+        if(r["status"] != "ok" or key not in base):
+            continue
+        b = base[key]
+        checks = [("samples_per_sec", r["samples_per_sec"], b["samples_per_sec"], -1),
+                  ("latency_ms.p50", r["latency_ms"]["p50"], b["latency_ms"]["p50"], 1),
+                  ("peak_rss_mb", r["peak_rss_mb"], b["peak_rss_mb"], 1)]
+        for metric, current, previous, sign in checks:
+            change = (current - previous) / previous if previous > 0 else 0.
+            if(sign * change > tolerance):
+                regressions.append({"cell": key, "metric": metric, "baseline": previous, "current": current, "change": change})
+    return regressions
+
+def Save_Report(report, path):
+    if(os.path.dirname(path) != ""):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return
+
+def Load_Report(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+from auto_vp.const import CLASS_NUMBER
+
+# Synthetic stand-ins for the datasets of DataPrepare(): same class count, raw image size
+# and batch structure, random pixels. Registered in DataPrepare() as "Synthetic-<dataset>",
+# so the whole pipeline (decode, transform, loader, model) runs without any download.
+
+SYNTHETIC_PREFIX = "Synthetic-"
+
+# raw (pre-transform) image side of the real datasets, default 256
+SYNTHETIC_NATIVE_SIZE = {
+    'CIFAR10' : 32,
+    'CIFAR10-C' : 32,
+    'CIFAR100' : 32,
+    'SVHN' : 32,
+    'GTSRB' : 32,
+    'EuroSAT' : 64,
+    'ABIDE' : 200,
+}
+
+SYNTHETIC_LENGTH = {"train": 4096, "test": 1024}
+
+WILD_DATASETS = ["Camelyon17", "Iwildcam", "FMoW"]
+
+def Is_Synthetic(dataset_name):
+    return dataset_name[0:len(SYNTHETIC_PREFIX)] == SYNTHETIC_PREFIX
+
+def Real_Dataset_Name(dataset_name):
+    # "Synthetic-CIFAR10" -> "CIFAR10"
+    if(Is_Synthetic(dataset_name) == True):
+        return dataset_name[len(SYNTHETIC_PREFIX):]
+    return dataset_name
+
+class Synthetic(Dataset):
+    # Sample idx depends only on (seed, mode, idx), so every epoch and every worker sees the same data.
+    # Images are generated as PIL images of the native size and go through the same transform as the real dataset.
+    def __init__(self, dataset_name, mode="train", length=None, transformer=None, seed=0):
+        self.dataset_name = dataset_name
+        self.mode = mode
+        self.class_num = CLASS_NUMBER[dataset_name]
+        self.native_size = SYNTHETIC_NATIVE_SIZE.get(dataset_name, 256)
+        self.length = length if length != None else SYNTHETIC_LENGTH[mode]
+        self.transformer = transformer
+        self.wild_dataset = (dataset_name in WILD_DATASETS)
+        self.seed = seed + (0 if mode == "train" else 1)
+        self.targets = [i % self.class_num for i in range(self.length)] # balanced, read by Get_Targets()
+        self.classes = [f"class {i}" for i in range(self.class_num)]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        rng = np.random.default_rng(self.seed * 1000003 + idx)
+        img = Image.fromarray(rng.integers(0, 256, (self.native_size, self.native_size, 3), dtype=np.uint8))
+        if(self.transformer != None):
+            img = self.transformer(img)
+        label = self.targets[idx]
+        if(self.wild_dataset == True): # WILDS loaders yield (x, y, metadata)
+            return img, label, torch.zeros(1, dtype=torch.long)
+        return img, label
+
+def Synthetic_DataPrepare(dataset_name, target_size, batch_size=64, clip_transform=None, random_state=1, num_workers=2):
+    dataset_name = Real_Dataset_Name(dataset_name)
+    if(dataset_name not in CLASS_NUMBER):
+        raise NotImplementedError(f"{SYNTHETIC_PREFIX}{dataset_name} not supported")
+    if(clip_transform == None):
+        transform = torchvision.transforms.Compose(
+            [torchvision.transforms.ToTensor(),
+            torchvision.transforms.Resize(target_size)])
+    else:
+        transform = clip_transform
+
+    trainset = Synthetic(dataset_name, mode="train", transformer=transform, seed=random_state)
+    trainloader = DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    testset = Synthetic(dataset_name, mode="test", transformer=transform, seed=random_state)
+    testloader = DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    class_names = list(testset.classes)
+    return trainloader, testloader, class_names, trainset
@@ -0,0 +1,158 @@
+import os
+import copy
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler, SubsetRandomSampler
+from auto_vp.distributed import Get_Rank, Get_World_Size
+from auto_vp.loader_tuning import Loader_Options
+
+def To_CPU(obj):
+    # detached CPU copy, so training can keep updating the live tensors
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        out = OrderedDict((k, To_CPU(v)) for k, v in obj.items()) if isinstance(obj, OrderedDict) else {k: To_CPU(v) for k, v in obj.items()}
+        if hasattr(obj, "_metadata"): # module state_dict versions, used by load_state_dict
+            out._metadata = copy.deepcopy(obj._metadata)
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(To_CPU(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def Atomic_Save(state_dict, path):
+    # write next to the target and rename, so a crash never leaves a truncated checkpoint
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        torch.save(state_dict, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return
+
+class Checkpoint_Writer:
+    # Saves checkpoints on a background thread. save() only snapshots the tensors to CPU;
+    # a newer save for the same path replaces one that has not been written yet.
+    # enabled=False turns save() into a no-op (non-zero ranks of a data-parallel run).
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.pending = {}
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict, path):
+        if(self.enabled == False):
+            return
+        snapshot = To_CPU(state_dict)
+        with self.cond:
+            self._raise_error()
+            self.pending[path] = snapshot
+            self.cond.notify_all()
+        return
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while(len(self.pending) == 0 and self.closed == False):
+                    self.cond.wait()
+                if(len(self.pending) == 0):
+                    return
+                path, snapshot = self.pending.popitem()
+                self.busy = True
+            try:
+                Atomic_Save(snapshot, path)
+            except Exception as e:
+                self.error = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def _raise_error(self):
+        if(self.error != None):
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        with self.cond:
+            while(len(self.pending) > 0 or self.busy == True):
+                self.cond.wait()
+            self._raise_error()
+        return
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        return
+
+
+# ---- Resumable training: RNG states and a data order that can restart mid-epoch ----
+
+def RNG_State():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def Set_RNG_State(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if("cuda" in state and torch.cuda.is_available()):
+        torch.cuda.set_rng_state_all(state["cuda"])
+    return
+
+class Resumable_Sampler(Sampler):
+    # The permutation depends only on (seed, epoch), so a resumed run can skip the
+    # first `start` samples of the epoch without loading them.
+    # With num_replicas > 1 each rank takes every num_replicas-th sample (padded like DistributedSampler).
+    def __init__(self, indices, seed=0, num_replicas=1, rank=0):
+        self.indices = list(indices)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(len(self.indices), generator=g).tolist()
+        if(self.num_replicas > 1):
+            perm += perm[:self.num_samples()*self.num_replicas - len(perm)]
+            perm = perm[self.rank::self.num_replicas]
+        for i in perm[self.start:]:
+            yield self.indices[i]
+
+    def num_samples(self):
+        return (len(self.indices) + self.num_replicas - 1) // self.num_replicas
+
+    def __len__(self):
+        return self.num_samples() - self.start
+
+def Resumable_Loader(loader, seed=0):
+    if isinstance(loader.sampler, Resumable_Sampler):
+        return loader
+    if isinstance(loader.sampler, SubsetRandomSampler): # from Data_Scalability()
+        indices = loader.sampler.indices
+    else:
+        indices = range(len(loader.dataset))
+    sampler = Resumable_Sampler(indices, seed, Get_World_Size(), Get_Rank())
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler, collate_fn=loader.collate_fn,
+                      drop_last=loader.drop_last, **Loader_Options(loader))
@@ -0,0 +1,194 @@
+from auto_vp.const import METRIC_REPORT_INTERVAL
+from auto_vp.imagenet1000_classname import IMGNET_CLASSNAME
+from auto_vp.metrics import Running_Metrics
+from auto_vp.checkpoint import Checkpoint_Writer
+from auto_vp.training_process import FreqLabelMap, Checkpoint_State
+
+import torch
+import torch.nn as nn
+from tqdm.auto import tqdm
+import os
+
+# Co-training of K prompt configurations (InputPadding / Trainable_Resize / Output_Mapping)
+# over one frozen backbone. Every decoded batch goes through the K prompts, the K prompted
+# batches are concatenated along the batch dimension for a single backbone forward, and
+# each configuration keeps its own optimizer, scheduler, metrics and checkpoints.
+
+def Per_Config(value, K):
+    if isinstance(value, (list, tuple)):
+        if(len(value) != K):
+            raise ValueError(f"Expected {K} per-configuration values, got {len(value)}")
+        return list(value)
+    return [value for _ in range(K)]
+
+def Co_Forward(models, imgs):
+    # [B, ...] -> K logits of [B, ...]
+    xs = [m.Prompt_network(imgs) for m in models]
+    features = models[0].Backbone_network(torch.cat(xs))
+    return [m.output_mapping(x) for m, x in zip(models, features.chunk(len(models)))]
+
+def Co_Evaluate(models, loader, criterion, device, desc="Testing", wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL):
+    for m in models:
+        m.eval()
+    metrics = [Running_Metrics(["loss", "acc"], device, report_interval) for _ in models]
+    pbar = tqdm(loader, total=len(loader), desc=desc, ncols=120)
+    for pb in pbar:
+        if(wild_dataset == True):
+            imgs, labels, _ = pb
+        else:
+            imgs, labels = pb
+
+        if imgs.get_device() == -1:
+            imgs = imgs.to(device)
+            labels = labels.to(device)
+        with torch.no_grad():
+            logits = Co_Forward(models, imgs)
+            for k in range(len(models)):
+                loss = criterion(logits[k], labels)
+                acc = (logits[k].argmax(dim=-1) == labels).float().mean()
+                metrics[k].update(loss, acc)
+
+        if(metrics[0].should_report()):
+            pbar.set_postfix_str(", ".join(f"{k}: {m.average()[1]*100:.2f}%" for k, m in enumerate(metrics)))
+    return [m.average() for m in metrics]
+
+def Co_Training(dataset, fname, models, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL):
+    # lr, weight_decay and freqmap_interval: one value for all configurations or a list of K values
+    K = len(models)
+    lrs = Per_Config(lr, K)
+    weight_decays = Per_Config(weight_decay, K)
+    freqmap_intervals = Per_Config(freqmap_interval, K)
+    for m in models[1:]:
+        if(m.model is not models[0].model):
+            raise ValueError("Co_Training: all configurations must share one backbone (see shared_backbone of BaseWrapper)")
+    is_clip = (models[0].model_name[0:4] == "clip")
+
+    criterion = nn.CrossEntropyLoss()
+    optimizers = []
+    schedulers = []
+    if(is_clip == True):
+        if any(m.output_mapping.mapping_method == "semantic_mapping" for m in models):
+            print("CLIP not support semantic mapping!")
+            return
+        # same classes and templates for every configuration: embed the texts once
+        template_number = 0 # use default template
+        models[0].CLIP_Text_Embedding(class_names, template_number)
+        for m in models[1:]:
+            m.txt_emb = models[0].txt_emb
+            m.text_content = models[0].text_content
+
+        t_max = Epoch * len(trainloader)
+        for k in range(K):
+            optimizers.append(torch.optim.SGD(models[k].parameters(), lr=lrs[k], momentum=0.9, weight_decay=weight_decays[k]))
+            schedulers.append(torch.optim.lr_scheduler.CosineAnnealingLR(optimizers[k], T_max=t_max))
+    else:
+        for k in range(K):
+            if(models[k].output_mapping.mapping_method == "semantic_mapping"):
+                models[k].output_mapping.Semantic_mapping(list(IMGNET_CLASSNAME.values()), class_names)
+            optimizers.append(torch.optim.Adam(models[k].parameters(), lr=lrs[k], weight_decay=weight_decays[k]))
+            schedulers.append(torch.optim.lr_scheduler.MultiStepLR(optimizers[k], milestones=[int(0.5*Epoch), int(0.72*Epoch)], gamma=0.1))
+
+    # Frequency mapping
+    for m in models:
+        FreqLabelMap(m, trainloader, device, wild_dataset=wild_dataset)
+
+    save_paths = []
+    for k in range(K):
+        save_paths.append(f"results_auto_vp/_cotrain_{dataset}/config_{k}")
+        os.makedirs(save_paths[k], exist_ok=True)
+
+    f = open(fname, "a")
+    best_results = [[-1, 0., 0., 1.] for _ in range(K)] # epoch, traing acc, validation acc, resize scale
+    ckpt_writer = Checkpoint_Writer()
+    policy = models[0].execution_policy
+    scaler = policy.grad_scaler() # one scaler: the K losses are summed into one backward
+    valid_interval = 1 if is_clip == True else 2
+    for epoch in range(Epoch):
+        # Frequency mapping
+        for k in range(K):
+            if(models[k].output_mapping.mapping_method == "frequency_based_mapping" and freqmap_intervals[k] != None and epoch!= 0 and epoch%freqmap_intervals[k] == 0):
+                FreqLabelMap(models[k], trainloader, device, wild_dataset=wild_dataset)
+
+        # Training
+        for m in models:
+            m.train()
+        train_metrics = [Running_Metrics(["loss", "acc"], device, report_interval) for _ in range(K)]
+        pbar = tqdm(trainloader, total=len(trainloader), desc=f"Epoch {epoch+1} Training {K} configs", ncols=120)
+        for pb in pbar:
+            if(wild_dataset == True):
+                imgs, labels, _ = pb
+            else:
+                imgs, labels = pb
+
+            if imgs.get_device() == -1:
+                imgs = imgs.to(device)
+                labels = labels.to(device)
+
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            with policy.autocast():
+                logits = Co_Forward(models, imgs)
+                losses = [criterion(logits[k], labels) for k in range(K)]
+            # the configurations share no parameters, so the summed loss gives each its own gradient
+            scaler.scale(sum(losses)).backward()
+
+            for k in range(K):
+                m = models[k]
+                if(is_clip == True):
+                    # clip scale's gradient
+                    if(m.no_trainable_resize == 0):
+                        nn.utils.clip_grad_value_(m.train_resize.scale, 0.001)
+                    if(m.output_mapping.mapping_method == "fully_connected_layer_mapping"):
+                        nn.utils.clip_grad_value_(m.output_mapping.layers.bias, 0.001)
+                        nn.utils.clip_grad_value_(m.output_mapping.layers.weight, 0.001)
+                scaler.step(optimizers[k])
+            scaler.update()
+            if(is_clip == True):
+                models[0].model.logit_scale.data = torch.clamp(models[0].model.logit_scale.data, 0, 4.6052) # shared backbone
+
+            for k in range(K):
+                m = models[k]
+                if(m.no_trainable_resize == 0):
+                    with torch.no_grad():
+                        m.train_resize.scale = m.train_resize.scale.clamp_(0.1, 5.0)
+                if(is_clip == True):
+                    schedulers[k].step()
+                acc = (logits[k].argmax(dim=-1) == labels).float().mean()
+                train_metrics[k].update(losses[k], acc)
+
+            if(train_metrics[0].should_report()):
+                pbar.set_postfix_str(", ".join(f"{k}: {m.average()[1]*100:.2f}%" for k, m in enumerate(train_metrics)))
+
+        # update log
+        train_results = [m.average() for m in train_metrics]
+        for k in range(K):
+            total_train_loss, total_train_acc = train_results[k]
+            f.write(f"[config {k}] Epoch {epoch+1} Training Lr {optimizers[k].param_groups[0]['lr']:.1e}, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}\n")
+            if(is_clip == False):
+                schedulers[k].step()
+
+        if(epoch%valid_interval == 0 or epoch == Epoch-1):
+            # Validation, also one backbone forward per batch for all configurations
+            valid_results = Co_Evaluate(models, testloader, criterion, device, desc=f"Epoch {epoch+1} Testing {K} configs",
+                                        wild_dataset=wild_dataset, report_interval=report_interval)
+            for k in range(K):
+                total_valid_loss, total_valid_acc = valid_results[k]
+                f.write(f"[config {k}] Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
+
+                if (total_valid_acc > best_results[k][2] or epoch == Epoch - 1):
+                    ss = None
+                    if(models[k].no_trainable_resize == 0):
+                        ss = models[k].train_resize.scale.item()
+                    # save model
+                    print(f"[config {k}] Save! Acc: ", total_valid_acc, ", Scale: ", ss, ", Epoch: ", epoch+1)
+                    f.write(f"[config {k}] Save! Acc: {total_valid_acc}, Scale: {ss}, Epoch: {epoch+1}\n")
+                    state_dict = Checkpoint_State(models[k], optimizers[k])
+                    if(total_valid_acc > best_results[k][2]):
+                        best_results[k] = [epoch, train_results[k][1], total_valid_acc, ss]
+                        ckpt_writer.save(state_dict, os.path.join(save_paths[k], "result_best.pth"))
+                    if(epoch == Epoch - 1):
+                        ckpt_writer.save(state_dict, os.path.join(save_paths[k], "result_last.pth"))
+
+    ckpt_writer.close()
+    f.close()
+    return best_results
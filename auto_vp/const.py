@@ -70,6 +70,8 @@ IMG_SIZE = {
     'ImageNet1k' : 128
 }
 
+MODEL_ZOO = ["vgg16_bn", "resnet18", "resnet50", "resnext101_32x8d", "ig_resnext101_32x8d", "vit_b_16", "clip", "clip_large", "clip_ViT_B_32", "swin_t"]
+
 SOURCE_CLASS_NUM = {
     'vgg16_bn' : 1000, 
     'resnet18' : 1000,
@@ -217,6 +219,15 @@ NETSTD = {
     'ig_resnext101_32x8d' : [0.229, 0.224, 0.225]
 }
 
+# Steps between device->host syncs for the running training/validation metrics
+METRIC_REPORT_INTERVAL = 10
+
+# CIFAR10-C: one <corruption>.npy per corruption, severities 1-5 stacked in order, 10000 images each
+CIFAR10_C_CORRUPTIONS = ["gaussian_noise", "shot_noise", "speckle_noise", "impulse_noise", "defocus_blur", "gaussian_blur",
+                         "glass_blur", "motion_blur", "zoom_blur", "snow", "fog", "brightness", "contrast", "elastic_transform",
+                         "pixelate", "jpeg_compression", "spatter", "saturate", "frost"]
+CIFAR10_C_SEVERITY_SIZE = 10000
+
 DEFAULT_TEMPLATE = "This is a photo of a {}."
 
 ENSEMBLE_TEMPLATES = [
@@ -2,8 +2,12 @@
 import auto_vp.datasets as datasets
 from auto_vp.const import GTSRB_LABEL_MAP
 from auto_vp.ILM_Dataloader import COOPLMDBDataset
+from auto_vp.loader_tuning import Configure_Loader, Loader_Kwargs, Loader_Options
+from auto_vp.tensor_store import Stored_Dataset, TENSOR_STORE_DATASETS
+from auto_vp.manifest import Manifest_ImageFolder
+from auto_vp.preprocess import Is_Uint8_Transform
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import torchvision
 import torch
 from wilds import get_dataset
@@ -15,7 +19,10 @@ import os
 import json
 import zipfile
 import requests
+import numpy as np
 
+# stratified Data_Scalability() splits, see Stratified_Subset_Index()
+SPLIT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "autovp", "splits")
 
 
 def refine_classnames(class_names):
@@ -23,7 +30,7 @@ def refine_classnames(class_names):
         class_names[i] = class_name.lower().replace('_', ' ').replace('-', ' ')
     return class_names
 
-def DataPrepare(dataset_name, dataset_dir, target_size, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), download=True, batch_size=64, random_state=1, clip_transform=None, CIFAR10_C_mode="gaussian_noise"):
+def DataPrepare(dataset_name, dataset_dir, target_size, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), download=True, batch_size=64, random_state=1, clip_transform=None, CIFAR10_C_mode="gaussian_noise", loader_config=None, tensor_store=None):
     if(clip_transform == None):
         transform = torchvision.transforms.Compose(
             [torchvision.transforms.ToTensor(),
@@ -170,7 +177,9 @@ def DataPrepare(dataset_name, dataset_dir, target_size, mean=(0.485, 0.456, 0.40
         trainset = None
         trainloader = None
 
-        testset = datasets.CIFAR10_C(download=download, data_path=dataset_dir, mode=CIFAR10_C_mode, target_size=target_size, transformer=transform)
+        # uint8 pipeline: rows go to the model as they are, see auto_vp/preprocess.py
+        testset = datasets.CIFAR10_C(download=download, data_path=dataset_dir, mode=CIFAR10_C_mode, target_size=target_size, transformer=transform,
+                                     array_native=Is_Uint8_Transform(clip_transform))
         testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
                                                  shuffle=False, num_workers=2)
         
@@ -258,9 +267,23 @@ def DataPrepare(dataset_name, dataset_dir, target_size, mean=(0.485, 0.456, 0.40
     elif dataset_name == "tiny-imagenet-200":
         dataset_dir = os.path.join(dataset_dir, dataset_name)
         trainloader, testloader, class_names, trainset = prepare_tiny_imagenet(dataset_dir, transform)
+    elif dataset_name[0:10] == "Synthetic-": # random stand-in of a dataset above, for throughput benchmarks
+        from auto_vp.benchmark.synthetic import Synthetic_DataPrepare # auto_vp.benchmark imports this module
+        trainloader, testloader, class_names, trainset = Synthetic_DataPrepare(dataset_name, target_size, batch_size=batch_size, clip_transform=clip_transform, random_state=random_state)
     else:
         raise NotImplementedError(f"{dataset_name} not supported")
 
+    if(tensor_store != None and dataset_name in TENSOR_STORE_DATASETS):
+        # decode every image once into sharded uint8 arrays under tensor_store, see auto_vp/tensor_store.py
+        store_mode = "squash" if clip_transform == None else getattr(clip_transform, "store_mode", "crop")
+        trainset = Stored_Dataset(trainloader.dataset, tensor_store, f"{dataset_name}_train", store_mode)
+        testset = Stored_Dataset(testloader.dataset, tensor_store, f"{dataset_name}_test", store_mode)
+        trainloader = DataLoader(trainset, batch_size=trainloader.batch_size, shuffle=True, **Loader_Options(trainloader))
+        testloader = DataLoader(testset, batch_size=testloader.batch_size, shuffle=False, **Loader_Options(testloader))
+
+    # workers / prefetch depth / persistent workers / pinned memory, see auto_vp/loader_tuning.py
+    trainloader = Configure_Loader(trainloader, loader_config)
+    testloader = Configure_Loader(testloader, loader_config)
     return trainloader, testloader, class_names, trainset
 
 
@@ -307,9 +330,9 @@ def prepare_tiny_imagenet(data_path, preprocess=None, preprocess_test=None):
     if preprocess_test is None:
         preprocess_test = preprocess
 
-    # Load the datasets
-    train_data = torchvision.datasets.ImageFolder(train_dir, transform=preprocess)
-    val_data = torchvision.datasets.ImageFolder(val_dir, transform=preprocess_test)
+    # Load the datasets (file scans cached, see auto_vp/manifest.py)
+    train_data = Manifest_ImageFolder(train_dir, os.path.join(data_path, 'tiny-imagenet-200'), "train", transform=preprocess)
+    val_data = Manifest_ImageFolder(val_dir, os.path.join(data_path, 'tiny-imagenet-200'), "val", transform=preprocess_test)
     
     # Create data loaders
     loaders = {
@@ -339,7 +362,10 @@ def prepare_tiny_imagenet(data_path, preprocess=None, preprocess_test=None):
 
     return trainloader, testloader, actual_class_names, trainset
 
-def Data_Scalability(trainset, scalibility_rio, batch_size, mode="random", random_state=1, wild_dataset=False):
+def Data_Scalability(trainset, scalibility_rio, batch_size, mode="random", random_state=1, wild_dataset=False, loader_config=None, loader=None, dataset_name=None):
+    # loader: the full training loader, whose worker / prefetch settings the subset loader takes over
+    # dataset_name: cache the "equal" split on disk (see Stratified_Subset_Index)
+    loader_kwargs = Loader_Options(loader) if loader != None else Loader_Kwargs(loader_config)
     total_index = range(0,len(trainset))
     if(mode == "random"):
         kf = KFold(n_splits=scalibility_rio, shuffle=True, random_state=random_state)
@@ -347,39 +373,77 @@ def Data_Scalability(trainset, scalibility_rio, batch_size, mode="random", rando
             print(small_ids)
             break
         small_subsampler = torch.utils.data.SubsetRandomSampler(small_ids)
-        trainloader = DataLoader(trainset, batch_size=batch_size, sampler=small_subsampler)
+        trainloader = DataLoader(trainset, batch_size=batch_size, sampler=small_subsampler, **loader_kwargs)
     elif(mode == "equal"):
-        targets = []
-        trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=False, num_workers=2)
-        pbar = tqdm(trainloader, total=len(trainloader))
-        for pb in pbar:
-            if(wild_dataset == True):
-                imgs, labels, _ = pb
-            else:
-                imgs, labels = pb
-            targets += labels
-        print(len(targets))
-
-        big_ids, small_ids = train_test_split(total_index, test_size=1/scalibility_rio, random_state=random_state, shuffle=True, stratify=targets)
+        # stratified on the labels alone, no image is decoded
+        small_ids = Stratified_Subset_Index(trainset, scalibility_rio, random_state, wild_dataset, batch_size, dataset_name)
         print(len(small_ids))
 
         small_subsampler = torch.utils.data.SubsetRandomSampler(small_ids)
-        trainloader = DataLoader(trainset, batch_size=batch_size, sampler=small_subsampler)
-        #### Check the Spilt ####
-        count = {}
-        pbar = tqdm(trainloader, total=len(trainloader))
-        for pb in pbar:
-            if(wild_dataset == True):
-                imgs, labels, _ = pb
-            else:
-                imgs, labels = pb
-
-            for lab in labels:
-                if lab.item() in count:
-                    count[lab.item()] =  count[lab.item()] + 1
-                else:
-                    count[lab.item()] = 1
-        print(count) 
+        trainloader = DataLoader(trainset, batch_size=batch_size, sampler=small_subsampler, **loader_kwargs)
     else:
         raise NotImplementedError(f"{mode} not supported")
     return trainloader
+
+def Get_Targets(dataset, batch_size=64, wild_dataset=False):
+    # labels are only used for stratification, so any consistent encoding will do
+    if isinstance(dataset, Subset):
+        return Get_Targets(dataset.dataset, batch_size, wild_dataset)[np.asarray(dataset.indices)]
+    for attr in ["targets", "_labels", "labels", "label", "y_array"]:
+        targets = getattr(dataset, attr, None)
+        if(targets is not None and len(targets) == len(dataset)):
+            return np.asarray([int(t) for t in targets])
+    for attr in ["samples", "_samples"]: # (path, label) pairs: ImageFolder, GTSRB
+        samples = getattr(dataset, attr, None)
+        if(samples is not None and len(samples) == len(dataset)):
+            return np.asarray([int(s[1]) for s in samples])
+
+    # no label attribute: one pass over the data
+    targets = []
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=2)
+    for pb in tqdm(loader, total=len(loader), desc="Reading labels", ncols=100):
+        targets += [int(t) for t in pb[1]]
+    return np.asarray(targets)
+
+def Stratified_Subset_Index(dataset, scalibility_rio, random_state=1, wild_dataset=False, batch_size=64, dataset_name=None, cache_dir=SPLIT_CACHE_DIR):
+    # indices of a stratified 1/scalibility_rio subset, computed from the labels only and cached
+    # in cache_dir per dataset (name and size), ratio and seed
+    cache_path = None
+    if(dataset_name != None and cache_dir != None):
+        cache_path = os.path.join(cache_dir, f"{dataset_name}_n{len(dataset)}_r{scalibility_rio}_s{random_state}.npy")
+        if(os.path.exists(cache_path)):
+            print(f"Data split (cached): {cache_path}")
+            return np.load(cache_path)
+
+    targets = Get_Targets(dataset, batch_size, wild_dataset)
+    big_ids, small_ids = train_test_split(np.arange(len(dataset)), test_size=1/scalibility_rio, random_state=random_state, shuffle=True, stratify=targets)
+    classes, counts = np.unique(targets[small_ids], return_counts=True)
+    print({int(c): int(n) for c, n in zip(classes, counts)})
+
+    if(cache_path != None):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp.{os.getpid()}.npy"
+        np.save(tmp_path, small_ids)
+        os.replace(tmp_path, cache_path)
+    return small_ids
+
+def Validation_Subset(testloader, validation_size, random_state=1, wild_dataset=False):
+    # fixed stratified subset of the test set for per-epoch model selection
+    # validation_size: number of samples (>1) or fraction of the test set (<=1)
+    dataset = testloader.dataset
+    if(validation_size > 1):
+        n = int(validation_size)
+    else:
+        n = int(round(validation_size*len(dataset)))
+    if(n >= len(dataset)):
+        return testloader
+
+    total_index = np.arange(len(dataset))
+    targets = Get_Targets(dataset, testloader.batch_size, wild_dataset)
+    try:
+        _, val_ids = train_test_split(total_index, test_size=n, random_state=random_state, shuffle=True, stratify=targets)
+    except ValueError: # fewer samples than classes, or a class with a single sample
+        print("Warning: cannot stratify the validation subset, sample it uniformly")
+        _, val_ids = train_test_split(total_index, test_size=n, random_state=random_state, shuffle=True)
+    print(f"Validation subset: {len(val_ids)} / {len(dataset)}")
+    return DataLoader(Subset(dataset, np.sort(val_ids)), batch_size=testloader.batch_size, shuffle=False, **Loader_Options(testloader))
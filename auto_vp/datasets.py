@@ -13,8 +13,14 @@ from typing import Any
 from PIL import Image
 import numpy.ma as ma
 import os
+import json
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import urllib.request as request
 from sklearn.model_selection import train_test_split
+from auto_vp.manifest import Manifest, Listdir, Stamp
+from auto_vp.const import CIFAR10_C_SEVERITY_SIZE
 
 
 class Dataset(object):
@@ -68,29 +74,23 @@ class Melanoma(Dataset):
         # Lable dictionary
         self.lab_dic = {'akiec': 0, 'bcc': 1, 'bkl': 2, 'df': 3, 'mel': 4, 'nv': 5, 'vasc': 6}
 
-        # Read all the data
-        total_data = []
-        for file_name in self.total_list:
-            file_path = os.path.join(self.data_path, file_name)
-            number_list = sorted([x for x in os.listdir(file_path)])
-            total_data += [os.path.join(file_path, number_list[x]) for x in range(len(number_list))]
-
-        df = pd.read_csv(os.path.join(self.data_path, "HAM10000_metadata.csv")) # Unordered list in the csv file
-        df =  df[['image_id', 'dx']]
-        img_name = [(x.split("/"))[-1] for x in total_data]
-        total_label = [self.lab_dic[df[df['image_id'] == x[0:-4]]['dx'].values[0]] for x in img_name] # File name end with ".jpg"
-
-        # Resampling
-        nv_count = 0
-        idx = 0
-        for i in range(len(total_data)):
-            if(total_label[idx] == self.lab_dic['nv']):
-                if( nv_count%3 != 0):
-                    total_data.pop(idx)
-                    total_label.pop(idx)
-                    idx -= 1
-                nv_count += 1
-            idx += 1
+        # Read all the data (cached file manifest, see auto_vp/manifest.py)
+        def build(stamps):
+            total_data = []
+            for file_name in self.total_list:
+                file_path = os.path.join(self.data_path, file_name)
+                total_data += [os.path.join(file_path, x) for x in Listdir(file_path, stamps)]
+
+            df = pd.read_csv(Stamp(os.path.join(self.data_path, "HAM10000_metadata.csv"), stamps)) # Unordered list in the csv file
+            dx = df.drop_duplicates('image_id').set_index('image_id')['dx']
+            img_id = pd.Series([os.path.basename(x)[0:-4] for x in total_data]) # File name end with ".jpg"
+            total_label = img_id.map(dx).map(self.lab_dic).to_numpy(dtype=np.int64)
+
+            # Resampling: keep every third nv image
+            is_nv = (total_label == self.lab_dic['nv'])
+            keep = np.logical_or(is_nv == False, (np.cumsum(is_nv) - 1) % 3 == 0)
+            return [x for x, k in zip(total_data, keep) if k], total_label[keep]
+        total_data, total_label = Manifest(self.data_path, "Melanoma", build)
 
         X_train, X_test, y_train, y_test = train_test_split(
             total_data, total_label, test_size=0.1, random_state=random_state)
@@ -115,8 +115,53 @@ class Melanoma(Dataset):
         label = self.label[idx]
         return img,label
 
+def ABIDE_Correlation(filename, transformer):
+    # ROI time series -> upper triangle of the ROI correlation matrix, resized by transformer: (1, H, W) float32
+    df = pd.read_csv(filename, sep='\t')
+    # Create correlation matrix
+    # ref: https://github.com/pcdslab/ASD-DiagNet
+    np.seterr(divide='ignore', invalid='ignore')
+    img = np.nan_to_num(np.corrcoef(df.T))  # corr: (200, 200)
+    # upper triangle (without diagonal) set True, others set False
+    mask = np.invert(np.tri(img.shape[0], k=0, dtype=bool))
+    # keep the value of upper triangle, others set 0
+    img = np.where(mask, img, 0) # (200, 200)
+    img = Image.fromarray(img)
+    img = transformer(img)
+    return img.numpy()
+
+def ABIDE_Matrices(paths, transformer, cache_dir, tag, dtype=np.float32, num_workers=None):
+    # all correlation matrices as one (N, 1, H, W) array, computed once across a process pool and
+    # memory-mapped from <cache_dir>/ABIDE_<fingerprint>.npy afterwards (keyed by the ROI files and tag)
+    h = hashlib.sha1()
+    h.update(f"{tag}|{np.dtype(dtype).name}".encode())
+    for path in paths:
+        st = os.stat(path)
+        h.update(f"|{path}|{st.st_size}|{st.st_mtime_ns}".encode())
+    cache_path = os.path.join(cache_dir, f"ABIDE_{h.hexdigest()[:16]}.npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if(num_workers == None):
+        num_workers = min(16, os.cpu_count())
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}.npy"
+    matrices = None
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for i, img in enumerate(pool.map(functools.partial(ABIDE_Correlation, transformer=transformer), paths, chunksize=8)):
+            if(matrices is None):
+                matrices = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(paths),) + img.shape)
+            matrices[i] = img
+    matrices.flush()
+    del matrices
+    os.replace(tmp_path, cache_path)
+    print(f"ABIDE correlation matrices: {cache_path}")
+    return np.load(cache_path, mmap_mode='r')
+
 class ABIDE(Dataset):
-    def __init__(self, download=True, data_path=None, mode=None, target_size=(64, 64), data_mean=(0.5, 0.5, 0.5), data_std=(0.5, 0.5, 0.5), random_state=1):
+    # Samples are rows of one memory-mapped (N, 1, H, W) array shared by both splits (float16 with
+    # cache_dtype="float16"); the channel is expanded to 3 as a view and only materialized by collate.
+    def __init__(self, download=True, data_path=None, mode=None, target_size=(64, 64), data_mean=(0.5, 0.5, 0.5), data_std=(0.5, 0.5, 0.5), random_state=1, cache_dtype="float32", num_workers=None):
         super().__init__(data_path, mode, target_size, data_mean, data_std)
 
         if(download):
@@ -138,25 +183,29 @@ class ABIDE(Dataset):
         df = df[['FILE_ID', 'DX_GROUP']]
 
         fnames = []
+        paths = []
         for file_name in downloaded_list:
             file_path = os.path.join(self.data_path, file_name)
             number_list = sorted([x for x in os.listdir(file_path)])
             fnames += [number_list[x] for x in range(len(number_list))]
+            paths += [os.path.join(file_path, x) for x in number_list]
+
+        self.matrices = ABIDE_Matrices(paths, self.transformer, os.path.join(self.data_path, ".autovp_cache"),
+                                       f"{target_size}", dtype=np.dtype(cache_dtype), num_workers=num_workers)
 
         train, test = train_test_split(
-            fnames, test_size=0.1, random_state=random_state)
+            np.arange(len(fnames)), test_size=0.1, random_state=random_state)
 
         if(mode == "train"):
-            fnames = train
+            index = train
         elif(mode == "test"):
-            fnames = test
+            index = test
         elif(mode == "total"):
-            pass
+            index = np.arange(len(fnames))
 
-        self.data = [self.Get_image(os.path.join(file_path, x))
-                     for x in fnames]
-        self.label = [df[df['FILE_ID'] == x[0:-14]]
-                        ['DX_GROUP'].values[0] for x in fnames]
+        self.data = index # rows of self.matrices
+        dx = df.drop_duplicates('FILE_ID').set_index('FILE_ID')['DX_GROUP']
+        self.label = pd.Series([fnames[i][0:-14] for i in index], dtype=object).map(dx).to_numpy(dtype=np.int64).tolist()
 
     def Download_dataset(self, out_dir, pipeline="cpac", strategy="filt_global", derivative="rois_cc200", ext="1D"):
         # Download option (pipeline, strategy, derivative, ext) from: https://github.com/pcdslab/ASD-DiagNet
@@ -207,28 +256,22 @@ class ABIDE(Dataset):
                     os.path.join(download_prefix, file_name)))
 
     def Get_image(self, filename):
-        df = pd.read_csv(filename, sep='\t')
-        # Create correlation matrix
-        # ref: https://github.com/pcdslab/ASD-DiagNet
-        np.seterr(divide='ignore', invalid='ignore')
-        img = np.nan_to_num(np.corrcoef(df.T))  # corr: (200, 200)
-        # upper triangle (without diagonal) set True, others set False
-        mask = np.invert(np.tri(img.shape[0], k=0, dtype=bool))
-        # keep the value of upper triangle, others set 0
-        img = np.where(mask, img, 0) # (200, 200)
-        img = Image.fromarray(img)
-        img = self.transformer(img)
+        img = torch.from_numpy(ABIDE_Correlation(filename, self.transformer))
         img = img.repeat(3,1,1) # (3, 200, 200)
         return img
 
     def __getitem__(self, idx):
-        img = self.data[idx]
+        img = torch.from_numpy(np.array(self.matrices[self.data[idx]], dtype=np.float32))
+        img = img.expand(3, -1, -1) # (3, 200, 200) view of the single channel
         label = self.label[idx] - 1  # 1->0, 2->1
         return img, label
 
 # ref: https://github.com/tanimutomo/cifar10-c-eval/blob/master/src/dataset.py
 class CIFAR10_C(Dataset):
-    def __init__(self, download=True, data_path=None, mode=None, target_size=(64, 64), data_mean=(0.5, 0.5, 0.5), data_std=(0.5, 0.5, 0.5), transformer=None):
+    # The corruption array is memory-mapped. severity: one level (1-5) instead of all five.
+    # array_native: samples are uint8 CHW tensors straight from the array (no PIL, no transform),
+    # gathered a batch at a time, for BaseWrapper's batched uint8 preprocessing.
+    def __init__(self, download=True, data_path=None, mode=None, target_size=(64, 64), data_mean=(0.5, 0.5, 0.5), data_std=(0.5, 0.5, 0.5), transformer=None, severity=None, array_native=False):
         super().__init__(data_path, mode, target_size, data_mean, data_std)
         
         if(download):
@@ -248,24 +291,36 @@ class CIFAR10_C(Dataset):
         if(transformer!=None):
             self.transformer = transformer
         
-        mode_list = ["gaussian_noise", "shot_noise", "speckle_noise", "impulse_noise", "defocus_blur", "gaussian_blur",
-                     "motion_blur", "zoom_blur", "snow", "fog", "brightness", "contrast", "elastic_transform", "pixelate", 
-                     "jpeg_compression", "spatter", "saturate", "frost"]
-        
+        # mode: one of CIFAR10_C_CORRUPTIONS (auto_vp/const.py)
         img_path = os.path.join(data_path, mode + '.npy')
         target_path = os.path.join(data_path, 'labels.npy')
         
-        self.data = np.load(img_path)
+        self.data = np.load(img_path, mmap_mode='r') # (50000, 32, 32, 3) uint8
         self.label = np.load(target_path)
+        if(severity != None):
+            rows = slice((severity - 1) * CIFAR10_C_SEVERITY_SIZE, severity * CIFAR10_C_SEVERITY_SIZE)
+            self.data = self.data[rows]
+            self.label = self.label[rows]
+        self.array_native = array_native
         self.classes = ["airplane", "automobile", "bird", "cat", "deer", "dog", "frog", "horse", "ship", "truck"]
     
     def __getitem__(self,idx):
         img = self.data[idx]
-        img = Image.fromarray(img)
-        img = self.transformer(img)
+        if(self.array_native == True):
+            img = torch.from_numpy(np.array(img)).permute(2, 0, 1)
+        else:
+            img = Image.fromarray(img)
+            img = self.transformer(img)
         label = self.label[idx]
         return img,label
 
+    def __getitems__(self, indices):
+        if(self.array_native == False):
+            return [self[idx] for idx in indices]
+        # one gather from the memory map per batch
+        imgs = torch.from_numpy(self.data[np.asarray(indices)]).permute(0, 3, 1, 2)
+        return list(zip(imgs, self.label[np.asarray(indices)]))
+
 class Spawrious(Dataset):
     def __init__(self, download=True, data_path=None, mode=None, target_size=(64, 64), data_mean=(0.5, 0.5, 0.5), data_std=(0.5, 0.5, 0.5), random_state=1, transformer=None):
         super().__init__(data_path, mode, target_size, data_mean, data_std)
@@ -279,42 +334,42 @@ class Spawrious(Dataset):
         # Lable dictionary
         self.lab_dic = {'bulldog': 0, 'corgi': 1, 'dachshund': 2, 'labrador': 3}
 
-        if(mode == "train"): # M2M-Hard Setting
-            order = ['bulldog', 'corgi', 'dachshund', 'labrador']
-            env = [['beach', 'snow'], ['mountain', 'desert'], ['beach', 'snow'], ['mountain', 'desert']]  
-            for i, category in enumerate(order):
-                for background in env[i]:
-                    background_path = os.path.join(data_path, background)
-                    category_path = os.path.join(background_path, category)
-                    for img in sorted([y for y in os.listdir(category_path)]):
-                        self.data.append(os.path.join(category_path, img))
-                        self.label.append(self.lab_dic[category])
-
-        elif(mode == "test"): # M2M-Hard Setting
-            order = ['bulldog', 'corgi', 'dachshund', 'labrador']
-            env = [['mountain', 'desert'], ['beach', 'snow'], ['mountain', 'desert'], ['beach', 'snow']]   
-            for i, category in enumerate(order):
-                for background in env[i]:
+        # cached file manifest, see auto_vp/manifest.py
+        def build(stamps):
+            data = []
+            label = []
+            if(mode == "train"): # M2M-Hard Setting
+                order = ['bulldog', 'corgi', 'dachshund', 'labrador']
+                env = [['beach', 'snow'], ['mountain', 'desert'], ['beach', 'snow'], ['mountain', 'desert']]  
+                for i, category in enumerate(order):
+                    for background in env[i]:
+                        background_path = os.path.join(data_path, background)
+                        category_path = os.path.join(background_path, category)
+                        for img in Listdir(category_path, stamps):
+                            data.append(os.path.join(category_path, img))
+                            label.append(self.lab_dic[category])
+
+            elif(mode == "test"): # M2M-Hard Setting
+                order = ['bulldog', 'corgi', 'dachshund', 'labrador']
+                env = [['mountain', 'desert'], ['beach', 'snow'], ['mountain', 'desert'], ['beach', 'snow']]   
+                for i, category in enumerate(order):
+                    for background in env[i]:
+                        background_path = os.path.join(data_path, background)
+                        category_path = os.path.join(background_path, category)
+                        for img in Listdir(category_path, stamps):
+                            data.append(os.path.join(category_path, img))
+                            label.append(self.lab_dic[category])
+                            
+            elif(mode == "total"):
+                for background in Listdir(data_path, stamps):
                     background_path = os.path.join(data_path, background)
-                    category_path = os.path.join(background_path, category)
-                    for img in sorted([y for y in os.listdir(category_path)]):
-                        self.data.append(os.path.join(category_path, img))
-                        self.label.append(self.lab_dic[category])
-                        
-        elif(mode == "total"):
-            # count  = [0,0,0,0]
-            for background in sorted([x for x in os.listdir(data_path)]):
-                background_path = os.path.join(data_path, background)
-                for category in sorted([y for y in os.listdir(background_path)]):
-                    category_path = os.path.join(background_path, category)
-                    # idx = self.lab_dic[category]
-                    for img in sorted([y for y in os.listdir(category_path)]):
-                        self.data.append(os.path.join(category_path, img))
-                        self.label.append(self.lab_dic[category])
-                        # count[idx] += 1
-            
-            # print(len(self.data))
-            # print(count)
+                    for category in Listdir(background_path, stamps):
+                        category_path = os.path.join(background_path, category)
+                        for img in Listdir(category_path, stamps):
+                            data.append(os.path.join(category_path, img))
+                            label.append(self.lab_dic[category])
+            return data, label
+        self.data, self.label = Manifest(data_path, f"Spawrious_{mode}", build)
 
     def Download_dataset(self, out_dir):
         # wget https://www.dropbox.com/s/5usem63nfub266y/spawrious__m2m.tar.gz?dl=1 -O /.../Spawrious/spawrious__m2m.tar.gz
@@ -346,21 +401,23 @@ class ImageNet1k(Dataset):
             self.lab_dic[line.split()[0]] = int(line.split()[1])-1
             self.classes.append(line.split()[2])
 
-        train_path = os.path.join(data_path, "imagenet-mini/train")
-        if(mode == "train"):
-            for category in sorted([y for y in os.listdir(train_path)]):
-                category_path = os.path.join(train_path, category)
-                for img in sorted([im for im in os.listdir(category_path)]):
-                    self.data.append(os.path.join(category_path, img))
-                    self.label.append(self.lab_dic[category])
-
-        test_path = os.path.join(data_path, "imagenet-mini/val")
-        if(mode == "test"):
-            for category in sorted([y for y in os.listdir(test_path)]):
-                category_path = os.path.join(test_path, category)
-                for img in sorted([im for im in os.listdir(category_path)]):
-                    self.data.append(os.path.join(category_path, img))
-                    self.label.append(self.lab_dic[category])
+        # cached file manifest, see auto_vp/manifest.py
+        def build(stamps):
+            data = []
+            label = []
+            if(mode == "train"):
+                split_path = os.path.join(data_path, "imagenet-mini/train")
+            elif(mode == "test"):
+                split_path = os.path.join(data_path, "imagenet-mini/val")
+            else:
+                return data, label
+            for category in Listdir(split_path, stamps):
+                category_path = os.path.join(split_path, category)
+                for img in Listdir(category_path, stamps):
+                    data.append(os.path.join(category_path, img))
+                    label.append(self.lab_dic[category])
+            return data, label
+        self.data, self.label = Manifest(data_path, f"ImageNet1k_{mode}", build)
 
     def Download_dataset(self, out_dir):
         # kaggle datasets download -d ifigotin/imagenetmini-1000
@@ -0,0 +1,95 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Subset, SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from auto_vp.loader_tuning import Loader_Options
+
+# Data-parallel prompt training over several processes (gloo backend, CPU nodes).
+# Launch with torchrun, e.g. `torchrun --nnodes=2 --nproc_per_node=2 ... demo.py --distributed 1`.
+# Every rank holds the full model; the data is sharded with distributed samplers, the
+# gradients of the prompt and mapping are all-reduced and only rank 0 writes files.
+
+def Is_Distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def Get_Rank():
+    return dist.get_rank() if Is_Distributed() else 0
+
+def Get_World_Size():
+    return dist.get_world_size() if Is_Distributed() else 1
+
+def Is_Main_Process():
+    return Get_Rank() == 0
+
+def Setup_Distributed(backend="gloo"):
+    # rank / world size / master address come from the torchrun environment
+    if(Is_Distributed() == False):
+        dist.init_process_group(backend=backend)
+    print(f"Distributed: rank {Get_Rank()} / {Get_World_Size()}, backend {dist.get_backend()}")
+    return Get_Rank(), Get_World_Size()
+
+def Cleanup_Distributed():
+    if(Is_Distributed() == True):
+        dist.destroy_process_group()
+    return
+
+def Local_CPU_Threads():
+    # split this node's cores between the ranks running on it
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count()
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    return max(1, cores // local_world_size)
+
+def Distributed_Loader(loader, shuffle=True, seed=0):
+    # same dataset and batch size, one shard per rank (DistributedSampler pads the last shard)
+    dataset = loader.dataset
+    if isinstance(loader.sampler, SubsetRandomSampler): # from Data_Scalability()
+        dataset = Subset(dataset, list(loader.sampler.indices))
+    sampler = DistributedSampler(dataset, num_replicas=Get_World_Size(), rank=Get_Rank(), shuffle=shuffle, seed=seed)
+    return DataLoader(dataset, batch_size=loader.batch_size, sampler=sampler, collate_fn=loader.collate_fn,
+                      drop_last=loader.drop_last, **Loader_Options(loader))
+
+def Trainable_Parameters(model):
+    return [p for p in model.parameters() if p.requires_grad == True]
+
+def Broadcast_Model(model, src=0):
+    # start every rank from rank 0's prompt, resize, mapping and self_definded_map
+    if(Is_Distributed() == False):
+        return
+    for p in Trainable_Parameters(model):
+        dist.broadcast(p.data, src=src)
+    if hasattr(model, "output_mapping") and hasattr(model.output_mapping, "self_definded_map"):
+        obj = [model.output_mapping.self_definded_map]
+        dist.broadcast_object_list(obj, src=src)
+        model.output_mapping.self_definded_map = obj[0]
+    return
+
+def All_Reduce_Gradients(model):
+    # average the prompt/mapping gradients over the ranks in one flattened all-reduce
+    if(Is_Distributed() == False):
+        return
+    grads = [p.grad for p in Trainable_Parameters(model) if p.grad is not None]
+    if(len(grads) == 0):
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= Get_World_Size()
+    for g, reduced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        g.copy_(reduced)
+    return
+
+def All_Reduce_Sum(tensor):
+    if(Is_Distributed() == True):
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def Broadcast_Object(obj, src=0):
+    if(Is_Distributed() == False):
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
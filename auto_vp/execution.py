@@ -0,0 +1,133 @@
+import os
+import contextlib
+import torch
+import torch.nn as nn
+from torch.cuda.amp import GradScaler
+
+# Device-aware execution settings for prompt training.
+# CUDA keeps the original behaviour (fp16 autocast over the whole step + GradScaler).
+# On CPU only the frozen backbone runs under bf16 autocast (when the CPU has native
+# bf16 support), CNN backbones use channels_last, and the thread pools are set explicitly.
+
+CNN_BACKBONES = ["vgg16_bn", "resnet18", "resnet50", "resnext101_32x8d", "ig_resnext101_32x8d"]
+
+def CPU_Supports_BF16():
+    # bf16 autocast is emulated (and slower than fp32) without avx512_bf16 / AMX
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return ("avx512_bf16" in flags) or ("amx_bf16" in flags)
+
+def Setup_CPU_Threads(intra_op_threads=None, inter_op_threads=None):
+    if(intra_op_threads == None or intra_op_threads < 1):
+        try:
+            intra_op_threads = len(os.sched_getaffinity(0))
+        except AttributeError:
+            intra_op_threads = os.cpu_count()
+    if(inter_op_threads == None or inter_op_threads < 1):
+        inter_op_threads = 1 # the step is one sequential graph, inter-op parallelism only adds contention
+
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError: # can only be set once, before any inter-op parallel work
+        print("Warning: inter-op threads already initialized, keep", torch.get_num_interop_threads())
+    print(f"CPU threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+    return
+
+PRECISION_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+class Precision_Policy:
+    # Storage dtypes of the three kinds of tensors in prompt training:
+    # - the frozen backbone: fp32 / bf16 / fp16 (it is never updated, so no fp32 master copy)
+    # - the trainable prompt, resize and mapping: always fp32
+    # - the CLIP text embeddings (default fp32)
+    # With fp32 the backbone keeps the device's autocast (Execution_Policy); with bf16/fp16
+    # it runs natively in that dtype and its output is cast back to fp32 for the mapping.
+    def __init__(self, backbone_dtype="fp32", text_dtype="fp32"):
+        self.backbone_dtype = PRECISION_DTYPES[backbone_dtype] if isinstance(backbone_dtype, str) else backbone_dtype
+        self.prompt_dtype = torch.float32
+        self.text_dtype = PRECISION_DTYPES[text_dtype] if isinstance(text_dtype, str) else text_dtype
+
+    def low_precision(self):
+        return self.backbone_dtype != torch.float32
+
+    def cast_backbone(self, model):
+        # also replaces CLIP's "cast every parameter to fp32" (clip.load returns fp16 weights on CUDA)
+        return model.to(self.backbone_dtype)
+
+    def cast_input(self, x):
+        if(x.is_floating_point() and x.dtype != self.backbone_dtype):
+            x = x.to(self.backbone_dtype)
+        return x
+
+    def cast_text(self, txt_emb):
+        return txt_emb.to(self.text_dtype)
+
+    def cast_module_input(self, model):
+        # for a bare torchvision/timm backbone called with fp32 images (CLIP's encode_image casts by itself)
+        if(self.low_precision() == True):
+            model.register_forward_pre_hook(lambda module, args: (self.cast_input(args[0]),) + tuple(args[1:]))
+        return model
+
+    def cache_tag(self):
+        # feature caches of different backbone dtypes must not collide
+        if(self.low_precision() == False):
+            return ""
+        return "_" + [k for k, v in PRECISION_DTYPES.items() if v == self.backbone_dtype][0]
+
+class Float32_Head(nn.Module):
+    # fp32 trainable head on top of a low-precision frozen backbone (linear-probing baselines)
+    def __init__(self, head):
+        super(Float32_Head, self).__init__()
+        self.head = head
+
+    def forward(self, x):
+        return self.head(x.float())
+
+class Execution_Policy:
+    def __init__(self, device=None, cpu_bf16=None, channels_last=None, precision=None):
+        self.device_type = torch.device(device).type if device != None else "cpu"
+
+        if(precision == None):
+            precision = Precision_Policy()
+        self.precision = precision
+        if(self.device_type != "cuda" and precision.backbone_dtype == torch.float16):
+            print("Warning: fp16 backbone without CUDA runs without loss scaling, bf16 is preferred on CPU")
+
+        if(cpu_bf16 == None):
+            cpu_bf16 = CPU_Supports_BF16()
+        self.cpu_bf16 = (self.device_type == "cpu" and cpu_bf16)
+
+        if(channels_last == None):
+            channels_last = (self.device_type == "cpu")
+        self.channels_last = channels_last
+
+    # wraps the whole forward + loss in the training loops
+    def autocast(self):
+        if(self.device_type == "cuda" and self.precision.low_precision() == False):
+            return torch.autocast(device_type="cuda", dtype=torch.float16)
+        return contextlib.nullcontext()
+
+    # wraps only the frozen backbone inside BaseWrapper
+    def backbone_autocast(self):
+        if(self.cpu_bf16 == True and self.precision.low_precision() == False):
+            return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    # loss scaling whenever fp16 is in the graph: CUDA autocast or an fp16 backbone (bf16 needs none)
+    def grad_scaler(self):
+        fp16 = (self.precision.low_precision() == False or self.precision.backbone_dtype == torch.float16)
+        return GradScaler(enabled=(self.device_type == "cuda" and fp16))
+
+    def prepare_backbone(self, model_name, model):
+        if(self.channels_last == True and model_name in CNN_BACKBONES):
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, model_name, x):
+        if(self.channels_last == True and model_name in CNN_BACKBONES):
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
@@ -0,0 +1,101 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset, SubsetRandomSampler, BatchSampler, RandomSampler, SequentialSampler
+from tqdm.auto import tqdm
+
+# Frozen-backbone feature cache for the linear-probing baselines (LP / CLIP_LP).
+# The backbone runs once per split; the penultimate features are stored in a
+# memory-mapped .npy file and the linear head trains directly on them.
+
+def Transform_Key(dataset):
+    transform = getattr(dataset, "transform", None)
+    if(transform == None):
+        transform = getattr(dataset, "transformer", None)
+    # drop object addresses (e.g. CLIP's _convert_image_to_rgb) so the key is stable across runs
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", repr(transform))
+
+def Split_Indices(loader):
+    # Data_Scalability() draws the subset with a SubsetRandomSampler
+    if isinstance(loader.sampler, SubsetRandomSampler):
+        return np.sort(np.asarray(loader.sampler.indices, dtype=np.int64))
+    return None
+
+def Feature_Cache_Path(cache_dir, backbone, dataset_name, transform_key, split, indices=None):
+    h = hashlib.sha1()
+    h.update(transform_key.encode())
+    if(indices is not None):
+        h.update(np.ascontiguousarray(indices, dtype=np.int64).tobytes())
+    return os.path.join(cache_dir, f"{dataset_name}_{backbone}_{split}_{h.hexdigest()[:16]}")
+
+def Extract_Features(feature_fn, loader, device, path, wild_dataset=False):
+    if os.path.exists(path + ".json"):
+        print(f"Load cached features: {path}")
+        features = np.load(path + "_feat.npy", mmap_mode="r")
+        labels = np.load(path + "_label.npy")
+        return features, labels
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    dataset = loader.dataset
+    indices = Split_Indices(loader)
+    if(indices is not None):
+        dataset = Subset(dataset, indices)
+    ordered_loader = DataLoader(dataset, batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers)
+
+    n = len(dataset)
+    features = None
+    labels = np.zeros(n, dtype=np.int64)
+    idx = 0
+    pbar = tqdm(ordered_loader, total=len(ordered_loader), desc="Caching features", ncols=100)
+    for pb in pbar:
+        if(wild_dataset == True):
+            imgs, labs, _ = pb
+        else:
+            imgs, labs = pb
+
+        with torch.no_grad():
+            x = feature_fn(imgs.to(device)).float().cpu().numpy()
+        x = x.reshape(x.shape[0], -1)
+
+        if(features is None):
+            features = np.lib.format.open_memmap(path + "_feat.tmp.npy", mode="w+", dtype=np.float32, shape=(n, x.shape[1]))
+        features[idx:idx+len(x)] = x
+        labels[idx:idx+len(x)] = np.asarray(labs)
+        idx += len(x)
+
+    features.flush()
+    del features
+    os.replace(path + "_feat.tmp.npy", path + "_feat.npy")
+    np.save(path + "_label.npy", labels)
+    # the meta file is written last, so an interrupted run never leaves a valid-looking cache
+    with open(path + ".json", "w") as f:
+        json.dump({"num_samples": n}, f)
+
+    features = np.load(path + "_feat.npy", mmap_mode="r")
+    return features, labels
+
+class Cached_Feature_Dataset(Dataset):
+    # __getitem__ takes a list of indices, so one call returns a whole batch
+    def __init__(self, features, labels):
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        idx = np.sort(np.asarray(idx)) # sorted reads are sequential on the memmap
+        return torch.from_numpy(np.asarray(self.features[idx])), torch.from_numpy(self.labels[idx])
+
+def Cached_Feature_Loader(feature_fn, backbone, dataset_name, split, loader, device, cache_dir, shuffle=True, wild_dataset=False):
+    path = Feature_Cache_Path(cache_dir, backbone, dataset_name, Transform_Key(loader.dataset), split, Split_Indices(loader))
+    features, labels = Extract_Features(feature_fn, loader, device, path, wild_dataset=wild_dataset)
+    dataset = Cached_Feature_Dataset(features, labels)
+    if(shuffle == True):
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size=loader.batch_size, drop_last=False), batch_size=None)
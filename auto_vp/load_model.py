@@ -9,7 +9,7 @@ import random
 from torch.nn.parameter import Parameter
 import os
 
-def Load_Reprogramming_Model(dataset, device, file_path=None, mapping_method="frequency_based_mapping", set_train_resize=True, pretrained_model="resnet18", mapping=None, scale=1.0, num_map=1, weightinit=True):
+def Load_Reprogramming_Model(dataset, device, file_path=None, mapping_method="frequency_based_mapping", set_train_resize=True, pretrained_model="resnet18", mapping=None, scale=1.0, num_map=1, weightinit=True, shared_backbone=None, execution_policy=None, pretrained_weights=True):
     ##### Model Setting #####
     channel = 3
     img_resize = IMG_SIZE[dataset]
@@ -106,5 +106,5 @@ def Load_Reprogramming_Model(dataset, device, file_path=None, mapping_method="fr
                                         mapping_method=mapping_method, num_source_to_map=num_map, self_definded_map=mapping, weightinit=weightinit, device=device) 
 
     reprogram_model = BaseWrapper(model_name=pretrained_model, dataset_name=dataset, input_perturbation=input_pad,
-                                output_mapping=out_map, train_resize=resize, init_scale=scale, clip_img_size=img_resize, device=device)
+                                output_mapping=out_map, train_resize=resize, init_scale=scale, clip_img_size=img_resize, device=device, execution_policy=execution_policy, shared_backbone=shared_backbone, pretrained_weights=pretrained_weights)
     return reprogram_model
\ No newline at end of file
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import socket
+import torch
+from torch.utils.data import DataLoader
+
+# DataLoader settings for DataPrepare() / Data_Scalability(), loader-stall measurement for the
+# training loops, and an auto-tuner that probes worker counts and prefetch depth with the real
+# dataset and backbone and caches the winner per host and dataset.
+
+DEFAULT_LOADER_CONFIG = {"num_workers": 2, "prefetch_factor": 2, "persistent_workers": True, "pin_memory": None}
+
+LOADER_TUNING_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "autovp", "loader_tuning.json")
+
+def Loader_Options(loader):
+    # the worker / prefetch / pinning settings of an existing loader, to rebuild it over another sampler
+    options = {"num_workers": loader.num_workers, "pin_memory": loader.pin_memory}
+    if(loader.num_workers > 0):
+        options["prefetch_factor"] = loader.prefetch_factor
+        options["persistent_workers"] = loader.persistent_workers
+    return options
+
+def Loader_Kwargs(loader_config=None):
+    config = dict(DEFAULT_LOADER_CONFIG)
+    if(loader_config != None):
+        config.update({k: v for k, v in loader_config.items() if v != None})
+    kwargs = {"num_workers": config["num_workers"]}
+    kwargs["pin_memory"] = torch.cuda.is_available() if config.get("pin_memory") == None else config["pin_memory"]
+    if(config["num_workers"] > 0): # only valid with worker processes
+        kwargs["prefetch_factor"] = config["prefetch_factor"]
+        kwargs["persistent_workers"] = config["persistent_workers"]
+    return kwargs
+
+def Configure_Loader(loader, loader_config=None):
+    # same dataset, sampler, batch size and collate_fn, new worker / prefetch / pinning settings
+    # (the loader keeps its own worker count unless loader_config sets one); None stays None (CIFAR10-C has no trainloader)
+    if(loader == None):
+        return None
+    config = {"num_workers": loader.num_workers}
+    if(loader_config != None):
+        config.update({k: v for k, v in loader_config.items() if v != None})
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=loader.sampler, collate_fn=loader.collate_fn,
+                      drop_last=loader.drop_last, **Loader_Kwargs(config))
+
+class Loader_Stall_Meter:
+    # Splits the wall time of a loop over a loader into time blocked in next() (wait)
+    # and time spent in the loop body (compute).
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wait = 0.
+        self.compute = 0.
+        self.batches = 0
+
+    def iterate(self, loader):
+        it = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            resume = time.perf_counter()
+            self.wait += resume - start
+            self.batches += 1
+            yield batch
+            self.compute += time.perf_counter() - resume
+
+    def stall_fraction(self):
+        total = self.wait + self.compute
+        return self.wait / total if total > 0 else 0.
+
+    def report(self, prefix=""):
+        return (f"{prefix} Loader: wait {self.wait:.1f}s, compute {self.compute:.1f}s, "
+                f"stall {self.stall_fraction()*100:.1f}% over {self.batches} batches\n").lstrip()
+
+def Probe_Step(model, device):
+    # prompt + backbone forward/backward of a BaseWrapper on a batch, without touching the optimizer
+    # (the output mapping may not exist yet: frequency mapping and CLIP text embeddings come later)
+    def step(pb):
+        imgs = pb[0].to(device, non_blocking=True)
+        with model.execution_policy.autocast():
+            x = model.Prompt_network(imgs)
+            if(model.model_name[0:4] == "clip"):
+                out = model.model.encode_image(x)
+            else:
+                out = model.Backbone_network(x)
+        if(out.requires_grad == True):
+            out.float().sum().backward()
+        model.zero_grad(set_to_none=True)
+    return step
+
+def Loader_Candidates(max_workers=None):
+    if(max_workers == None):
+        try:
+            max_workers = len(os.sched_getaffinity(0))
+        except AttributeError:
+            max_workers = os.cpu_count()
+    workers = sorted(set([w for w in [0, 2, 4, 8, 16] if w <= max_workers] + [max_workers]))
+    candidates = [{"num_workers": 0}]
+    for w in workers:
+        if(w > 0):
+            for prefetch in [2, 4, 8]:
+                candidates.append({"num_workers": w, "prefetch_factor": prefetch, "persistent_workers": True})
+    return candidates
+
+def Probe_Loader(loader, loader_config, step_fn=None, probe_batches=20, warmup_batches=3):
+    # samples/sec of the loop (loader + step_fn) once the workers are up
+    probe = Configure_Loader(loader, loader_config)
+    meter = Loader_Stall_Meter()
+    seen = 0
+    start = None
+    for i, pb in enumerate(meter.iterate(probe)):
+        if(i == warmup_batches):
+            start = time.perf_counter()
+            meter.reset()
+        if(step_fn != None):
+            step_fn(pb)
+        if(i >= warmup_batches):
+            seen += pb[0].shape[0]
+        if(i + 1 >= warmup_batches + probe_batches):
+            break
+    elapsed = time.perf_counter() - start if start != None else 0.
+    del probe # shut the workers down before the next candidate
+    return {"samples_per_sec": seen / elapsed if elapsed > 0 else 0., "stall": meter.stall_fraction()}
+
+def Tuning_Key(dataset_name, backbone, batch_size, pipeline="float", tensor_store=False, target_size=None):
+    # the per-sample worker cost depends on the transform (float / uint8), the decoded store and the resize target
+    store = "store" if tensor_store == True else "decode"
+    return f"{socket.gethostname()}|cpu{os.cpu_count()}|{dataset_name}|{backbone}|bs{batch_size}|{pipeline}|{store}|size{target_size}"
+
+def Load_Tuned_Config(key, cache_path=LOADER_TUNING_CACHE):
+    if(os.path.exists(cache_path) == False):
+        return None
+    with open(cache_path) as f:
+        return json.load(f).get(key)
+
+def Save_Tuned_Config(key, config, cache_path=LOADER_TUNING_CACHE):
+    cache = {}
+    if(os.path.exists(cache_path) == True):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    cache[key] = config
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+    return
+
+def Auto_Tune_Loader(loader, dataset_name, backbone, step_fn=None, cache_path=LOADER_TUNING_CACHE, probe_batches=20, tolerance=0.05, retune=False,
+                     pipeline="float", tensor_store=False, target_size=None):
+    # returns (tuned loader, config); the fewest workers / shallowest prefetch within `tolerance` of the best wins
+    key = Tuning_Key(dataset_name, backbone, loader.batch_size, pipeline, tensor_store, target_size)
+    config = None if retune == True else Load_Tuned_Config(key, cache_path)
+    if(config != None):
+        print(f"Loader config (cached): {config}")
+        return Configure_Loader(loader, config), config
+
+    results = []
+    for candidate in Loader_Candidates():
+        result = Probe_Loader(loader, candidate, step_fn, probe_batches)
+        print(f"Loader probe {candidate}: {result['samples_per_sec']:.1f} samples/s, stall {result['stall']*100:.1f}%")
+        results.append((candidate, result))
+    best = max(r["samples_per_sec"] for _, r in results)
+    for candidate, result in results: # candidates are ordered cheapest first
+        if(result["samples_per_sec"] >= (1 - tolerance) * best):
+            config = dict(candidate)
+            break
+    config["samples_per_sec"] = best
+    Save_Tuned_Config(key, config, cache_path)
+    print(f"Loader config (tuned): {config}")
+    return Configure_Loader(loader, config), config
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import torchvision
+
+# Cached file manifests (path and label arrays) for the datasets that are built by scanning
+# directories. A manifest lives in <root>/.autovp_manifest/<name>.npz together with the mtime of
+# every directory (and metadata file) the scan read; it is rebuilt as soon as one of them changes,
+# i.e. when files are added, removed or renamed. Loading one costs a stat per stamped directory.
+
+MANIFEST_VERSION = 1
+MANIFEST_DIR = ".autovp_manifest"
+
+def Stamp(path, stamps):
+    stamps[path] = os.stat(path).st_mtime_ns
+    return path
+
+def Listdir(path, stamps):
+    # sorted entries of a directory (hidden ones skipped, among them the manifest directory)
+    Stamp(path, stamps)
+    return sorted([x for x in os.listdir(path) if x[0:1] != "."])
+
+def Stamps_Valid(stamps):
+    try:
+        return all(os.stat(path).st_mtime_ns == mtime for path, mtime in stamps.items())
+    except OSError:
+        return False
+
+def Load_Manifest(manifest_path):
+    try:
+        with np.load(manifest_path, allow_pickle=False) as f:
+            if(int(f["version"]) != MANIFEST_VERSION):
+                return None
+            stamps = dict(zip(f["stamp_paths"].tolist(), f["stamp_mtimes"].tolist()))
+            if(Stamps_Valid(stamps) == False):
+                return None
+            return f["paths"].tolist(), f["labels"].tolist()
+    except (OSError, ValueError, KeyError):
+        return None
+
+def Save_Manifest(manifest_path, paths, labels, stamps):
+    tmp_path = f"{manifest_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=np.int64(MANIFEST_VERSION), paths=np.array(paths, dtype=str), labels=np.array(labels, dtype=np.int64),
+                 stamp_paths=np.array(list(stamps.keys()), dtype=str), stamp_mtimes=np.array(list(stamps.values()), dtype=np.int64))
+    os.replace(tmp_path, manifest_path)
+    return
+
+def Manifest(root, name, build):
+    # (paths, labels) from build(stamps), which lists directories through Listdir(path, stamps)
+    manifest_dir = os.path.join(root, MANIFEST_DIR)
+    try:
+        os.makedirs(manifest_dir, exist_ok=True) # before the scan, so that it does not change a stamped mtime
+    except OSError:
+        print(f"Warning: {root} is not writable, file manifest not cached")
+        paths, labels = build({})
+        return list(paths), [int(x) for x in labels]
+    manifest_path = os.path.join(manifest_dir, f"{name}.npz")
+    cached = Load_Manifest(manifest_path)
+    if(cached != None):
+        return cached
+    stamps = {}
+    paths, labels = build(stamps)
+    Save_Manifest(manifest_path, paths, labels, stamps)
+    return list(paths), [int(x) for x in labels]
+
+class Manifest_ImageFolder(torchvision.datasets.ImageFolder):
+    # ImageFolder whose file scan (os.walk over every class directory) is cached in a manifest
+    def __init__(self, root, manifest_root, name, transform=None):
+        self.manifest_root = manifest_root
+        self.manifest_name = name
+        super(Manifest_ImageFolder, self).__init__(root, transform=transform)
+
+    def make_dataset(self, directory, class_to_idx, *args, **kwargs):
+        def build(stamps):
+            paths = []
+            labels = []
+            for target_class in sorted(class_to_idx.keys()):
+                for dirpath, dirnames, fnames in sorted(os.walk(os.path.join(directory, target_class), followlinks=True)):
+                    Stamp(dirpath, stamps)
+                    for fname in sorted(fnames):
+                        if(torchvision.datasets.folder.has_file_allowed_extension(fname, torchvision.datasets.folder.IMG_EXTENSIONS)):
+                            paths.append(os.path.join(dirpath, fname))
+                            labels.append(class_to_idx[target_class])
+            return paths, labels
+        paths, labels = Manifest(self.manifest_root, self.manifest_name, build)
+        return list(zip(paths, labels))
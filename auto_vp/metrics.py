@@ -0,0 +1,45 @@
+import torch
+from auto_vp.distributed import All_Reduce_Sum
+
+# Running averages of per-step metrics. The sums stay on the device and the step
+# count is a host-side int, so update() never synchronizes; the device is read
+# back only every `report_interval` steps (and once in average()).
+class Running_Metrics:
+    def __init__(self, names, device, report_interval=10):
+        self.names = list(names)
+        self.device = device
+        self.report_interval = report_interval
+        self.reset()
+
+    def reset(self):
+        self.sums = torch.zeros(len(self.names), device=self.device)
+        self.steps = 0
+        self.last = [0. for _ in self.names]
+
+    def update(self, *values):
+        # values follow the order of self.names; tensors are detached, python numbers are fine too
+        values = [v.detach().float().reshape([]) if torch.is_tensor(v) else torch.tensor(float(v)) for v in values]
+        self.sums += torch.stack([v.to(self.sums.device) for v in values])
+        self.steps += 1
+
+    def should_report(self):
+        return self.report_interval != None and self.report_interval > 0 and self.steps % self.report_interval == 0
+
+    def average(self):
+        # the only device->host sync
+        if(self.steps > 0):
+            self.last = (self.sums / self.steps).tolist()
+        return self.last
+
+    def all_reduce(self):
+        # data-parallel run: sum the step sums and counts of every rank (no-op in a single process)
+        t = All_Reduce_Sum(torch.cat([self.sums, torch.tensor([float(self.steps)], device=self.sums.device)]))
+        self.sums = t[:-1]
+        self.steps = int(t[-1].item())
+
+    def state_dict(self):
+        return {"sums": self.sums.cpu(), "steps": self.steps}
+
+    def load_state_dict(self, state_dict):
+        self.sums = state_dict["sums"].to(self.sums.device)
+        self.steps = state_dict["steps"]
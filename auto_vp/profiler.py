@@ -0,0 +1,172 @@
+import os
+import time
+import contextlib
+from collections import defaultdict
+import torch
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from auto_vp.distributed import Get_Rank
+
+# Per-stage profiling of the reprogramming pipeline (BaseWrapper.Profile()).
+# Stages: clip_resize (or preprocess for uint8 batches) -> train_resize -> input_padding -> backbone -> output_mapping, plus
+# the loss in backward. Forward time is measured around each stage; backward time is the
+# interval between the gradient reaching a stage's output and reaching the previous stage's
+# output (identity autograd markers). Only grad-enabled passes are recorded, so evaluation
+# and frequency mapping do not show up. Allocation counting intercepts every aten op and
+# adds per-op overhead to the measured times.
+
+PIPELINE_STAGES = ["preprocess", "clip_resize", "train_resize", "input_padding", "backbone", "output_mapping", "loss"]
+
+class Stage_Marker(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, profiler, name):
+        ctx.profiler = profiler
+        ctx.name = name
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        ctx.profiler.backward_event(ctx.name)
+        return grad, None, None
+
+class Allocation_Counter(TorchDispatchMode):
+    # charges every op output that does not alias an input to the profiler's current stage
+    def __init__(self, profiler):
+        super(Allocation_Counter, self).__init__()
+        self.profiler = profiler
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = set(t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                self.profiler.count_allocation(t.untyped_storage().nbytes())
+        return out
+
+class Stage_Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.allocations = True
+        self.sync = False
+        self.reset()
+
+    def enable(self, enabled=True, allocations=True, device=None):
+        self.enabled = enabled
+        self.allocations = allocations
+        self.sync = (device != None and torch.device(device).type == "cuda") # time the kernels, not their launch
+        self.reset()
+        return self
+
+    def reset(self):
+        self.time = defaultdict(float) # (phase, stage) -> seconds
+        self.alloc_count = defaultdict(int)
+        self.alloc_bytes = defaultdict(int)
+        self.steps = 0
+        self.current = None
+        self.events = None
+
+    def active(self):
+        return self.enabled == True and torch.is_grad_enabled() == True
+
+    def _sync(self):
+        if(self.sync == True):
+            torch.cuda.synchronize()
+
+    def _counter(self):
+        return Allocation_Counter(self) if self.allocations == True else contextlib.nullcontext()
+
+    def count_allocation(self, nbytes):
+        if(self.current != None):
+            self.alloc_count[self.current] += 1
+            self.alloc_bytes[self.current] += nbytes
+
+    def run(self, name, fn, *args):
+        # out = fn(*args), timed as stage `name`; tuple outputs (Trainable_Resize) are marked on their first element
+        if(self.active() == False):
+            return fn(*args)
+        self._sync()
+        self.current = ("forward", name)
+        start = time.perf_counter()
+        with torch.profiler.record_function(f"AutoVP::{name}"), self._counter():
+            out = fn(*args)
+        self._sync()
+        self.time[("forward", name)] += time.perf_counter() - start
+        self.current = None
+        if isinstance(out, tuple):
+            return (self.mark(name, out[0]),) + out[1:]
+        return self.mark(name, out)
+
+    def mark(self, name, x):
+        if(isinstance(x, torch.Tensor) and x.requires_grad == True):
+            return Stage_Marker.apply(x, self, name)
+        return x
+
+    def backward_event(self, name):
+        # the gradient reached the output of stage `name`: its backward starts, the next stage's ends
+        if(self.events == None):
+            return
+        self._sync()
+        self.events.append((name, time.perf_counter()))
+        self.current = ("backward", name)
+
+    @contextlib.contextmanager
+    def backward(self):
+        # wraps loss.backward() in the training loop
+        if(self.active() == False):
+            yield
+            return
+        self._sync()
+        self.events = [("loss", time.perf_counter())]
+        self.current = ("backward", "loss")
+        with self._counter():
+            yield
+        self._sync()
+        self.events.append((None, time.perf_counter()))
+        for (name, start), (_, end) in zip(self.events[:-1], self.events[1:]):
+            self.time[("backward", name)] += end - start
+        self.events = None
+        self.current = None
+        self.steps += 1
+
+    def report(self, prefix=""):
+        # per-step averages over the steps since the last reset(), one line per stage
+        lines = []
+        steps = max(self.steps, 1)
+        for name in PIPELINE_STAGES:
+            keys = [("forward", name), ("backward", name)]
+            if all(k not in self.time for k in keys):
+                continue
+            fwd, bwd = [self.time.get(k, 0.) * 1000. / steps for k in keys]
+            line = f"{prefix} Stage {name}: forward {fwd:.2f} ms, backward {bwd:.2f} ms"
+            if(self.allocations == True):
+                counts = [self.alloc_count.get(k, 0) / steps for k in keys]
+                mbytes = [self.alloc_bytes.get(k, 0) / steps / 2**20 for k in keys]
+                line += f", allocations {counts[0]:.0f} / {counts[1]:.0f} ({mbytes[0]:.1f} MB / {mbytes[1]:.1f} MB)"
+            lines.append(line)
+        return "".join(line.strip() + "\n" for line in lines)
+
+class Trace_Window:
+    # torch.profiler Chrome trace of `steps` training steps, starting after `start` steps
+    def __init__(self, trace_dir, start=10, steps=5):
+        self.trace_dir = trace_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        warmup = 1 if start > 0 else 0
+        self.prof = torch.profiler.profile(activities=activities,
+                                           schedule=torch.profiler.schedule(wait=start - warmup, warmup=warmup, active=steps, repeat=1),
+                                           on_trace_ready=self.export, record_shapes=True, profile_memory=True)
+        self.prof.start()
+
+    def export(self, prof):
+        path = os.path.join(self.trace_dir, f"trace_rank{Get_Rank()}_{int(time.time())}.json")
+        prof.export_chrome_trace(path)
+        print(f"Chrome trace: {path}")
+
+    def step(self):
+        self.prof.step()
+
+    def stop(self):
+        self.prof.stop()
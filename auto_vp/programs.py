@@ -2,15 +2,22 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
-import kornia
+import torchvision.transforms as transforms
 import numpy as np
 import matplotlib.pyplot as plt
 import clip
 from tqdm.auto import tqdm
+from .distributed import All_Reduce_Sum
 # ref: https://github.com/Prinsphield/Adversarial_Reprogramming/blob/master/main.py
 
 
 class Trainable_Resize(nn.Module):
+    # Pads the image to the output size and zooms the canvas by `scale` about its center (bilinear,
+    # zeros outside, align_corners=True: what kornia.geometry.transform.scale did), in one
+    # grid_sample straight from the unpadded image. The scale-independent part of the sampling grid
+    # is cached per shape, the scaled grid per scale value when no gradient is needed.
+    # The returned integer size uses a host copy of the scale. On CUDA it is refreshed asynchronously
+    # and may lag one optimizer step behind during training; with no grad it is exact.
     def __init__(self, output_size=(3, 256, 256)):
         super(Trainable_Resize, self).__init__()
         self.height_out = output_size[1]
@@ -21,17 +28,74 @@ class Trainable_Resize(nn.Module):
         self.u_pad = 0.0  # upper padding
         self.d_pad = 0.0  # lower padding
 
+        self.grid_key = None
+        self.base_grid = None   # (1, H_out, W_out, 2), divided by the scale
+        self.grid_offset = None # (2,), added after
+        self.grid_cache = None  # (scale version, grid)
+        self.scale_host = None  # (scale version, float)
+        self.scale_copy = None  # (scale version, pinned tensor, event) in flight
+
+    def __getstate__(self):
+        # copies (Snapshot_Model, pickling) rebuild the grid and the host scale
+        state = self.__dict__.copy()
+        for name in ["grid_key", "base_grid", "grid_offset", "grid_cache", "scale_copy"]:
+            state[name] = None
+        return state
+
+    def sampling_grid(self, image):
+        key = (tuple(image.shape[1:]), image.device, image.dtype)
+        if(key != self.grid_key):
+            # output pixel -> canvas pixel c + (p - c) / scale -> image pixel (minus the padding),
+            # normalized over the image (align_corners=True)
+            h_in, w_in = max(image.shape[2] - 1, 1), max(image.shape[3] - 1, 1)
+            ys = (torch.arange(self.height_out, dtype=image.dtype, device=image.device) - (self.height_out - 1) / 2) * (2 / h_in)
+            xs = (torch.arange(self.width_out, dtype=image.dtype, device=image.device) - (self.width_out - 1) / 2) * (2 / w_in)
+            self.base_grid = torch.stack(torch.meshgrid(xs, ys, indexing="xy"), dim=-1).unsqueeze(0)
+            self.grid_offset = torch.tensor([2 * ((self.width_out - 1) / 2 - self.l_pad) / w_in - 1,
+                                             2 * ((self.height_out - 1) / 2 - self.u_pad) / h_in - 1], dtype=image.dtype, device=image.device)
+            self.grid_key = key
+            self.grid_cache = None
+        if(torch.is_grad_enabled() == False and self.grid_cache != None and self.grid_cache[0] == self.scale._version):
+            return self.grid_cache[1]
+        grid = self.base_grid / self.scale.to(image.dtype) + self.grid_offset
+        self.grid_cache = (self.scale._version, grid) if torch.is_grad_enabled() == False else None
+        return grid
+
+    def scale_value(self):
+        # the scale as a python float, without a blocking device->host read in training
+        version = self.scale._version
+        if(self.scale.device.type != "cuda"):
+            return float(self.scale.detach())
+        exact = (torch.is_grad_enabled() == False) # evaluation waits for the current value
+        if(self.scale_copy != None and (self.scale_copy[2].query() == True or exact == True)):
+            self.finish_scale_copy()
+        if(self.scale_copy == None and (self.scale_host == None or self.scale_host[0] != version)):
+            buf = torch.empty((), dtype=self.scale.dtype, pin_memory=True)
+            buf.copy_(self.scale.detach(), non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self.scale_copy = (version, buf, event)
+        if(self.scale_copy != None and (self.scale_host == None or exact == True)): # nothing to fall back on yet
+            self.finish_scale_copy()
+        return self.scale_host[1]
+
+    def finish_scale_copy(self):
+        version, buf, event = self.scale_copy
+        event.synchronize()
+        self.scale_host = (version, float(buf))
+        self.scale_copy = None
+
     def forward(self, image):   # image.shape [batch_sz, channel, H, W]
         self.l_pad = int((self.width_out-image.shape[3]+1)/2)
         self.r_pad = int((self.width_out-image.shape[3])/2)
         self.u_pad = int((self.height_out-image.shape[2]+1)/2)
         self.d_pad = int((self.height_out-image.shape[2])/2)
 
-        x = torch.nn.functional.pad(
-            image, (self.l_pad, self.r_pad, self.u_pad, self.d_pad), value=0)
-        x = kornia.geometry.transform.scale(x, self.scale)
+        grid = self.sampling_grid(image)
+        x = torch.nn.functional.grid_sample(image, grid.expand(image.shape[0], -1, -1, -1), mode="bilinear", padding_mode="zeros", align_corners=True)
 
-        return x, min(int(image.shape[2]*self.scale), self.height_out), min(int(image.shape[3]*self.scale), self.width_out)
+        scale = self.scale_value()
+        return x, min(int(image.shape[2]*scale), self.height_out), min(int(image.shape[3]*scale), self.width_out)
 
 
 class InputPadding(nn.Module):
@@ -62,27 +126,101 @@ class InputPadding(nn.Module):
 
         self.input_aware = input_aware
 
+        # mask and padding offsets are rebuilt only when the (resized) image size changes
         self.mask = None
+        self.mask_key = None
+        self.pad_shape = tuple(img_size[1:])
         self.init_mask()
 
         self.delta = torch.nn.Parameter(
             data=torch.zeros(3, output_size[1], output_size[2]))
         self.dropout = nn.Dropout(0.2)
 
-    def init_mask(self):
-        self.mask = torch.ones(self.output_size).to(self.device)
-        # upper triangle and the diagonal are set to True, others are False
-        up_tri = np.invert(np.tri(N=self.img_h, M=self.img_w, k=0, dtype=bool))
-        up_tri = torch.from_numpy(up_tri)
-        if(self.padding_size == None or self.padding_size < int((self.out_h-self.img_h)//2)): 
+        # Fused compositor: out = pad(image) / std + (act(delta) * mask - mean) / std is written
+        # into a reused canvas per batch size, the prompt term computed once per step (training)
+        # or once per prompt version (no grad). Other normalizations take the unfused path.
+        self.fused = (normalization == None or isinstance(normalization, transforms.Normalize))
+        if(isinstance(normalization, transforms.Normalize)):
+            self.register_buffer("norm_mean", torch.tensor(normalization.mean, dtype=torch.float32).view(-1, 1, 1), persistent=False)
+            self.register_buffer("norm_std", torch.tensor(normalization.std, dtype=torch.float32).view(-1, 1, 1), persistent=False)
+            self.register_buffer("norm_scale", 1. / self.norm_std, persistent=False)
+        else:
+            self.norm_mean = None
+            self.norm_std = None
+            self.norm_scale = None
+        self.canvas = {}       # (batch size, dtype, device) -> canvas
+        self.canvas_step = {}  # (batch size, dtype, device) -> delta version of its last use with grad
+        self.prompt_cache = None
+
+    def __getstate__(self):
+        # copies (Snapshot_Model, pickling) start without the canvases
+        state = self.__dict__.copy()
+        state["canvas"] = {}
+        state["canvas_step"] = {}
+        state["prompt_cache"] = None
+        return state
+
+    def prompt_term(self):
+        # (act(delta) * mask - mean) / std: the part of the output that does not depend on the image
+        if(torch.is_grad_enabled() == False and self.prompt_cache != None and self.prompt_cache[0] == (self.delta._version, self.mask_key)):
+            return self.prompt_cache[1]
+        if(self.model_name[0:4] == "clip"): 
+            masked_delta = self.delta * self.mask
+        else:
+            masked_delta = torch.sigmoid(self.delta) * self.mask
+        if(self.norm_mean is not None):
+            masked_delta = (masked_delta - self.norm_mean) / self.norm_std
+        if(torch.is_grad_enabled() == False):
+            self.prompt_cache = ((self.delta._version, self.mask_key), masked_delta)
+        else:
+            self.prompt_cache = None
+        return masked_delta
+
+    def canvas_buffer(self, n, dtype, device):
+        key = (n, dtype, device)
+        if(torch.is_grad_enabled() == True):
+            # the canvas of the last step may still be saved for its backward until the optimizer
+            # has stepped (delta changed); until then, a second forward gets a fresh one
+            if(self.canvas_step.get(key) == self.delta._version):
+                return torch.empty((n,) + tuple(self.output_size), dtype=dtype, device=device)
+            self.canvas_step[key] = self.delta._version
+        if(key not in self.canvas):
+            if(len(self.canvas) >= 4): # e.g. train, last partial and eval batches
+                self.canvas.clear()
+                self.canvas_step.clear()
+            self.canvas[key] = torch.empty((n,) + tuple(self.output_size), dtype=dtype, device=device)
+        return self.canvas[key].detach() # no autograd history carried over between calls
+
+    def composite(self, image):
+        # one pass over the canvas: prompt term everywhere, image * (1 / std) added into its window
+        # (the output is only valid until the next call with the same batch size)
+        prompt = self.prompt_term()
+        canvas = self.canvas_buffer(image.shape[0], torch.promote_types(image.dtype, prompt.dtype), image.device)
+        canvas.copy_(prompt.expand(image.shape[0], -1, -1, -1))
+        window = canvas[:, :, self.u_pad:self.u_pad+image.shape[2], self.l_pad:self.l_pad+image.shape[3]]
+        if(self.norm_scale is not None):
+            window.addcmul_(image, self.norm_scale) # 1-channel images broadcast to 3 channels
+        else:
+            window.add_(image)
+        return canvas
+
+    def build_mask(self, img_h, img_w, device):
+        mask = torch.ones(self.output_size, device=device)
+        if(self.padding_size == None or self.padding_size < int((self.out_h-img_h)//2)): 
             if(self.dataset_name == "ABIDE"):
-                self.mask[:, int((self.out_h-self.img_h)//2):int((self.out_h+self.img_h)//2), int(
-                    (self.out_w-self.img_w)//2):int((self.out_w+self.img_w)//2)] = torch.where(up_tri, 0, 1).to(self.device)
+                # the strict upper triangle is image (mask 0), the diagonal and the lower triangle are prompted (mask 1)
+                mask[:, int((self.out_h-img_h)//2):int((self.out_h+img_h)//2), int(
+                    (self.out_w-img_w)//2):int((self.out_w+img_w)//2)] = 1 - torch.triu(torch.ones(img_h, img_w, device=device), diagonal=1)
             else:
-                self.mask[:, int((self.out_h-self.img_h)//2):int((self.out_h+self.img_h)//2), int(
-                    (self.out_w-self.img_w)//2):int((self.out_w+self.img_w)//2)] = 0 # the location of img is set to zero
+                mask[:, int((self.out_h-img_h)//2):int((self.out_h+img_h)//2), int(
+                    (self.out_w-img_w)//2):int((self.out_w+img_w)//2)] = 0 # the location of img is set to zero
         else:
-            self.mask[:, self.padding_size:self.out_h-self.padding_size, self.padding_size:self.out_w-self.padding_size] = 0 
+            mask[:, self.padding_size:self.out_h-self.padding_size, self.padding_size:self.out_w-self.padding_size] = 0 
+        return mask
+
+    def init_mask(self):
+        self.mask = self.build_mask(self.img_h, self.img_w, self.device)
+        self.mask_key = (self.img_h, self.img_w, self.mask.device)
 
     def redefind_mask(self, img, img_h, img_w):
         self.channel = img.size()[1]
@@ -95,27 +233,25 @@ class InputPadding(nn.Module):
         if(img_w != -1):
             self.img_w = img_w
 
-        self.mask = torch.ones(self.output_size).to(self.device)
-        # upper triangle and the diagonal are set to True, others are False
-        up_tri = np.invert(np.tri(N=self.img_h, M=self.img_w, k=0, dtype=bool))
-        up_tri = torch.from_numpy(up_tri).to(self.device)
-        if(self.padding_size == None or self.padding_size < int((self.out_h-self.img_h)//2)):
-            if(self.dataset_name == "ABIDE"):
-                self.mask[:, int((self.out_h-self.img_h)//2):int((self.out_h+self.img_h)//2), int(
-                    (self.out_w-self.img_w)//2):int((self.out_w+self.img_w)//2)] = torch.where(up_tri, 0, 1).to(self.device)
-            else:
-                self.mask[:, int((self.out_h-self.img_h)//2):int((self.out_h+self.img_h)//2), int(
-                    (self.out_w-self.img_w)//2):int((self.out_w+self.img_w)//2)] = 0 # the location of img is set to zero
-        else:
-            self.mask[:, self.padding_size:self.out_h-self.padding_size, self.padding_size:self.out_w-self.padding_size] = 0 
+        # device-resident mask, rebuilt only for a new image size (or device)
+        key = (self.img_h, self.img_w, img.device)
+        if(key != self.mask_key):
+            self.mask = self.build_mask(self.img_h, self.img_w, img.device)
+            self.mask_key = key
 
-        self.u_pad = int((self.out_h-img.size()[2]+1)/2)
-        self.d_pad = int((self.out_h-img.size()[2])/2)
-        self.l_pad = int((self.out_w-img.size()[3]+1)/2)
-        self.r_pad = int((self.out_w-img.size()[3])/2)
+        if(tuple(img.size()[2:]) != self.pad_shape):
+            self.pad_shape = tuple(img.size()[2:])
+            self.u_pad = int((self.out_h-img.size()[2]+1)/2)
+            self.d_pad = int((self.out_h-img.size()[2])/2)
+            self.l_pad = int((self.out_w-img.size()[3]+1)/2)
+            self.r_pad = int((self.out_w-img.size()[3])/2)
 
     def forward(self, image, img_h, img_w):
         self.redefind_mask(image, img_h, img_w)
+        # (torch.compile fuses the plain graph by itself)
+        if(self.fused == True and self.input_aware == False and min(self.u_pad, self.d_pad, self.l_pad, self.r_pad) >= 0 and torch._dynamo.is_compiling() == False):
+            return self.composite(image)
+
         # 3-self.channel+1: times of channel repeat to fit the image net model
         image = image.repeat(1, 3-self.channel+1, 1, 1)
 
@@ -147,8 +283,11 @@ class Output_Mapping(nn.Module):
         self.mapping_method = mapping_method
 
         # [[source_i1], [source_i2], ....], [source_i1] map to target1
-        self.self_definded_map = self_definded_map
+        # mirrored in the map_index buffer [target_class_num, num_source_to_map], updated in place on every remap
+        # so that a compiled forward gathers through a tensor instead of guarding on the list
         self.num_source_to_map = num_source_to_map
+        self.register_buffer("map_index", torch.zeros(target_class_num, num_source_to_map if num_source_to_map != None else 1, dtype=torch.long), persistent=False)
+        self.self_definded_map = self_definded_map
 
         self.weightinit = weightinit
 
@@ -163,6 +302,30 @@ class Output_Mapping(nn.Module):
         self.layers = nn.Linear(self.source_class_num, self.target_class_num)
 
 
+    @property
+    def self_definded_map(self):
+        return self._self_definded_map
+
+    @self_definded_map.setter
+    def self_definded_map(self, mapping):
+        self._self_definded_map = mapping
+        self.update_map_index()
+
+    def update_map_index(self):
+        # no-op until every target has its full list of sources
+        mapping = self._self_definded_map
+        if(mapping == None or len(mapping) != self.target_class_num):
+            return
+        lengths = set(len(m) for m in mapping)
+        if(len(lengths) != 1 or 0 in lengths):
+            return
+        index = torch.tensor([[int(s) for s in m] for m in mapping], dtype=torch.long)
+        if(index.shape == self.map_index.shape):
+            self.map_index.copy_(index)
+        else: # a different number of sources per target, a new graph input
+            self.map_index = index.to(self.map_index.device)
+        return
+
     def mapping_done(self):
         done = True
         for i in range(self.target_class_num):
@@ -197,6 +360,7 @@ class Output_Mapping(nn.Module):
         self.freq_is_map = [0 for _ in range(self.source_class_num)]
         preds, labs = self.Frequency_distribution_calculate(model, trainloader, device, wild_dataset)
         self.Frequency_mapping_define(preds, labs)
+        self.update_map_index() # the map was filled in place
         if(self.mapping_done() == True):
             self.freq_check = True
         return
@@ -226,13 +390,7 @@ class Output_Mapping(nn.Module):
                     x = model.train_resize(imgs)
 
                 x = model.input_perturbation(x, img_h, img_w)
-
-                if(model.model_name == "clip_ViT_B_32"):
-                    x = model.model.encode_image(x)
-                elif(model.model_name[0:4] == "clip"):
-                    x = model.CLIP_network(x)
-                else:
-                    x = model.model(x)
+                x = model.Backbone_network(x)
 
             preds.append(x.argmax(dim=-1))
             labs.append(labels)
@@ -246,6 +404,8 @@ class Output_Mapping(nn.Module):
         mapped_matrix = np.zeros(self.source_class_num*self.target_class_num)
         for i in range(len(preds)):
             mapped_matrix[preds[i]*self.target_class_num + labs[i]] += 1
+        # data-parallel run: every rank builds the same map from the global counts
+        mapped_matrix = All_Reduce_Sum(torch.from_numpy(mapped_matrix)).numpy()
         
         i = -1
         while(self.mapping_done() == False and abs(i)<=len(mapped_matrix)):
@@ -315,6 +475,7 @@ class Output_Mapping(nn.Module):
             print("Error: not enough mapping source label")
             return
         else:
+            self.update_map_index()
             self.sem_check = True
             if(show_map == True):
                 print("Target Class:")
@@ -331,10 +492,7 @@ class Output_Mapping(nn.Module):
             print("Error: no mapping exist")
             return
         if self.mapping_method == "self_definded_mapping" or self.mapping_method == "frequency_based_mapping" or self.mapping_method == "semantic_mapping":
-            output = [torch.mean(input[:, self.self_definded_map[x]], 1)
-                      for x in range(len(self.self_definded_map))]
-            output = torch.stack(output)
-            output = torch.transpose(output, 1, 0)
+            output = torch.mean(input[:, self.map_index], 2) # [B, target_class_num, num_source_to_map] -> [B, target_class_num]
         elif self.mapping_method == "fully_connected_layer_mapping":
             output = self.layers(input)
 
@@ -1,5 +1,6 @@
 from auto_vp.utilities import setup_device
-from auto_vp.const import MAP_NUMBER
+from auto_vp.const import MAP_NUMBER, METRIC_REPORT_INTERVAL
+from auto_vp.metrics import Running_Metrics
 
 from functools import partial
 import numpy as np
@@ -22,7 +23,7 @@ def FreqLabelMap(model, trainloader, device, wild_dataset=False):
         #print(model.output_mapping.self_definded_map)
     return
 
-def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, report=True, wild_dataset=False, convergence=False):    
+def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, report=True, wild_dataset=False, convergence=False, report_interval=METRIC_REPORT_INTERVAL):    
     from auto_vp.wrapper import BaseWrapper
     from auto_vp import programs
     from auto_vp.imagenet1000_classname import IMGNET_CLASSNAME
@@ -86,8 +87,8 @@ def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weigh
     total_train_acc = 0
     total_valid_acc = 0
 
-    if(model.model_name[0:4] == "clip"):
-        scaler = GradScaler()
+    policy = model.execution_policy
+    scaler = policy.grad_scaler() # follows the precision policy
     for epoch in range(Epoch):
         # Frequency mapping
         if(model.output_mapping.mapping_method == "frequency_based_mapping" and freqmap_interval != None and epoch!= 0 and epoch%freqmap_interval == 0):
@@ -102,9 +103,7 @@ def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weigh
         # Training
         model.train()
         model.model.eval()
-        train_loss = []
-        train_loss2 = []
-        train_accs = []
+        train_metrics = Running_Metrics(["loss", "loss2", "acc"], device, report_interval)
         pbar = tqdm(trainloader, total=len(trainloader),
                     desc=f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}", ncols=160)
 
@@ -119,7 +118,7 @@ def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weigh
                 labels = labels.to(device)
 
             optimizer.zero_grad()
-            with autocast():
+            with policy.autocast():
                 logits = model(imgs)
                 loss = criterion(logits, labels)
                 if(model.model_name[0:4] == "clip" and convergence == True):
@@ -146,28 +145,27 @@ def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weigh
 
                 model.model.logit_scale.data = torch.clamp(model.model.logit_scale.data, 0, 4.6052)
             else:
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
             if(model.no_trainable_resize == 0):
                 with torch.no_grad():
                     model.train_resize.scale = model.train_resize.scale.clamp_(0.1, 5.0)
 
             acc = (logits.argmax(dim=-1) == labels).float().mean()
-            train_loss.append(loss.item())
-            train_loss2.append(loss2.item())
-            train_accs.append(acc)
+            train_metrics.update(loss, loss2, acc)
 
-            total_train_loss = sum(train_loss) / len(train_loss)
-            total_train_loss2 = sum(train_loss2) / len(train_loss2)
-            total_train_acc = sum(train_accs) / len(train_accs)
-            if(model.no_trainable_resize == 0):
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}, Scale: {model.train_resize.scale.item():.4f}")
-            else:
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}")
+            if(train_metrics.should_report()):
+                total_train_loss, total_train_loss2, total_train_acc = train_metrics.average()
+                if(model.no_trainable_resize == 0):
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}, Scale: {model.train_resize.scale.item():.4f}")
+                else:
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}")
 
             scheduler.step()
           
+        total_train_loss, total_train_loss2, total_train_acc = train_metrics.average()
         if total_train_acc > best_result[2]:
             ss = 1.
             if(model.no_trainable_resize == 0):
@@ -180,15 +178,16 @@ def Training_local(model, trainloader, testloader, class_names, Epoch, lr, weigh
                 scale = model.train_resize.scale.item()
             else:
                 scale = model.init_scale
-            tune.report(accuracy=total_train_acc.cpu().item(), last_scale=scale)
+            tune.report(accuracy=total_train_acc, last_scale=scale)
   
     return best_result
 
-def train_model(config, dataset, data_path, download=True, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False, LRWD=False): 
+def train_model(config, dataset, data_path, download=True, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False, LRWD=False, compile_cache_dir=None): 
     from auto_vp.wrapper import BaseWrapper
     from auto_vp.dataprepare import DataPrepare, Data_Scalability
     from auto_vp.utilities import setup_device
     from auto_vp import programs
+    from auto_vp.execution import Execution_Policy, Precision_Policy
     import auto_vp.datasets as datasets
     from auto_vp.const import CLASS_NUMBER, IMG_SIZE, SOURCE_CLASS_NUM, BATCH_SIZE, NETMEAN, NETSTD, RAY_BATCH_SIZE
 
@@ -205,6 +204,7 @@ def train_model(config, dataset, data_path, download=True, scalibility_rio=1, sc
     scale = config["scale"]
     set_train_resize = config["set_train_resize"]
     pretrained_model = config["pretrained_model"]
+    execution_policy = Execution_Policy(device, precision=Precision_Policy(config.get("backbone_dtype", "fp32"), config.get("text_dtype", "fp32")))
 
     if(LRWD == False):
         if(pretrained_model[0:4] == "clip"):
@@ -261,7 +261,9 @@ def train_model(config, dataset, data_path, download=True, scalibility_rio=1, sc
     out_map = programs.Output_Mapping(source_class_num=source_class_num, target_class_num=class_num,
                                       mapping_method=mapping_method, num_source_to_map=num_map, self_definded_map=mapping, device=device) 
     reprogram_model = BaseWrapper(model_name=pretrained_model, input_perturbation=input_pad,
-                                  output_mapping=out_map, train_resize=resize, init_scale=scale, clip_img_size=img_resize, device=device)
+                                  output_mapping=out_map, train_resize=resize, init_scale=scale, clip_img_size=img_resize, device=device, execution_policy=execution_policy)
+    if(compile_cache_dir != None): # shared on-disk cache, so only the first trial of a configuration pays the warm-up
+        reprogram_model.Compile(cache_dir=compile_cache_dir)
 
     if(pretrained_model[0:4] == "clip"):
         clip_transform = reprogram_model.clip_preprocess
@@ -273,7 +275,7 @@ def train_model(config, dataset, data_path, download=True, scalibility_rio=1, sc
         img_resize, img_resize), mean=NETMEAN[pretrained_model], std=NETSTD[pretrained_model], download=download, batch_size=RAY_BATCH_SIZE[dataset], random_state=random_state, clip_transform=clip_transform)
 
     if(scalibility_rio != 1):
-        trainloader = Data_Scalability(trainset, scalibility_rio, BATCH_SIZE[dataset], mode=scalibility_mode, random_state=random_state, wild_dataset=wild_dataset) 
+        trainloader = Data_Scalability(trainset, scalibility_rio, BATCH_SIZE[dataset], mode=scalibility_mode, random_state=random_state, wild_dataset=wild_dataset, loader=trainloader, dataset_name=dataset) 
 
     # Training
     best_result = Training_local(model=reprogram_model, trainloader=trainloader, testloader=testloader, class_names=class_names, Epoch=5, lr=lr, weight_decay=weight_decay, device=device, freqmap_interval=freqmap_interval, report=True, wild_dataset=wild_dataset, convergence=convergence) 
@@ -314,7 +316,7 @@ def Config_Setting(mapping_type, num_map_range, scale_range):
     return config
 
 
-def Parameter_Tune(dataset, data_path, download=True, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False): # , mapping_method, OutMap_num, scale
+def Parameter_Tune(dataset, data_path, download=True, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False, compile_cache_dir=None, backbone_dtype="fp32", text_dtype="fp32"): # , mapping_method, OutMap_num, scale
     # ref: https://pytorch.org/tutorials/beginner/hyperparameter_tuning_tutorial.html
     # ref: https://docs.ray.io/en/latest/tune/api_docs/suggestion.html#tune-search-alg
     from auto_vp.const import RAY_MAX_EPOCH, RAY_MIN_EPOCH
@@ -337,6 +339,8 @@ def Parameter_Tune(dataset, data_path, download=True, scalibility_rio=1, scalibi
 
     for mapping_type in ["fully_connected_layer_mapping", "semantic_mapping", "frequency_based_mapping"]: 
         config = Config_Setting(mapping_type, num_map_range, scale_range)
+        config["backbone_dtype"] = tune.choice([backbone_dtype]) # every trial runs at the precision of the final training
+        config["text_dtype"] = tune.choice([text_dtype])
 
         scheduler = ASHAScheduler(
             metric="accuracy",
@@ -356,7 +360,7 @@ def Parameter_Tune(dataset, data_path, download=True, scalibility_rio=1, scalibi
             data_path = os.path.join(os.getcwd(), data_path)
         #os.environ["CUDA_VISIBLE_DEVICES"]="0, 1"
         result = tune.run(
-            partial(train_model, dataset=dataset, data_path=data_path,  download=False, scalibility_rio=scalibility_rio, scalibility_mode=scalibility_mode, wild_dataset=wild_dataset, convergence=convergence),
+            partial(train_model, dataset=dataset, data_path=data_path,  download=False, scalibility_rio=scalibility_rio, scalibility_mode=scalibility_mode, wild_dataset=wild_dataset, convergence=convergence, compile_cache_dir=compile_cache_dir),
             config=config,
             resources_per_trial={"cpu": 2, "gpu": 1},
             scheduler=scheduler,
@@ -395,7 +399,7 @@ def Config_Setting_LR_WD(lr_list, weight_decay_list, mapping_method, num_map, fr
     return config
 
 
-def Parameter_Tune_LRWD(dataset, data_path, mapping_method, num_map, freqmap_interval, scale, set_train_resize, pretrained_model, download=False, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False):
+def Parameter_Tune_LRWD(dataset, data_path, mapping_method, num_map, freqmap_interval, scale, set_train_resize, pretrained_model, download=False, scalibility_rio=1, scalibility_mode="equal", wild_dataset=False, convergence=False, compile_cache_dir=None, backbone_dtype="fp32", text_dtype="fp32"):
     from auto_vp.const import RAY_MAX_EPOCH, RAY_MIN_EPOCH
     import os
     if(pretrained_model[0:4] == "clip"):
@@ -413,6 +417,8 @@ def Parameter_Tune_LRWD(dataset, data_path, mapping_method, num_map, freqmap_int
     f.close()
 
     config = Config_Setting_LR_WD(lr_list, weight_decay_list, mapping_method, num_map, freqmap_interval, scale, set_train_resize, pretrained_model)
+    config["backbone_dtype"] = tune.choice([backbone_dtype])
+    config["text_dtype"] = tune.choice([text_dtype])
 
     scheduler = ASHAScheduler(
         metric="accuracy",
@@ -432,7 +438,7 @@ def Parameter_Tune_LRWD(dataset, data_path, mapping_method, num_map, freqmap_int
         data_path = os.path.join(os.getcwd(), data_path)
     #os.environ["CUDA_VISIBLE_DEVICES"]="0, 1"
     result = tune.run(
-        partial(train_model, dataset=dataset, data_path=data_path,  download=False, scalibility_rio=scalibility_rio, scalibility_mode=scalibility_mode, wild_dataset=wild_dataset, convergence=convergence, LRWD=True),
+        partial(train_model, dataset=dataset, data_path=data_path,  download=False, scalibility_rio=scalibility_rio, scalibility_mode=scalibility_mode, wild_dataset=wild_dataset, convergence=convergence, LRWD=True, compile_cache_dir=compile_cache_dir),
         config=config,
         resources_per_trial={"cpu": 2, "gpu": 1},
         scheduler=scheduler,
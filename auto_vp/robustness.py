@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm.auto import tqdm
+
+import auto_vp.datasets as datasets
+from auto_vp.const import CIFAR10_C_CORRUPTIONS, CIFAR10_C_SEVERITY_SIZE
+from auto_vp.loader_tuning import Loader_Kwargs
+
+# CIFAR10-C robustness of one loaded model: each corruption file is memory-mapped and scored in
+# a single pass over its five severities, so all corruptions run in one process and one model load.
+
+CIFAR10_C_SEVERITIES = [1, 2, 3, 4, 5]
+
+def Severity_Accuracy(model, dataset, device, batch_size=128, loader_config=None, desc="Testing"):
+    # accuracy per severity over a CIFAR10_C dataset holding all five levels in order
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, **Loader_Kwargs(loader_config))
+    correct = torch.zeros(len(CIFAR10_C_SEVERITIES), dtype=torch.long, device=device)
+    seen = 0
+    for imgs, labels in tqdm(loader, total=len(loader), desc=desc, ncols=100):
+        imgs = imgs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        with torch.no_grad():
+            hit = (model(imgs).argmax(dim=-1) == labels).long()
+        severity = torch.arange(seen, seen + labels.shape[0], device=device) // CIFAR10_C_SEVERITY_SIZE
+        correct.index_add_(0, severity, hit)
+        seen += labels.shape[0]
+    return (correct.float() / CIFAR10_C_SEVERITY_SIZE).tolist() # the only device->host sync
+
+def Evaluate_CIFAR10_C(model, data_path, device, corruptions=CIFAR10_C_CORRUPTIONS, batch_size=128, loader_config=None, array_native=True, transformer=None):
+    # {corruption: [acc of severity 1, ..., 5]}; array_native needs a BaseWrapper (uint8 batches),
+    # otherwise every image goes through PIL and `transformer`
+    model.eval()
+    results = {}
+    for corruption in corruptions:
+        dataset = datasets.CIFAR10_C(download=False, data_path=data_path, mode=corruption, transformer=transformer, array_native=array_native)
+        results[corruption] = Severity_Accuracy(model, dataset, device, batch_size, loader_config, desc=f"CIFAR10-C {corruption}")
+    return results
+
+def Corruption_Table(results):
+    # per-corruption accuracy (%) by severity, with row and column means
+    lines = ["corruption".ljust(20) + "".join(f"s{s}".rjust(8) for s in CIFAR10_C_SEVERITIES) + "mean".rjust(8)]
+    for corruption, accs in results.items():
+        lines.append(corruption.ljust(20) + "".join(f"{a*100:8.2f}" for a in accs) + f"{np.mean(accs)*100:8.2f}")
+    if(len(results) > 0):
+        means = np.mean(np.array(list(results.values())), axis=0)
+        lines.append("mean".ljust(20) + "".join(f"{a*100:8.2f}" for a in means) + f"{np.mean(means)*100:8.2f}")
+    return "".join(line + "\n" for line in lines)
+
+def Save_Corruption_Table(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("corruption," + ",".join(f"severity_{s}" for s in CIFAR10_C_SEVERITIES) + ",mean\n")
+        for corruption, accs in results.items():
+            f.write(corruption + "," + ",".join(f"{a:.4f}" for a in accs) + f",{np.mean(accs):.4f}\n")
+    return
@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from tqdm.auto import tqdm
+
+# Persistent store of decoded images: every image is decoded and resized once to a canonical
+# STORE_SIZE x STORE_SIZE uint8 RGB array, written to sharded .npy files (read back with mmap),
+# together with the labels and a fingerprint of the source files and the store transform.
+# The run's own transform is still applied on top, to a PIL view of the stored array.
+#   "squash": Resize((S, S)), like the Resize(target_size) of DataPrepare's default transform
+#   "crop":   Resize(S) + CenterCrop(S) (bicubic), the first two steps of CLIP's preprocess,
+#             which then become no-ops for S = 224
+
+STORE_VERSION = 1
+STORE_SIZE = 224
+STORE_SHARD_SIZE = 4096
+
+# file-backed datasets of DataPrepare(); the in-memory ones (CIFAR, SVHN, ABIDE, CIFAR10-C) gain nothing
+TENSOR_STORE_DATASETS = ["GTSRB", "Food101", "OxfordIIITPet", "Melanoma", "Spawrious", "ImageNet1k", "tiny-imagenet-200",
+                         "Flowers102", "DTD", "EuroSAT", "UCF101"]
+
+def Transform_Attribute(dataset):
+    # torchvision / LMDB datasets use `transform`, the datasets in auto_vp/datasets.py `transformer`
+    return "transformer" if hasattr(dataset, "transformer") else "transform"
+
+def Store_Transform(size=STORE_SIZE, mode="squash"):
+    if(mode == "crop"):
+        resize = [torchvision.transforms.Resize(size, interpolation=torchvision.transforms.InterpolationMode.BICUBIC),
+                  torchvision.transforms.CenterCrop(size)]
+    else:
+        resize = [torchvision.transforms.Resize((size, size))]
+    return torchvision.transforms.Compose(
+        [torchvision.transforms.Lambda(lambda x: x.convert("RGB"))] + resize +
+        [torchvision.transforms.Lambda(lambda x: torch.from_numpy(np.asarray(x, dtype=np.uint8).copy()))]) # HWC uint8
+
+def Source_Files(dataset):
+    # the image files (or LMDB file) behind a dataset, for the fingerprint
+    if hasattr(dataset, "db_path"): # LMDBDataset
+        path = dataset.db_path
+        return [os.path.join(path, "data.mdb")] if os.path.isdir(path) else [path]
+    for attr in ["samples", "_samples", "_image_files", "_images", "data"]:
+        items = getattr(dataset, attr, None)
+        if(items is None or len(items) != len(dataset)):
+            continue
+        files = [str(x[0]) if isinstance(x, (tuple, list)) else str(x) for x in items]
+        if all(os.path.isfile(x) for x in files[:10]):
+            return files
+    return None
+
+def Store_Fingerprint(dataset, size=STORE_SIZE, mode="squash"):
+    h = hashlib.sha1()
+    h.update(f"v{STORE_VERSION}|{type(dataset).__name__}|{len(dataset)}|{size}|{mode}".encode())
+    files = Source_Files(dataset)
+    if(files == None):
+        return None
+    for path in files:
+        st = os.stat(path)
+        h.update(f"|{path}|{st.st_size}|{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+def Write_Tensor_Store(dataset, store_path, fingerprint, size=STORE_SIZE, mode="squash", shard_size=STORE_SHARD_SIZE, num_workers=None):
+    # decode once (in parallel workers), then rename, so an interrupted write leaves no half store behind
+    attr = Transform_Attribute(dataset)
+    transform = getattr(dataset, attr)
+    setattr(dataset, attr, Store_Transform(size, mode))
+    if(num_workers == None):
+        num_workers = min(8, os.cpu_count())
+    tmp_path = f"{store_path}.tmp.{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    n = len(dataset)
+    try:
+        loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=num_workers)
+        labels = np.zeros(n, dtype=np.int64)
+        shards = []
+        shard = None
+        i = 0
+        for pb in tqdm(loader, total=len(loader), desc=f"Writing tensor store {os.path.basename(store_path)}", ncols=100):
+            imgs, targets = pb[0].numpy(), pb[1]
+            for j in range(imgs.shape[0]):
+                if(i % shard_size == 0):
+                    if(shard is not None):
+                        shard.flush()
+                    name = f"shard_{len(shards):05d}.npy"
+                    shard = np.lib.format.open_memmap(os.path.join(tmp_path, name), mode="w+", dtype=np.uint8, shape=(min(shard_size, n - i), size, size, 3))
+                    shards.append(name)
+                shard[i % shard_size] = imgs[j]
+                labels[i] = int(targets[j])
+                i += 1
+        if(shard is not None):
+            shard.flush()
+        np.save(os.path.join(tmp_path, "labels.npy"), labels)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"fingerprint": fingerprint, "length": n, "size": size, "mode": mode, "shard_size": shard_size, "shards": shards}, f)
+        if(os.path.exists(store_path)): # a stale store of the same name
+            shutil.rmtree(store_path)
+        os.replace(tmp_path, store_path)
+    finally:
+        setattr(dataset, attr, transform)
+        if(os.path.exists(tmp_path)):
+            shutil.rmtree(tmp_path)
+    return
+
+class Tensor_Store_Dataset(Dataset):
+    # Reads a store written by Write_Tensor_Store(). Shards are memory-mapped lazily in each
+    # worker; an image is a view into the page cache until the transform copies it.
+    def __init__(self, store_path, transform=None, classes=None):
+        self.store_path = store_path
+        with open(os.path.join(store_path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.targets = np.load(os.path.join(store_path, "labels.npy"))
+        self.transform = transform
+        self.shards = None
+        if(classes != None):
+            self.classes = classes
+
+    def __len__(self):
+        return self.meta["length"]
+
+    def _shard(self, k):
+        if(self.shards == None):
+            self.shards = [None for _ in self.meta["shards"]]
+        if(self.shards[k] is None):
+            self.shards[k] = np.load(os.path.join(self.store_path, self.meta["shards"][k]), mmap_mode="r")
+        return self.shards[k]
+
+    def __getstate__(self):
+        # workers open their own maps
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __getitem__(self, idx):
+        shard_size = self.meta["shard_size"]
+        img = self._shard(idx // shard_size)[idx % shard_size]
+        img = Image.fromarray(img)
+        if(self.transform != None):
+            img = self.transform(img)
+        return img, int(self.targets[idx])
+
+def Stored_Dataset(dataset, store_dir, name, mode="squash", size=STORE_SIZE):
+    # the stored version of `dataset` (written on first use), or `dataset` itself when its source files are unknown
+    fingerprint = Store_Fingerprint(dataset, size, mode)
+    if(fingerprint == None):
+        print(f"Warning: no source files found for {name}, tensor store not used")
+        return dataset
+    store_path = os.path.join(store_dir, f"{name}_{mode}{size}_{fingerprint[:16]}")
+    meta_path = os.path.join(store_path, "meta.json")
+    valid = False
+    if(os.path.exists(meta_path)):
+        with open(meta_path) as f:
+            valid = (json.load(f).get("fingerprint") == fingerprint)
+    if(valid == False):
+        os.makedirs(store_dir, exist_ok=True)
+        Write_Tensor_Store(dataset, store_path, fingerprint, size, mode)
+    print(f"Tensor store: {store_path}")
+    return Tensor_Store_Dataset(store_path, getattr(dataset, Transform_Attribute(dataset)), getattr(dataset, "classes", None))
@@ -1,8 +1,16 @@
 from auto_vp.wrapper import BaseWrapper
 from auto_vp import programs
-from auto_vp.const import CLASS_NUMBER, IMG_SIZE, SOURCE_CLASS_NUM, BATCH_SIZE, NETMEAN, NETSTD, DEFAULT_TEMPLATE, ENSEMBLE_TEMPLATES
+from auto_vp.const import CLASS_NUMBER, IMG_SIZE, SOURCE_CLASS_NUM, BATCH_SIZE, NETMEAN, NETSTD, DEFAULT_TEMPLATE, ENSEMBLE_TEMPLATES, METRIC_REPORT_INTERVAL
 from auto_vp.imagenet1000_classname import IMGNET_CLASSNAME
 from auto_vp.utilities import Trainable_Parameter_Size
+from auto_vp.feature_cache import Cached_Feature_Loader
+from auto_vp.execution import Execution_Policy, Float32_Head
+from auto_vp.profiler import Trace_Window
+from auto_vp.loader_tuning import Loader_Stall_Meter
+from auto_vp.metrics import Running_Metrics
+from auto_vp.checkpoint import Checkpoint_Writer, RNG_State, Set_RNG_State, Resumable_Loader
+from auto_vp.validation import Validation_Policy, Snapshot_Model, Early_Stopping
+from auto_vp.distributed import Is_Distributed, Is_Main_Process, Distributed_Loader, Broadcast_Model, All_Reduce_Gradients, Broadcast_Object
 
 import torch
 import torch.nn as nn
@@ -12,9 +20,9 @@ from sklearn.model_selection import KFold
 from torch.utils.data import ConcatDataset
 import matplotlib.pyplot as plt
 from torch.nn.parameter import Parameter
-from torch.cuda.amp import autocast, GradScaler
 import clip
 import os
+import copy
 from datetime import datetime
 
 from .plotter import Plotter, plotter
@@ -25,7 +33,131 @@ def FreqLabelMap(model, trainloader, device,  wild_dataset=False):
         #print(model.output_mapping.self_definded_map)
     return
 
-def Training(dataset, fname, model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, wild_dataset=False):
+def Checkpoint_State(model, optimizer):
+    state_dict = {
+        "pretrained_model": model.model_name,
+        "resize_dict": model.train_resize.state_dict(),
+        "perturb_dict": model.input_perturbation.state_dict(),
+        "outmap_dict": model.output_mapping.state_dict(),
+        "output_mapping": model.output_mapping.self_definded_map,
+        "mapping_method": model.output_mapping.mapping_method,
+        "freq_check": model.output_mapping.freq_check,
+        "optimizer_dict": optimizer.state_dict(),
+        "init_scale" : model.init_scale
+    }
+    return state_dict
+
+def Resume_State(model, optimizer, scheduler, scaler, epoch, step, best_result, train_metrics, seed, extra=None):
+    # everything needed to continue a run from (epoch, step): step batches of epoch are already done
+    state_dict = Checkpoint_State(model, optimizer)
+    state_dict.update({
+        "scheduler_dict": scheduler.state_dict(),
+        "scaler_dict": scaler.state_dict() if scaler != None else None,
+        "rng_state": RNG_State(),
+        "epoch": epoch,
+        "step": step,
+        "seed": seed,
+        "best_result": best_result,
+        "metrics_dict": train_metrics.state_dict() if train_metrics != None else None,
+    })
+    if(extra != None):
+        state_dict.update(extra)
+    return state_dict
+
+def Load_Resume_State(resume_path, model, optimizer, scheduler, scaler=None):
+    state_dict = torch.load(resume_path, map_location="cpu")
+    if(state_dict["pretrained_model"] != model.model_name):
+        raise ValueError(f"Resume checkpoint was trained on {state_dict['pretrained_model']}, not {model.model_name}")
+    model.train_resize.load_state_dict(state_dict["resize_dict"])
+    model.input_perturbation.load_state_dict(state_dict["perturb_dict"])
+    model.output_mapping.load_state_dict(state_dict["outmap_dict"])
+    model.output_mapping.self_definded_map = state_dict["output_mapping"]
+    model.output_mapping.freq_check = state_dict["freq_check"]
+    optimizer.load_state_dict(state_dict["optimizer_dict"])
+    scheduler.load_state_dict(state_dict["scheduler_dict"])
+    if(scaler != None and state_dict["scaler_dict"] != None):
+        scaler.load_state_dict(state_dict["scaler_dict"])
+    print(f"Resume from {resume_path}: epoch {state_dict['epoch']+1}, step {state_dict['step']}")
+    return state_dict
+
+def Train_Loader(trainloader, resumable, seed):
+    if(resumable == True):
+        return Resumable_Loader(trainloader, seed) # also shards over the ranks of a data-parallel run
+    if(Is_Distributed() == True):
+        return Distributed_Loader(trainloader, shuffle=True, seed=seed)
+    return trainloader
+
+def Record_Validation(f, ckpt_writer, save_path, Epoch, best_result, result, early_stopping=None):
+    epoch, total_valid_loss, total_valid_acc, _, info = result
+
+    # update log
+    f.write(f"Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
+    plotter.log(epoch, {f"evaluate_acc": total_valid_acc, f"evaluate_loss": total_valid_loss})
+
+    if (total_valid_acc > best_result[2] or epoch == Epoch - 1):
+        ss = info["scale"]
+        # save model
+        print("Save! Acc: ", total_valid_acc, ", Scale: ", ss, ", Epoch: ", epoch+1)
+        f.write(f"Save! Acc: {total_valid_acc}, Scale: {ss}, Epoch: {epoch+1}\n")
+        if(total_valid_acc > best_result[2]):
+            best_result = [epoch, info["train_acc"], total_valid_acc, ss]
+            ckpt_writer.save(info["state_dict"], os.path.join(save_path, "result_best.pth"))
+        if(epoch == Epoch - 1):
+            ckpt_writer.save(info["state_dict"], os.path.join(save_path, "result_last.pth"))
+
+    if(early_stopping != None):
+        early_stopping.update(epoch, total_valid_acc)
+    return best_result
+
+def Early_Stop(f, model, optimizer, ckpt_writer, save_path, epoch, best_result, early_stopping):
+    # plateau: keep the current state as result_last.pth and record why and what was saved
+    ckpt_writer.save(Checkpoint_State(model, optimizer), os.path.join(save_path, "result_last.pth"))
+    print(f"Early stop at Epoch {epoch+1}: {early_stopping.stop_reason}")
+    f.write(f"Early stop at Epoch {epoch+1}: {early_stopping.stop_reason}\n")
+    f.write(f"Saved result_best.pth (Epoch {best_result[0]+1}), result_last.pth (Epoch {epoch+1})\n")
+    return
+
+def Stage_Profiling(model, profile_stages=False, trace_dir=None, trace_start=10, trace_steps=5):
+    # per-stage times / allocations in the log every epoch, and a Chrome trace of steps [trace_start, trace_start+trace_steps)
+    if(profile_stages == True):
+        model.Profile(True)
+    trace = None
+    if(trace_dir != None):
+        trace = Trace_Window(trace_dir, trace_start, trace_steps)
+    return model.stage_profiler, trace
+
+def Stage_Report(f, profiler, epoch, loader_meter=None):
+    if(loader_meter != None): # time blocked on the train loader vs. time in the step
+        f.write(loader_meter.report(f"Epoch {epoch+1}"))
+        loader_meter.reset()
+    if(profiler.enabled == True):
+        f.write(profiler.report(f"Epoch {epoch+1}"))
+        profiler.reset()
+    return
+
+def Finish_Validation(f, model, validation, ckpt_writer, save_path, Epoch, best_result, early_stopping=None):
+    # collect the pending background results, then score the selected checkpoint on the full test set
+    for result in validation.finish():
+        best_result = Record_Validation(f, ckpt_writer, save_path, Epoch, best_result, result, early_stopping)
+
+    if(validation.needs_full_test() == True and best_result[0] >= 0):
+        ckpt_writer.flush()
+        state_dict = None
+        if(Is_Main_Process() == True):
+            state_dict = torch.load(os.path.join(save_path, "result_best.pth"), map_location="cpu")
+        state_dict = Broadcast_Object(state_dict)
+        best_model = Snapshot_Model(model)
+        best_model.train_resize.load_state_dict(state_dict["resize_dict"])
+        best_model.input_perturbation.load_state_dict(state_dict["perturb_dict"])
+        best_model.output_mapping.load_state_dict(state_dict["outmap_dict"])
+        best_model.output_mapping.self_definded_map = state_dict["output_mapping"]
+        best_model.output_mapping.freq_check = state_dict["freq_check"]
+        total_test_loss, total_test_acc = validation.full_test(best_model)
+        print(f"Best checkpoint (Epoch {best_result[0]+1}) full test ACC: {total_test_acc*100:.2f}%")
+        f.write(f"Best checkpoint (Epoch {best_result[0]+1}) Full Testing, ACC: {total_test_acc*100:.2f}%, Loss: {total_test_loss:.4f}\n")
+    return best_result
+
+def Training(dataset, fname, model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL, resume_path=None, resume_interval=None, seed=0, validation_size=None, background_eval=False, patience=None, min_delta=0., profile_stages=False, trace_dir=None, trace_start=10, trace_steps=5):
     if(model.output_mapping.mapping_method == "semantic_mapping"):
         source_labels = list(IMGNET_CLASSNAME.values())
         model.output_mapping.Semantic_mapping(source_labels, class_names)
@@ -41,27 +173,60 @@ def Training(dataset, fname, model, trainloader, testloader, class_names, Epoch,
         if param.requires_grad == True:
             print("\t",name)
 
+    policy = model.execution_policy
+    scaler = policy.grad_scaler() # follows the precision policy
+
+    # Resumable run: the data order is a function of (seed, epoch), so it can restart mid-epoch
+    resumable = (resume_path != None or (resume_interval != None and resume_interval > 0))
+    trainloader = Train_Loader(trainloader, resumable, seed)
+    start_epoch, start_step, resume_state = 0, 0, None
+    if(resume_path != None):
+        resume_state = Load_Resume_State(resume_path, model, optimizer, scheduler, scaler)
+        start_epoch, start_step, seed = resume_state["epoch"], resume_state["step"], resume_state["seed"]
+        trainloader.sampler.seed = seed
+    Broadcast_Model(model) # data-parallel run: every rank starts from rank 0's prompt and mapping
+
     # Frequency mapping
-    FreqLabelMap(model, trainloader, device)
+    if(resume_state == None):
+        FreqLabelMap(model, trainloader, device)
     save_path = f"results_auto_vp/_cnn_{dataset}"
     os.makedirs(save_path, exist_ok=True)
+    resume_file = os.path.join(save_path, "resume.pth")
 
-    f = open(fname, "a")
+    f = open(fname if Is_Main_Process() else os.devnull, "a") # only rank 0 writes
     best_result = [-1, 0., 0., 1.] # epoch, traing acc, validation acc, resize scale
+    if(resume_state != None):
+        best_result = resume_state["best_result"]
     total_train_acc = 0
     total_valid_acc = 0
     scale_grad = []
-    for epoch in range(Epoch):
-        # Frequency mapping
-        if(freqmap_interval != None and epoch!= 0 and epoch%freqmap_interval == 0):
+    ckpt_writer = Checkpoint_Writer(enabled=Is_Main_Process())
+    validation = Validation_Policy(testloader, criterion, device, validation_size, background_eval, wild_dataset, report_interval, random_state=seed)
+    early_stopping = Early_Stopping(patience, min_delta)
+    if(resume_state != None and "early_stopping" in resume_state):
+        early_stopping.load_state_dict(resume_state["early_stopping"])
+    profiler, trace = Stage_Profiling(model, profile_stages, trace_dir, trace_start, trace_steps)
+    loader_meter = Loader_Stall_Meter()
+    for epoch in range(start_epoch, Epoch):
+        step = start_step if epoch == start_epoch else 0
+        if(resumable == True):
+            trainloader.sampler.set_epoch(epoch, start=step*trainloader.batch_size)
+        elif(Is_Distributed() == True):
+            trainloader.sampler.set_epoch(epoch)
+        # Frequency mapping (a mid-epoch resume already has this epoch's map)
+        if(freqmap_interval != None and epoch!= 0 and epoch%freqmap_interval == 0 and step == 0):
             FreqLabelMap(model, trainloader, device)
 
         # Training
         model.train()
         model.model.eval()
-        train_loss = []
-        train_accs = []
-        pbar = tqdm(trainloader, total=len(trainloader),
+        train_metrics = Running_Metrics(["loss", "acc"], device, report_interval)
+        if(step > 0):
+            train_metrics.load_state_dict(resume_state["metrics_dict"])
+        if(resume_state != None):
+            Set_RNG_State(resume_state["rng_state"])
+            resume_state = None
+        pbar = tqdm(loader_meter.iterate(trainloader), total=len(trainloader),
                     desc=f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}", ncols=120)
         for pb in pbar:
             if(wild_dataset == True):
@@ -74,103 +239,79 @@ def Training(dataset, fname, model, trainloader, testloader, class_names, Epoch,
                 labels = labels.to(device)
 
             optimizer.zero_grad()
-            with autocast():
+            with policy.autocast():
                 logits = model(imgs)
                 loss = criterion(logits, labels)
-            loss.backward()
+            with profiler.backward():
+                scaler.scale(loss).backward()
+            All_Reduce_Gradients(model)
 
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
             if(model.no_trainable_resize == 0):
                 with torch.no_grad():
                     model.train_resize.scale = model.train_resize.scale.clamp_(0.1, 5.0)
 
             acc = (logits.argmax(dim=-1) == labels).float().mean()
-            train_loss.append(loss.item())
-            train_accs.append(acc)
+            train_metrics.update(loss, acc)
+            step += 1
+            if(trace != None):
+                trace.step()
 
-            total_train_loss = sum(train_loss) / len(train_loss)
-            total_train_acc = sum(train_accs) / len(train_accs)
-            plotter.log(epoch, {f"train_tm_acc": total_train_loss})
-            plotter.log(epoch, {f"train_tm_loss": total_train_acc})
+            if(train_metrics.should_report()):
+                total_train_loss, total_train_acc = train_metrics.average()
+                if(model.no_trainable_resize == 0):
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Scale: {model.train_resize.scale.item():.4f}")
+                else:
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
 
-            if(model.no_trainable_resize == 0):
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Scale: {model.train_resize.scale.item():.4f}")
-            else:
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
+            if(resume_interval != None and resume_interval > 0 and step%resume_interval == 0):
+                ckpt_writer.save(Resume_State(model, optimizer, scheduler, scaler, epoch, step, best_result, train_metrics, seed, {"early_stopping": early_stopping.state_dict()}), resume_file)
         
+        train_metrics.all_reduce()
+        total_train_loss, total_train_acc = train_metrics.average()
+        plotter.log(epoch, {f"train_tm_acc": total_train_loss})
+        plotter.log(epoch, {f"train_tm_loss": total_train_acc})
+
         # update log
         if(model.no_trainable_resize == 0):
             f.write(f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Scale: {model.train_resize.scale.item():.4f}\n")
         else:
             f.write(f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}\n")
+        Stage_Report(f, profiler, epoch, loader_meter)
         scheduler.step()
 
     
         if(epoch%2 ==0 or epoch == Epoch-1): 
-            # Validation
-            model.eval()
-            valid_loss = []
-            valid_accs = []
-            pbar = tqdm(testloader, total=len(
-                testloader), desc=f"Epoch {epoch+1} Testing", ncols=120)
-            for pb in pbar:
-                if(wild_dataset == True):
-                    imgs, labels, _ = pb
-                else:
-                    imgs, labels = pb
-                    
-                if imgs.get_device() == -1:
-                    imgs = imgs.to(device)
-                    labels = labels.to(device)
-                with torch.no_grad():
-                    logits = model(imgs)
-                    loss = criterion(logits, labels)
-                acc = (logits.argmax(dim=-1) == labels).float().mean()
-
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-
-                total_valid_loss = sum(valid_loss) / len(valid_loss)
-                total_valid_acc = sum(valid_accs) / len(valid_accs)
-                pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
-
-            # update log
-            f.write(f"Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
-            plotter.log(epoch, {f"evaluate_acc": acc, f"evaluate_loss": loss})
-
-            if (total_valid_acc > best_result[2] or epoch == Epoch - 1):
-                ss = None
-                if(model.no_trainable_resize == 0):
-                    ss = model.train_resize.scale.item()
-                # save model
-                print("Save! Acc: ", total_valid_acc, ", Scale: ", ss)
-                f.write(f"Save! Acc: {total_valid_acc}, Scale: {ss}\n")
-                state_dict = {
-                    "pretrained_model": model.model_name,
-                    "resize_dict": model.train_resize.state_dict(),
-                    "perturb_dict": model.input_perturbation.state_dict(),
-                    "outmap_dict": model.output_mapping.state_dict(),
-                    "output_mapping": model.output_mapping.self_definded_map,
-                    "mapping_method": model.output_mapping.mapping_method,
-                    "freq_check": model.output_mapping.freq_check,
-                    "optimizer_dict": optimizer.state_dict(),
-                    "init_scale" : model.init_scale
-                }
-                if(total_valid_acc > best_result[2]):
-                    best_result = [epoch, total_train_acc, total_valid_acc, ss]
-                    torch.save(state_dict, os.path.join(save_path, "result_best.pth"))
-                if(epoch == Epoch - 1):
-                    torch.save(state_dict, os.path.join(save_path, "result_last.pth"))
-
+            # Validation (selection subset, possibly scored in the background)
+            ss = None
+            if(model.no_trainable_resize == 0):
+                ss = model.train_resize.scale.item()
+            info = {"train_acc": total_train_acc, "scale": ss, "state_dict": Checkpoint_State(model, optimizer)}
+            for result in validation.validate(model, epoch, info):
+                best_result = Record_Validation(f, ckpt_writer, save_path, Epoch, best_result, result, early_stopping)
+
+        if(resumable == True):
+            ckpt_writer.save(Resume_State(model, optimizer, scheduler, scaler, epoch+1, 0, best_result, None, seed, {"early_stopping": early_stopping.state_dict()}), resume_file)
+
+        if(early_stopping.should_stop()):
+            Early_Stop(f, model, optimizer, ckpt_writer, save_path, epoch, best_result, early_stopping)
+            break
+
+    if(trace != None):
+        trace.stop()
+    best_result = Finish_Validation(f, model, validation, ckpt_writer, save_path, Epoch, best_result, early_stopping)
+    ckpt_writer.close()
     f.close()
 
-    plotter.finish(save_path)
+    if(Is_Main_Process() == True):
+        plotter.finish(save_path)
 
     return best_result
 
 # https://github.com/openai/CLIP
-def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, wild_dataset=False, convergence=False):
+def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, Epoch, lr, weight_decay, device, freqmap_interval=None, wild_dataset=False, convergence=False, report_interval=METRIC_REPORT_INTERVAL, resume_path=None, resume_interval=None, seed=0, validation_size=None, background_eval=False, patience=None, min_delta=0., profile_stages=False, trace_dir=None, trace_start=10, trace_steps=5):
     if(model.output_mapping.mapping_method == "semantic_mapping"):
         print("CLIP not support semantic mapping!")
         return
@@ -182,6 +323,10 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
     # loss
     criterion = nn.CrossEntropyLoss()
     
+    # Resumable run: the data order is a function of (seed, epoch), so it can restart mid-epoch
+    resumable = (resume_path != None or (resume_interval != None and resume_interval > 0))
+    trainloader = Train_Loader(trainloader, resumable, seed)
+
     # Optimizer
     optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=weight_decay)
     t_max = Epoch * len(trainloader)
@@ -192,10 +337,25 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
         if param.requires_grad == True:
             print("\t",name)
 
+    policy = model.execution_policy
+    scaler = policy.grad_scaler()
+
+    start_epoch, start_step, resume_state = 0, 0, None
+    if(resume_path != None):
+        resume_state = Load_Resume_State(resume_path, model, optimizer, scheduler, scaler)
+        start_epoch, start_step, seed = resume_state["epoch"], resume_state["step"], resume_state["seed"]
+        trainloader.sampler.seed = seed
+    Broadcast_Model(model) # data-parallel run: every rank starts from rank 0's prompt and mapping
+
     # Frequency mapping
-    FreqLabelMap(model, trainloader, device, wild_dataset=wild_dataset)
+    if(resume_state == None):
+        FreqLabelMap(model, trainloader, device, wild_dataset=wild_dataset)
+        init_map = copy.deepcopy(model.output_mapping.self_definded_map)
+    else:
+        init_map = resume_state["init_map"]
     save_path = f"results_auto_vp/_clip_vp_{dataset}"
     os.makedirs(save_path, exist_ok=True)
+    resume_file = os.path.join(save_path, "resume.pth")
 
     # Convergence loss
     MseLoss = nn.MSELoss(reduction='sum')
@@ -211,9 +371,11 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
     # Convergence loss: init condition for frequency mapping
     if(model.output_mapping.mapping_method == "frequency_based_mapping" and freqmap_interval != None):
         freq_conv_loss_update = 1
+        if(resume_state != None):
+            freq_conv_loss_update = resume_state["freq_conv_loss_update"]
         init_freq_mapping = torch.zeros([model.output_mapping.target_class_num, model.output_mapping.target_class_num*81]).to(device)
         for i in range(model.output_mapping.target_class_num):
-            for j in model.output_mapping.self_definded_map[i]:
+            for j in init_map[i]:
                 init_freq_mapping[i, j] = 1.0
         #print("init_freq_mapping: ", init_freq_mapping)
 
@@ -223,16 +385,35 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
                 current_freq_mapping[i, j] = 1.0
     
     
-    f = open(fname, "a")
+    f = open(fname if Is_Main_Process() else os.devnull, "a") # only rank 0 writes
     best_result = [-1, 0., 0., 1.] # epoch, traing acc, validation acc, resize scale
+    if(resume_state != None):
+        best_result = resume_state["best_result"]
     total_train_acc = 0
     total_valid_acc = 0
     scale_grad = []
-
-    scaler = GradScaler()
-    for epoch in range(Epoch):
-        # Frequency mapping
-        if(model.output_mapping.mapping_method == "frequency_based_mapping" and freqmap_interval != None and epoch!= 0 and epoch%freqmap_interval == 0):
+    ckpt_writer = Checkpoint_Writer(enabled=Is_Main_Process())
+    validation = Validation_Policy(testloader, criterion, device, validation_size, background_eval, wild_dataset, report_interval, random_state=seed)
+    early_stopping = Early_Stopping(patience, min_delta)
+    if(resume_state != None and "early_stopping" in resume_state):
+        early_stopping.load_state_dict(resume_state["early_stopping"])
+
+    def Resume_Extra():
+        extra = {"init_map": init_map, "early_stopping": early_stopping.state_dict()}
+        if(model.output_mapping.mapping_method == "frequency_based_mapping" and freqmap_interval != None):
+            extra["freq_conv_loss_update"] = freq_conv_loss_update
+        return extra
+
+    profiler, trace = Stage_Profiling(model, profile_stages, trace_dir, trace_start, trace_steps)
+    loader_meter = Loader_Stall_Meter()
+    for epoch in range(start_epoch, Epoch):
+        step = start_step if epoch == start_epoch else 0
+        if(resumable == True):
+            trainloader.sampler.set_epoch(epoch, start=step*trainloader.batch_size)
+        elif(Is_Distributed() == True):
+            trainloader.sampler.set_epoch(epoch)
+        # Frequency mapping (a mid-epoch resume already has this epoch's map)
+        if(model.output_mapping.mapping_method == "frequency_based_mapping" and freqmap_interval != None and epoch!= 0 and epoch%freqmap_interval == 0 and step == 0):
             FreqLabelMap(model, trainloader, device, wild_dataset=wild_dataset)
             # print([model.text_content[x].item() for x in model.output_mapping.self_definded_map])
             freq_conv_loss_update = 1
@@ -244,10 +425,13 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
         # Training
         model.train()
         model.model.eval()
-        train_loss = []
-        train_loss2 = []
-        train_accs = []
-        pbar = tqdm(trainloader, total=len(trainloader),
+        train_metrics = Running_Metrics(["loss", "loss2", "acc"], device, report_interval)
+        if(step > 0):
+            train_metrics.load_state_dict(resume_state["metrics_dict"])
+        if(resume_state != None):
+            Set_RNG_State(resume_state["rng_state"])
+            resume_state = None
+        pbar = tqdm(loader_meter.iterate(trainloader), total=len(trainloader),
                     desc=f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}", ncols=160)
         for pb in pbar:
             if(wild_dataset == True):
@@ -260,7 +444,7 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
                 labels = labels.to(device)
             
             optimizer.zero_grad()
-            with autocast():
+            with policy.autocast():
                 logits = model(imgs)
                 loss = criterion(logits, labels)
                 if(convergence == True):
@@ -272,7 +456,9 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
                         loss += loss2
                         freq_conv_loss_update = 0
             
-            scaler.scale(loss).backward()
+            with profiler.backward():
+                scaler.scale(loss).backward()
+            All_Reduce_Gradients(model)
 
             # clip scale's gradient
             if(model.no_trainable_resize == 0): 
@@ -293,91 +479,62 @@ def CLIP_Training(dataset, fname, model, trainloader, testloader, class_names, E
                     model.train_resize.scale = model.train_resize.scale.clamp_(0.1, 5.0)
 
             acc = (logits.argmax(dim=-1) == labels).float().mean()
-            train_loss.append(loss.item())
-            train_loss2.append(loss2.item())
-            train_accs.append(acc)
+            train_metrics.update(loss, loss2, acc)
+            step += 1
+            if(trace != None):
+                trace.step()
 
-            total_train_loss = sum(train_loss) / len(train_loss)
-            total_train_loss2 = sum(train_loss2) / len(train_loss2)
-            total_train_acc = sum(train_accs) / len(train_accs)
-            if(model.no_trainable_resize == 0):
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}, Scale: {model.train_resize.scale.item():.4f}")
-            else:
-                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}")
+            if(train_metrics.should_report()):
+                total_train_loss, total_train_loss2, total_train_acc = train_metrics.average()
+                if(model.no_trainable_resize == 0):
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}, Scale: {model.train_resize.scale.item():.4f}")
+                else:
+                    pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}")
             scheduler.step()
 
-            plotter.log(epoch, {f"train_tm_acc": total_train_loss})
-            plotter.log(epoch, {f"train_tm_loss": total_train_acc})
+            if(resume_interval != None and resume_interval > 0 and step%resume_interval == 0):
+                ckpt_writer.save(Resume_State(model, optimizer, scheduler, scaler, epoch, step, best_result, train_metrics, seed, Resume_Extra()), resume_file)
+
+        train_metrics.all_reduce()
+        total_train_loss, total_train_loss2, total_train_acc = train_metrics.average()
+        plotter.log(epoch, {f"train_tm_acc": total_train_loss})
+        plotter.log(epoch, {f"train_tm_loss": total_train_acc})
 
         # update log
         if(model.no_trainable_resize == 0):
             f.write(f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}, Scale: {model.train_resize.scale.item():.4f}\n")
         else:
             f.write(f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}, Loss2: {total_train_loss2:.4f}\n")
+        Stage_Report(f, profiler, epoch, loader_meter)
         
         if(epoch%1 ==0 or epoch == Epoch-1): 
-            # Validation
-            model.eval()
-            valid_loss = []
-            valid_accs = []
-            pbar = tqdm(testloader, total=len(
-                testloader), desc=f"Epoch {epoch+1} Testing", ncols=160)
-            for pb in pbar:
-                if(wild_dataset == True):
-                    imgs, labels, _ = pb
-                else:
-                    imgs, labels = pb
-
-                if imgs.get_device() == -1:
-                    imgs = imgs.to(device)
-                    labels = labels.to(device)
-
-                with torch.no_grad():
-                    logits = model(imgs)
-                    loss = criterion(logits, labels)
-                acc = (logits.argmax(dim=-1) == labels).float().mean()
-
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-
-                total_valid_loss = sum(valid_loss) / len(valid_loss)
-                total_valid_acc = sum(valid_accs) / len(valid_accs)
-                pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
-
-            # update log
-            f.write(f"Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
-            plotter.log(epoch, {f"evaluate_acc": acc, f"evaluate_loss": loss})
-
-            if (total_valid_acc > best_result[2] or epoch == Epoch - 1):
-                ss = None
-                if(model.no_trainable_resize == 0):
-                    ss = model.train_resize.scale.item()
-                # save model
-                print("Save! Acc: ", total_valid_acc, ", Scale: ", ss)
-                f.write(f"Save! Acc: {total_valid_acc}, Scale: {ss}\n")
-                state_dict = {
-                    "pretrained_model": model.model_name,
-                    "resize_dict": model.train_resize.state_dict(),
-                    "perturb_dict": model.input_perturbation.state_dict(),
-                    "outmap_dict": model.output_mapping.state_dict(),
-                    "output_mapping": model.output_mapping.self_definded_map,
-                    "mapping_method": model.output_mapping.mapping_method,
-                    "freq_check": model.output_mapping.freq_check,
-                    "optimizer_dict": optimizer.state_dict(),
-                    "init_scale" : model.init_scale
-                }
-                if(total_valid_acc > best_result[2]):
-                    best_result = [epoch, total_train_acc, total_valid_acc, ss]
-                    torch.save(state_dict, os.path.join(save_path, "result_best.pth"))
-                if(epoch == Epoch - 1):
-                    torch.save(state_dict, os.path.join(save_path, "result_last.pth"))
+            # Validation (selection subset, possibly scored in the background)
+            ss = None
+            if(model.no_trainable_resize == 0):
+                ss = model.train_resize.scale.item()
+            info = {"train_acc": total_train_acc, "scale": ss, "state_dict": Checkpoint_State(model, optimizer)}
+            for result in validation.validate(model, epoch, info):
+                best_result = Record_Validation(f, ckpt_writer, save_path, Epoch, best_result, result, early_stopping)
+
+        if(resumable == True):
+            ckpt_writer.save(Resume_State(model, optimizer, scheduler, scaler, epoch+1, 0, best_result, None, seed, Resume_Extra()), resume_file)
+
+        if(early_stopping.should_stop()):
+            Early_Stop(f, model, optimizer, ckpt_writer, save_path, epoch, best_result, early_stopping)
+            break
+
+    if(trace != None):
+        trace.stop()
+    best_result = Finish_Validation(f, model, validation, ckpt_writer, save_path, Epoch, best_result, early_stopping)
+    ckpt_writer.close()
     f.close()
 
-    plotter.finish(save_path)
+    if(Is_Main_Process() == True):
+        plotter.finish(save_path)
 
     return best_result
 
-def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=False, wild_dataset=False):   
+def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=False, wild_dataset=False, save_model=None, report_interval=METRIC_REPORT_INTERVAL, execution_policy=None):   
     # Update stretagy
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=lr) #, weight_decay=1e-5) 
@@ -387,13 +544,13 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
     total_valid_acc = 0
     best_result = [-1, 0., 0.] # epoch, traing acc, validation acc
     f = open(fname, "w+")
-    scaler = GradScaler()
+    policy = execution_policy if execution_policy != None else Execution_Policy(device)
+    scaler = policy.grad_scaler()
     for epoch in range(Epoch):
         # Training
         if(FF == True): # full finetune all the layers
             model.train()
-        train_loss = []
-        train_accs = []
+        train_metrics = Running_Metrics(["loss", "acc"], device, report_interval)
         pbar = tqdm(trainloader, total=len(trainloader),
                     desc=f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}", ncols=100)
         for pb in pbar:
@@ -403,7 +560,7 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
                 imgs, labels = pb
 
             optimizer.zero_grad()
-            with autocast():
+            with policy.autocast():
                 logits = model(imgs.to(device))
                 loss = criterion(logits, labels.to(device))
 
@@ -412,12 +569,12 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
             scaler.update()
 
             acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
-            train_loss.append(loss.item())
-            train_accs.append(acc)
+            train_metrics.update(loss, acc)
 
-            total_train_loss = sum(train_loss) / len(train_loss)
-            total_train_acc = sum(train_accs) / len(train_accs)
-            pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
+            if(train_metrics.should_report()):
+                total_train_loss, total_train_acc = train_metrics.average()
+                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
+        total_train_loss, total_train_acc = train_metrics.average()
         # update log
         f.write(f"Epoch {epoch+1} Training, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}\n")
 
@@ -426,8 +583,7 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
         if(epoch%10 ==0 or epoch == Epoch-1): 
             # Validation
             model.eval()
-            valid_loss = []
-            valid_accs = []
+            valid_metrics = Running_Metrics(["loss", "acc"], device, report_interval)
             pbar = tqdm(testloader, total=len(
                 testloader), desc=f"Epoch {epoch+1} Testing", ncols=100)
             for pb in pbar:
@@ -440,13 +596,12 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
                     logits = model(imgs.to(device))
                     loss = criterion(logits, labels.to(device))
                 acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
+                valid_metrics.update(loss, acc)
 
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-
-                total_valid_loss = sum(valid_loss) / len(valid_loss)
-                total_valid_acc = sum(valid_accs) / len(valid_accs)
-                pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
+                if(valid_metrics.should_report()):
+                    total_valid_loss, total_valid_acc = valid_metrics.average()
+                    pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
+            total_valid_loss, total_valid_acc = valid_metrics.average()
             # update log
             f.write(f"Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
 
@@ -455,13 +610,15 @@ def Training_pure(fname, model, trainloader, testloader, Epoch, lr, device, FF=F
     
     # save model
     print("Save! Acc: ", total_valid_acc)
-    state_dict = {"model": model}
+    if(save_model == None): # save_model: full model when only the head is trained on cached features
+        save_model = model
+    state_dict = {"model": save_model}
     torch.save(state_dict, fname.split(".")[0]+ ".pth")
     
     f.close()
     return best_result[2]
 
-def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device, FF=False, wild_dataset=False):   
+def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device, FF=False, wild_dataset=False, save_model=None, report_interval=METRIC_REPORT_INTERVAL, execution_policy=None):   
     # loss
     criterion = nn.CrossEntropyLoss()
 
@@ -477,13 +634,13 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
     total_valid_acc = 0
     best_result = [-1, 0., 0.] # epoch, traing acc, validation acc
     f = open(fname, "w+")
-    scaler = GradScaler()
+    policy = execution_policy if execution_policy != None else Execution_Policy(device)
+    scaler = policy.grad_scaler()
     for epoch in range(Epoch):
         # Training
         if(FF == True): # full finetune all the layers
             model.train()
-        train_loss = []
-        train_accs = []
+        train_metrics = Running_Metrics(["loss", "acc"], device, report_interval)
         pbar = tqdm(trainloader, total=len(trainloader),
                     desc=f"Epoch {epoch+1} Training Lr {optimizer.param_groups[0]['lr']:.1e}", ncols=100)
         for pb in pbar:
@@ -493,7 +650,7 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
                 imgs, labels = pb
 
             optimizer.zero_grad()
-            with autocast():
+            with policy.autocast():
                 logits = model(imgs.to(device))
                 loss = criterion(logits, labels.to(device))
 
@@ -506,12 +663,12 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
             nn.utils.clip_grad_value_(model.linear.weight, 0.001)
 
             acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
-            train_loss.append(loss.item())
-            train_accs.append(acc)
+            train_metrics.update(loss, acc)
 
-            total_train_loss = sum(train_loss) / len(train_loss)
-            total_train_acc = sum(train_accs) / len(train_accs)
-            pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
+            if(train_metrics.should_report()):
+                total_train_loss, total_train_acc = train_metrics.average()
+                pbar.set_postfix_str(f"ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}")
+        total_train_loss, total_train_acc = train_metrics.average()
         # update log
         f.write(f"Epoch {epoch+1} Training, ACC: {total_train_acc*100:.2f}%, Loss: {total_train_loss:.4f}\n")
         plotter.log(epoch, {f"train_tm_acc": total_train_loss})
@@ -520,8 +677,7 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
         if(epoch%1 == 0 or epoch == Epoch-1): 
             # Validation
             model.eval()
-            valid_loss = []
-            valid_accs = []
+            valid_metrics = Running_Metrics(["loss", "acc"], device, report_interval)
             pbar = tqdm(testloader, total=len(
                 testloader), desc=f"Epoch {epoch+1} Testing", ncols=100)
             for pb in pbar:
@@ -534,13 +690,12 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
                     logits = model(imgs.to(device))
                     loss = criterion(logits, labels.to(device))
                 acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
+                valid_metrics.update(loss, acc)
 
-                valid_loss.append(loss.item())
-                valid_accs.append(acc)
-
-                total_valid_loss = sum(valid_loss) / len(valid_loss)
-                total_valid_acc = sum(valid_accs) / len(valid_accs)
-                pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
+                if(valid_metrics.should_report()):
+                    total_valid_loss, total_valid_acc = valid_metrics.average()
+                    pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}")
+            total_valid_loss, total_valid_acc = valid_metrics.average()
             # update log
             f.write(f"Epoch {epoch+1} Testing, ACC: {total_valid_acc*100:.2f}%, Loss: {total_valid_loss:.4f}\n")
             plotter.log(epoch, {f"evaluate_acc": total_valid_acc, f"evaluate_loss": total_valid_loss})
@@ -550,14 +705,25 @@ def Training_pure_clip(fname, model, trainloader, testloader, Epoch, lr, device,
     
     # save model
     print("Save! Acc: ", total_valid_acc)
-    state_dict = {"model": model}
+    if(save_model == None): # save_model: full model when only the head is trained on cached features
+        save_model = model
+    state_dict = {"model": save_model}
     torch.save(state_dict, fname.split(".")[0]+ ".pth")
     plotter.finish(save_path)
 
     f.close()
     return best_result[2]
 
-def LP(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch, lr, device, wild_dataset=False):
+def Replace_Head(model, pretrained_model, head):
+    if(pretrained_model == "vit_b_16"):
+        model.heads.head = head
+    elif(pretrained_model == "swin_t"):
+        model.head = head
+    else:
+        model.fc = head
+    return
+
+def LP(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch, lr, device, wild_dataset=False, feature_cache_dir=None, dataset_name=None, execution_policy=None):
     for param in model.parameters():
         param.requires_grad = False
     model.eval() 
@@ -565,13 +731,17 @@ def LP(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch
     # Parameters of newly constructed modules have requires_grad=True by default
     if(pretrained_model == "vit_b_16"):
         num_ftrs = model.heads.head.in_features
-        model.heads.head = nn.Linear(num_ftrs, class_num)
     elif(pretrained_model == "swin_t"):
         num_ftrs = model.head.in_features
-        model.head = nn.Linear(num_ftrs, class_num)
     else:
         num_ftrs = model.fc.in_features
-        model.fc = nn.Linear(num_ftrs, class_num)
+    head = nn.Linear(num_ftrs, class_num)
+    cache_tag = ""
+    if(execution_policy != None and execution_policy.precision.low_precision() == True):
+        head = Float32_Head(head) # fp32 head on the low-precision backbone features
+        execution_policy.precision.cast_module_input(model)
+        cache_tag = execution_policy.precision.cache_tag()
+    Replace_Head(model, pretrained_model, head)
 
     Trainable_Parameter_Size(model, fname)
     #'''
@@ -582,11 +752,20 @@ def LP(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch
             params_to_update.append(param)
             print("\t",name)
     #'''
-    best_val_acc = Training_pure(fname, model.to(device), trainloader, testloader, Epoch, lr, device, wild_dataset=wild_dataset)
+    if(feature_cache_dir != None):
+        # run the frozen backbone once per split and train the head on the cached penultimate features
+        Replace_Head(model, pretrained_model, nn.Identity())
+        model.to(device)
+        trainloader = Cached_Feature_Loader(model, pretrained_model + cache_tag, dataset_name, "train", trainloader, device, feature_cache_dir, shuffle=True, wild_dataset=wild_dataset)
+        testloader = Cached_Feature_Loader(model, pretrained_model + cache_tag, dataset_name, "test", testloader, device, feature_cache_dir, shuffle=False, wild_dataset=wild_dataset)
+        Replace_Head(model, pretrained_model, head)
+        best_val_acc = Training_pure(fname, head.to(device), trainloader, testloader, Epoch, lr, device, save_model=model, execution_policy=execution_policy)
+    else:
+        best_val_acc = Training_pure(fname, model.to(device), trainloader, testloader, Epoch, lr, device, wild_dataset=wild_dataset, execution_policy=execution_policy)
 
     return best_val_acc
 
-def Full_Finetune(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch, lr, device, wild_dataset=False):
+def Full_Finetune(fname, model, pretrained_model, class_num, trainloader, testloader, Epoch, lr, device, wild_dataset=False, execution_policy=None):
     # Parameters of newly constructed modules have requires_grad=True by default
     if(pretrained_model == "vit_b_16"):
         num_ftrs = model.heads.head.in_features
@@ -608,7 +787,7 @@ def Full_Finetune(fname, model, pretrained_model, class_num, trainloader, testlo
             print("\t",name)
     #'''
 
-    best_val_acc = Training_pure(fname, model.to(device), trainloader, testloader, Epoch, lr, device, FF=True, wild_dataset=wild_dataset)
+    best_val_acc = Training_pure(fname, model.to(device), trainloader, testloader, Epoch, lr, device, FF=True, wild_dataset=wild_dataset, execution_policy=execution_policy)
 
     return best_val_acc
 
@@ -638,16 +817,18 @@ def CLIP_Text_Embedding(class_names, template_number, clip_model, device):
     return txt_emb
 
 # https://github.com/openai/CLIP
-def CLIP_Pure(model, testloader, class_names, device, wild_dataset=False):
+def CLIP_Pure(model, testloader, class_names, device, wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL, execution_policy=None):
     model.requires_grad_(False)
     model.eval()
     # Prepare text embedding
     template_number = 0 # use default template
     txt_emb = CLIP_Text_Embedding(class_names, template_number, model, device) 
+    if(execution_policy != None):
+        txt_emb = execution_policy.precision.cast_text(txt_emb)
 
     total_train_acc = 0
     total_valid_acc = 0
-    valid_accs = []
+    valid_metrics = Running_Metrics(["acc"], device, report_interval)
         
     # Validation
     pbar = tqdm(testloader, total=len(testloader), ncols=120)
@@ -665,13 +846,14 @@ def CLIP_Pure(model, testloader, class_names, device, wild_dataset=False):
             x_emb = model.encode_image(imgs)
 
         x_emb /= x_emb.norm(dim=-1, keepdim=True)
-        logits = model.logit_scale.exp() * x_emb @ txt_emb.t()
+        logits = model.logit_scale.exp() * x_emb.to(txt_emb.dtype) @ txt_emb.t()
         acc = (logits.argmax(dim=-1) == labels).float().mean()
+        valid_metrics.update(acc)
 
-        valid_accs.append(acc)
-
-        total_valid_acc = sum(valid_accs) / len(valid_accs)
-        pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%")
+        if(valid_metrics.should_report()):
+            total_valid_acc, = valid_metrics.average()
+            pbar.set_postfix_str(f"ACC: {total_valid_acc*100:.2f}%")
+    total_valid_acc, = valid_metrics.average()
 
     return total_valid_acc
 
@@ -682,13 +864,14 @@ class LogisticRegression(nn.Module):
         self.clip_model = clip_model
 
     def forward(self, x):
-        x = self.clip_model.encode_image(x) # output shape: [128, 512]
+        if(self.clip_model != None): # clip_model is None when x is a cached image feature
+            x = self.clip_model.encode_image(x).float() # output shape: [128, 512], fp32 for the head
         x = self.linear(x)
         return x
 
 # ref: https://github.com/openai/CLIP
 # use the image features to classify
-def CLIP_LP(fname, model, trainloader, testloader, class_num, Epoch, lr, device, b_l="b", wild_dataset=False): 
+def CLIP_LP(fname, model, trainloader, testloader, class_num, Epoch, lr, device, b_l="b", wild_dataset=False, feature_cache_dir=None, dataset_name=None, execution_policy=None): 
     for param in model.parameters():
         param.requires_grad = False
     model.eval()  
@@ -703,5 +886,16 @@ def CLIP_LP(fname, model, trainloader, testloader, class_num, Epoch, lr, device,
         if param.requires_grad == True:
             print("\t",name)
     
-    best_val_acc = Training_pure_clip(fname, LR_model.to(device), trainloader, testloader, Epoch, lr, device, wild_dataset=wild_dataset)
+    if(feature_cache_dir != None):
+        # encode every image once and train the shared linear layer on the cached features
+        backbone = "clip_large" if b_l == "l" else "clip"
+        if(execution_policy != None):
+            backbone += execution_policy.precision.cache_tag()
+        trainloader = Cached_Feature_Loader(model.encode_image, backbone, dataset_name, "train", trainloader, device, feature_cache_dir, shuffle=True, wild_dataset=wild_dataset)
+        testloader = Cached_Feature_Loader(model.encode_image, backbone, dataset_name, "test", testloader, device, feature_cache_dir, shuffle=False, wild_dataset=wild_dataset)
+        head_model = LogisticRegression(LR_model.linear.in_features, class_num, None)
+        head_model.linear = LR_model.linear
+        best_val_acc = Training_pure_clip(fname, head_model.to(device), trainloader, testloader, Epoch, lr, device, save_model=LR_model, execution_policy=execution_policy)
+    else:
+        best_val_acc = Training_pure_clip(fname, LR_model.to(device), trainloader, testloader, Epoch, lr, device, wild_dataset=wild_dataset, execution_policy=execution_policy)
     return best_val_acc
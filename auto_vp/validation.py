@@ -0,0 +1,192 @@
+import copy
+import threading
+import torch
+from tqdm.auto import tqdm
+
+from auto_vp.metrics import Running_Metrics
+from auto_vp.checkpoint import To_CPU
+from auto_vp.dataprepare import Validation_Subset
+from auto_vp.const import METRIC_REPORT_INTERVAL
+from auto_vp.distributed import Is_Distributed, Distributed_Loader
+
+# Validation during prompt training: per-epoch model selection runs on a fixed stratified
+# subset of the test set (optionally on a background thread, over a snapshot of the
+# prompt and mapping), and the full test set is scored once, on the selected checkpoint.
+
+def Evaluate(model, loader, criterion, device, desc="Testing", wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL, ncols=120):
+    model.eval()
+    metrics = Running_Metrics(["loss", "acc"], device, report_interval)
+    pbar = tqdm(loader, total=len(loader), desc=desc, ncols=ncols)
+    for pb in pbar:
+        if(wild_dataset == True):
+            imgs, labels, _ = pb
+        else:
+            imgs, labels = pb
+
+        if imgs.get_device() == -1:
+            imgs = imgs.to(device)
+            labels = labels.to(device)
+        with torch.no_grad():
+            logits = model(imgs)
+            loss = criterion(logits, labels)
+        acc = (logits.argmax(dim=-1) == labels).float().mean()
+        metrics.update(loss, acc)
+
+        if(metrics.should_report()):
+            total_loss, total_acc = metrics.average()
+            pbar.set_postfix_str(f"ACC: {total_acc*100:.2f}%, Loss: {total_loss:.4f}")
+    metrics.all_reduce() # sharded loader in a data-parallel run
+    return metrics.average()
+
+def Snapshot_Model(model):
+    # copy of a BaseWrapper that shares the frozen backbone (and text embedding) but owns
+    # its prompt, resize and output mapping, so training can keep updating the originals
+    snapshot = copy.copy(model)
+    snapshot._parameters = copy.copy(model._parameters)
+    snapshot._buffers = copy.copy(model._buffers)
+    snapshot._modules = copy.copy(model._modules)
+    for name in ["train_resize", "input_perturbation", "output_mapping"]:
+        snapshot._modules[name] = copy.deepcopy(model._modules[name])
+    snapshot.compiled_forward = None # the compiled graph is bound to the live model
+    return snapshot.eval()
+
+class Background_Evaluator:
+    # Scores submitted snapshots on a worker thread, one at a time, in submission order.
+    def __init__(self, loader, criterion, device, wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL):
+        self.loader = loader
+        self.criterion = criterion
+        self.device = device
+        self.wild_dataset = wild_dataset
+        self.report_interval = report_interval
+        self.jobs = []
+        self.results = []
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, epoch, snapshot, info):
+        with self.cond:
+            self.jobs.append((epoch, snapshot, info))
+            self.cond.notify_all()
+        return
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while(len(self.jobs) == 0 and self.closed == False):
+                    self.cond.wait()
+                if(len(self.jobs) == 0):
+                    return
+                epoch, snapshot, info = self.jobs.pop(0)
+                self.busy = True
+            try:
+                loss, acc = Evaluate(snapshot, self.loader, self.criterion, self.device, desc=f"Epoch {epoch+1} Testing (background)",
+                                     wild_dataset=self.wild_dataset, report_interval=self.report_interval)
+                result = (epoch, loss, acc, snapshot, info)
+            except Exception as e:
+                self.error = e
+                result = None
+            with self.cond:
+                if(result != None):
+                    self.results.append(result)
+                self.busy = False
+                self.cond.notify_all()
+
+    def poll(self):
+        # finished results, oldest first
+        with self.cond:
+            if(self.error != None):
+                error, self.error = self.error, None
+                raise error
+            results, self.results = self.results, []
+        return results
+
+    def close(self):
+        with self.cond:
+            while(len(self.jobs) > 0 or self.busy == True):
+                self.cond.wait()
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        return self.poll()
+
+class Validation_Policy:
+    # validation_size: number (>1) or fraction (<=1) of the test set used for model selection, None: whole test set
+    # background: score a snapshot on a worker thread while the next epoch trains
+    def __init__(self, testloader, criterion, device, validation_size=None, background=False, wild_dataset=False, report_interval=METRIC_REPORT_INTERVAL, random_state=1):
+        self.testloader = testloader
+        self.criterion = criterion
+        self.device = device
+        self.wild_dataset = wild_dataset
+        self.report_interval = report_interval
+        if(validation_size == None):
+            self.valloader = testloader
+        else:
+            self.valloader = Validation_Subset(testloader, validation_size, random_state=random_state, wild_dataset=wild_dataset)
+        self.subset = (self.valloader is not testloader)
+        if(Is_Distributed() == True):
+            # every rank scores a shard, the metric sums are all-reduced in Evaluate()
+            self.testloader = Distributed_Loader(testloader, shuffle=False)
+            self.valloader = Distributed_Loader(self.valloader, shuffle=False) if self.subset == True else self.testloader
+            if(background == True):
+                print("Warning: background validation is not supported in a data-parallel run, validate in the training loop")
+                background = False
+        self.evaluator = None
+        if(background == True):
+            self.evaluator = Background_Evaluator(self.valloader, criterion, device, wild_dataset, report_interval)
+
+    def needs_full_test(self):
+        # the selection metric was not measured on the full test set
+        return self.subset
+
+    def validate(self, model, epoch, info):
+        # returns the (epoch, loss, acc, snapshot, info) results that are ready; snapshot is None
+        # when the live model was scored, and info is passed through (captured at submit time)
+        if(self.evaluator != None):
+            info = To_CPU(info)
+            self.evaluator.submit(epoch, Snapshot_Model(model), info)
+            return self.evaluator.poll()
+        loss, acc = Evaluate(model, self.valloader, self.criterion, self.device, desc=f"Epoch {epoch+1} Testing",
+                             wild_dataset=self.wild_dataset, report_interval=self.report_interval)
+        return [(epoch, loss, acc, None, info)]
+
+    def finish(self):
+        if(self.evaluator != None):
+            return self.evaluator.close()
+        return []
+
+    def full_test(self, model):
+        return Evaluate(model, self.testloader, self.criterion, self.device, desc="Best checkpoint Testing",
+                        wild_dataset=self.wild_dataset, report_interval=self.report_interval)
+
+class Early_Stopping:
+    # Stops when the validation accuracy has not improved by more than min_delta for
+    # `patience` epochs. patience None: never stop.
+    def __init__(self, patience=None, min_delta=0.):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_acc = -1.
+        self.best_epoch = -1
+        self.stop_reason = None
+
+    def update(self, epoch, acc):
+        if(acc > self.best_acc + self.min_delta):
+            self.best_acc = acc
+            self.best_epoch = epoch
+        elif(self.patience != None and epoch - self.best_epoch >= self.patience and self.stop_reason == None):
+            self.stop_reason = f"validation ACC did not improve by more than {self.min_delta} for {epoch - self.best_epoch} epochs (best {self.best_acc*100:.2f}% at Epoch {self.best_epoch+1})"
+        return self.should_stop()
+
+    def should_stop(self):
+        return self.stop_reason != None
+
+    def state_dict(self):
+        return {"best_acc": self.best_acc, "best_epoch": self.best_epoch, "stop_reason": self.stop_reason}
+
+    def load_state_dict(self, state_dict):
+        self.best_acc = state_dict["best_acc"]
+        self.best_epoch = state_dict["best_epoch"]
+        self.stop_reason = state_dict["stop_reason"]
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 import torchvision.transforms as transforms
@@ -7,13 +8,17 @@ from tqdm.auto import tqdm
 import numpy as np
 import timm
 
-from .const import DEFAULT_TEMPLATE, ENSEMBLE_TEMPLATES
+from .const import DEFAULT_TEMPLATE, ENSEMBLE_TEMPLATES, MODEL_ZOO
+from .execution import Execution_Policy
+from .activation_checkpoint import Enable_Activation_Checkpointing
+from .profiler import Stage_Profiler
+from .preprocess import Batch_Preprocess, CLIP_MEAN, CLIP_STD
 
 # ref: https://github.com/RobustBench/robustbench/blob/master/robustbench/utils.py
 # ref: https://pytorch.org/vision/0.8/models.html
 
 class BaseWrapper(nn.Module):
-    def __init__(self, model_name=None, dataset_name=None, input_perturbation=None, output_mapping=None, train_resize=None, init_scale=1.0, clip_img_size=128, device=None):
+    def __init__(self, model_name=None, dataset_name=None, input_perturbation=None, output_mapping=None, train_resize=None, init_scale=1.0, clip_img_size=128, device=None, execution_policy=None, shared_backbone=None, pretrained_weights=True):
         super(BaseWrapper, self).__init__()
         self.model = None
         self.model_name = model_name
@@ -26,7 +31,28 @@ class BaseWrapper(nn.Module):
         self.clip_preprocess = None
         self.text_content = []
         self.init_scale = init_scale
+        self.clip_img_size = clip_img_size
         self.clip_rz_transform = transforms.Resize([clip_img_size, clip_img_size])
+        # uint8 batches (Uint8_Transform loaders): float conversion + normalization on the device, no second resize;
+        # non-CLIP inputs are normalized by InputPadding, CLIP inputs here as CLIP's preprocess would
+        if(model_name != None and model_name[0:4] == "clip"):
+            self.batch_preprocess = Batch_Preprocess(clip_img_size, CLIP_MEAN, CLIP_STD).to(device)
+        else:
+            self.batch_preprocess = Batch_Preprocess(clip_img_size).to(device)
+
+        # autocast / memory format / grad scaling follow the device
+        if(execution_policy == None and shared_backbone != None):
+            execution_policy = shared_backbone.execution_policy # same backbone dtype and autocast
+        if(execution_policy == None):
+            execution_policy = Execution_Policy(device)
+        self.execution_policy = execution_policy
+
+        # opt-in torch.compile of the whole prompt->backbone->mapping pipeline, see Compile()
+        self.compiled_forward = None
+        self.compile_batch_size = None
+
+        # per-stage timing / allocation counts, off until Profile() is called
+        self.stage_profiler = Stage_Profiler()
 
         if(model_name == None):
             self.model = self.No_operation.to(device)
@@ -57,46 +83,55 @@ class BaseWrapper(nn.Module):
             with torch.no_grad():
                 self.output_mapping.layers.weight.copy_(w)
 
-        self.model_zoo = ["vgg16_bn", "resnet18", "resnet50", "resnext101_32x8d", "ig_resnext101_32x8d", "vit_b_16", "clip", "clip_large", "clip_ViT_B_32", "swin_t"]
+        self.model_zoo = MODEL_ZOO
+
+        # share the frozen backbone of another BaseWrapper (co-training several prompts on one model)
+        if(shared_backbone != None):
+            if(shared_backbone.model_name != self.model_name):
+                raise ValueError(f"Cannot share a {shared_backbone.model_name} backbone with a {self.model_name} wrapper")
+            self.model = shared_backbone.model
+            self.clip_preprocess = shared_backbone.clip_preprocess
 
-        # load model from model zoo
-        if self.model_name in self.model_zoo:
+        # load model from model zoo (pretrained_weights=False: random weights for offline benchmarks, CLIP always loads its checkpoint)
+        elif self.model_name in self.model_zoo:
             if self.model_name == "vgg16_bn": # VGG-16 with batch normalization
-                model = models.vgg16_bn(weights=models.VGG16_BN_Weights.DEFAULT).to(device)  
+                model = models.vgg16_bn(weights=models.VGG16_BN_Weights.DEFAULT if pretrained_weights == True else None).to(device)  
             elif self.model_name == "resnet18":
-                model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT).to(device)
+                model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT if pretrained_weights == True else None).to(device)
             elif self.model_name == "resnet50":
-                model = models.resnet50(weights=models.ResNet50_Weights.DEFAULT).to(device)
+                model = models.resnet50(weights=models.ResNet50_Weights.DEFAULT if pretrained_weights == True else None).to(device)
             elif self.model_name == "resnext101_32x8d":
-                model = models.resnext101_32x8d(weights=models.ResNeXt101_32X8D_Weights.DEFAULT).to(device)
+                model = models.resnext101_32x8d(weights=models.ResNeXt101_32X8D_Weights.DEFAULT if pretrained_weights == True else None).to(device)
             elif self.model_name == "ig_resnext101_32x8d": # https://paperswithcode.com/model/ig-resnext?variant=ig-resnext101-32x8d
-                model = timm.create_model('ig_resnext101_32x8d', pretrained=True).to(device)
+                model = timm.create_model('ig_resnext101_32x8d', pretrained=pretrained_weights).to(device)
             elif self.model_name == "vit_b_16":
-                model = models.vit_b_16(weights=models.ViT_B_16_Weights.DEFAULT).to(device)
+                model = models.vit_b_16(weights=models.ViT_B_16_Weights.DEFAULT if pretrained_weights == True else None).to(device)
             elif self.model_name == "swin_t":
-                model = models.swin_t(weights=models.Swin_T_Weights.DEFAULT).to(device)
+                model = models.swin_t(weights=models.Swin_T_Weights.DEFAULT if pretrained_weights == True else None).to(device)
             elif self.model_name == "clip" or self.model_name == "clip_ViT_B_32":
                 model, self.clip_preprocess = clip.load("ViT-B/32", device=device)
-                # https://github.com/openai/CLIP/issues/57
-                for p in model.parameters(): 
-                    p.data = p.data.float() 
-                    if p.grad:
-                        p.grad.data = p.grad.data.float()
             elif self.model_name == "clip_large":
                 model, self.clip_preprocess = clip.load("ViT-L/14", device=device)
-                # https://github.com/openai/CLIP/issues/57
-                for p in model.parameters(): 
-                    p.data = p.data.float() 
-                    if p.grad:
-                        p.grad.data = p.grad.data.float()
-            
+
+            # Backbone storage dtype from the precision policy (fp32 by default)
+            # https://github.com/openai/CLIP/issues/57
+            model = self.execution_policy.precision.cast_backbone(model)
 
             # Frozen the pretrained model
             model.requires_grad_(False)
+            model = self.execution_policy.prepare_backbone(self.model_name, model)
 
             # Set to evaluation mode
             self.model = model.eval()
 
+    def train(self, mode=True):
+        # the frozen backbone always stays in eval mode (BN statistics, dropout); it is never
+        # switched, even briefly, since a background evaluator may be running it
+        self.training = mode
+        for module in self.children():
+            if module is not self.model:
+                module.train(mode)
+        return self
 
     # ref : https://github.com/OPTML-Group/ILM-VP
     def get_saparate_text_embedding(self, classnames, templates, model):
@@ -124,7 +159,7 @@ class BaseWrapper(nn.Module):
 
     def CLIP_Text_Embedding(self, class_names, template_number):
         TEMPLATES = [DEFAULT_TEMPLATE] + ENSEMBLE_TEMPLATES # len(TEMPLATES): 81
-        self.txt_emb = torch.cat(self.get_saparate_text_embedding(class_names, TEMPLATES, self.model)) 
+        self.txt_emb = self.execution_policy.precision.cast_text(torch.cat(self.get_saparate_text_embedding(class_names, TEMPLATES, self.model)))
         return
     
     def CLIP_network(self, x):
@@ -133,28 +168,95 @@ class BaseWrapper(nn.Module):
             return
         x_emb = self.model.encode_image(x)
         x_emb /= x_emb.norm(dim=-1, keepdim=True)
-        logits = self.model.logit_scale.exp() * x_emb @ self.txt_emb.t()
+        logits = self.model.logit_scale.exp() * x_emb.to(self.txt_emb.dtype) @ self.txt_emb.t()
         return logits
 
+    def Backbone_network(self, x):
+        x = self.execution_policy.prepare_input(self.model_name, x)
+        x = self.execution_policy.precision.cast_input(x)
+        with self.execution_policy.backbone_autocast():
+            if(self.model_name == "clip_ViT_B_32"):
+                x = self.model.encode_image(x)
+            elif(self.model_name[0:4] == "clip"):
+                x = self.CLIP_network(x)
+            else:
+                x = self.model(x)
+        return x.float()
+
+
+    def Activation_Checkpointing(self, granularity=None):
+        # trade a second backbone forward in backward for not keeping its activations; granularity: None (per-backbone default), "stage" or "block"
+        if(self.no_pretrained_model == 1):
+            return None
+        return Enable_Activation_Checkpointing(self.model_name, self.model, granularity)
+
+    def Compile(self, cache_dir=None, mode="default"):
+        # compiles the backbone + output mapping only: the prompt stage stays eager, since Trainable_Resize
+        # hands InputPadding integer sizes that change with the scale and would recompile a static graph;
+        # the backbone input is always [B, 3, 224, 224], so dynamic=False keeps one graph per batch size
+        if(cache_dir != None):
+            # inductor and AOT-autograd artifacts are reused by later runs / Ray trials on this host
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+            import torch._functorch.config
+            if hasattr(torch._functorch.config, "enable_autograd_cache"):
+                torch._functorch.config.enable_autograd_cache = True
+        self.compiled_forward = torch.compile(self.Mapped_Backbone, dynamic=False, mode=mode)
+        self.compile_batch_size = None
+        return
+
+    def Input_Size(self):
+        # the image size the prompt network expects; uint8 loaders should deliver exactly this
+        return self.clip_img_size
+
+    def Profile(self, enabled=True, allocations=True):
+        # switch the per-stage profiler on/off at runtime; profiled steps run the eager pipeline
+        if(enabled == True and self.compiled_forward != None):
+            print("Warning: stage profiling bypasses the compiled pipeline")
+        return self.stage_profiler.enable(enabled, allocations, self.device)
+
+    def Static_forward(self, input):
+        # eager prompt, compiled backbone + mapping; in eval a short (last) batch is padded up to the
+        # compiled batch size instead of recompiling, in training it gets its own graph (no wasted backbone rows)
+        input = self.Prompt_network(input)
+        n = input.shape[0]
+        if(self.compile_batch_size == None or n > self.compile_batch_size):
+            self.compile_batch_size = n
+        if(n < self.compile_batch_size and self.training == False):
+            pad = input.new_zeros((self.compile_batch_size - n,) + tuple(input.shape[1:]))
+            return self.compiled_forward(torch.cat([input, pad]))[:n]
+        return self.compiled_forward(input)
 
     def forward(self, input):
-        # clip need to resize by ourself 
-        x = self.clip_rz_transform(input)
+        if(self.compiled_forward != None and self.stage_profiler.enabled == False):
+            return self.Static_forward(input)
+        return self.Reprogram_network(input)
+
+    def Reprogram_network(self, input):
+        x = self.Prompt_network(input)
+        x = self.stage_profiler.run("backbone", self.Backbone_network, x)
+        x = self.stage_profiler.run("output_mapping", self.output_mapping, x)
+        return x
+
+    def Mapped_Backbone(self, x):
+        # the compiled region of Compile()
+        return self.output_mapping(self.Backbone_network(x))
+
+    def Prompt_network(self, input):
+        if(input.dtype == torch.uint8):
+            x = self.stage_profiler.run("preprocess", self.batch_preprocess, input)
+        else:
+            # clip need to resize by ourself 
+            x = self.stage_profiler.run("clip_resize", self.clip_rz_transform, input)
 
         img_h = -1
         img_w = -1
         if(self.no_trainable_resize == 0):
-            x, img_h, img_w = self.train_resize(x)
+            x, img_h, img_w = self.stage_profiler.run("train_resize", self.train_resize, x)
         else:
             x = self.train_resize(x)
 
-        x = self.input_perturbation(x, img_h, img_w)
-
-        if(self.model_name == "clip_ViT_B_32"):
-            x = self.model.encode_image(x)
-        elif(self.model_name[0:4] == "clip"):
-            x = self.CLIP_network(x)
-        else:
-            x = self.model(x)
-        x = self.output_mapping(x)
+        x = self.stage_profiler.run("input_padding", self.input_perturbation, x, img_h, img_w)
         return x
@@ -0,0 +1,53 @@
+from auto_vp.benchmark import Run_Benchmark, Compare_Baseline, Save_Report, Load_Report, MAPPING_METHODS
+from auto_vp.const import CLASS_NUMBER, MODEL_ZOO
+from auto_vp.utilities import setup_device
+
+import argparse
+import sys
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--dataset', default="CIFAR10", choices=list(CLASS_NUMBER.keys())) # synthetic stand-in, nothing is downloaded
+    p.add_argument('--pretrained', nargs="+", choices=MODEL_ZOO, default=MODEL_ZOO)
+    p.add_argument('--mapping_method', nargs="+", choices=MAPPING_METHODS, default=MAPPING_METHODS)
+    p.add_argument('--train_resize', nargs="+", type=int, choices=[0, 1], default=[1, 0])
+    p.add_argument('--steps', type=int, default=20) # measured steps per cell
+    p.add_argument('--warmup', type=int, default=5)
+    p.add_argument('--batch_size', type=int, default=-1) # -1: BATCH_SIZE of the dataset
+    p.add_argument('--img_scale', type=float, default=1.0)
+    p.add_argument('--out_map_num', type=int, default=1)
+    p.add_argument('--seed', type=int, default=7)
+    p.add_argument('--pretrained_weights', type=int, choices=[0, 1], default=0) # 0: random weights (throughput only), CLIP cells are skipped
+    p.add_argument('--backbone_dtype', choices=["fp32", "bf16", "fp16"], default="fp32")
+    p.add_argument('--num_threads', type=int, default=-1)
+    p.add_argument('--cpu', type=int, choices=[0, 1], default=0)
+    p.add_argument('--isolate', type=int, choices=[0, 1], default=1) # one process per cell, for per-cell peak RSS
+    p.add_argument('--output', type=str, default="results_auto_vp/benchmark.json")
+    p.add_argument('--baseline', type=str, default=None) # report of an earlier run to compare against
+    p.add_argument('--tolerance', type=float, default=0.1) # relative change that counts as a regression
+    args = p.parse_args()
+
+    if(args.cpu > 0):
+        device = "cpu"
+    else:
+        device, list_ids = setup_device(1)
+
+    report = Run_Benchmark(args.dataset, backbones=args.pretrained, mapping_methods=args.mapping_method, train_resize=[r > 0 for r in args.train_resize],
+                           device=device, isolate=(args.isolate > 0), steps=args.steps, warmup=args.warmup,
+                           batch_size=(args.batch_size if args.batch_size > 0 else None), scale=args.img_scale, num_map=args.out_map_num,
+                           seed=args.seed, pretrained_weights=(args.pretrained_weights > 0), backbone_dtype=args.backbone_dtype, num_threads=args.num_threads)
+
+    regressions = []
+    if(args.baseline != None):
+        regressions = Compare_Baseline(report, Load_Report(args.baseline), tolerance=args.tolerance)
+        report["baseline"] = args.baseline
+        report["regressions"] = regressions
+        for r in regressions:
+            print(f"Regression: {r['cell']} {r['metric']}: {r['baseline']:.2f} -> {r['current']:.2f} ({r['change']*100:+.1f}%)")
+        if(len(regressions) == 0):
+            print(f"No regression against {args.baseline} (tolerance {args.tolerance*100:.0f}%)")
+
+    Save_Report(report, args.output)
+    print(f"Report: {args.output}")
+    sys.exit(1 if len(regressions) > 0 else 0)
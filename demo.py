@@ -6,6 +6,11 @@ from auto_vp.training_process import *
 from auto_vp.ray_tune_setting import Parameter_Tune, Parameter_Tune_LRWD
 from auto_vp.const import CLASS_NUMBER, IMG_SIZE, SOURCE_CLASS_NUM, BATCH_SIZE, NETMEAN, NETSTD
 from auto_vp.load_model import Load_Reprogramming_Model
+from auto_vp.execution import Setup_CPU_Threads, Execution_Policy, Precision_Policy
+from auto_vp.co_training import Co_Training
+from auto_vp.distributed import Setup_Distributed, Cleanup_Distributed, Is_Main_Process, Local_CPU_Threads
+from auto_vp.loader_tuning import Auto_Tune_Loader, Configure_Loader, Probe_Step, LOADER_TUNING_CACHE
+from auto_vp.preprocess import Uint8_Transform
 
 import argparse
 from torchvision import transforms
@@ -14,6 +19,7 @@ import torch
 import random
 from torch.nn.parameter import Parameter
 import os
+import json
 
 import time
 
@@ -49,6 +55,32 @@ if __name__ == '__main__':
 
     p.add_argument('--scalibility_rio', type=int, choices=[1, 2, 4, 10, 100], default=1) 
     p.add_argument('--scalibility_mode', choices=["equal", "random"], default="equal") 
+    p.add_argument('--num_threads', type=int, default=-1) # CPU intra-op threads, -1: all available cores
+    p.add_argument('--num_interop_threads', type=int, default=-1) # CPU inter-op threads, -1: 1
+    p.add_argument('--compile', type=int, choices=[0, 1], default=0) # torch.compile the reprogramming pipeline
+    p.add_argument('--compile_cache_dir', type=str, default="./results/compile_cache/")
+    p.add_argument('--resume', type=str, default=None) # resume.pth written by an interrupted run
+    p.add_argument('--resume_interval', type=int, default=0) # save resume.pth every N steps (and every epoch), 0: off
+    p.add_argument('--validation_size', type=float, default=-1) # test samples (>1) or fraction (<=1) used for per-epoch selection, -1: whole test set
+    p.add_argument('--patience', type=int, default=-1) # early stop after N epochs without improvement, -1: off
+    p.add_argument('--min_delta', type=float, default=0.0) # minimum validation ACC gain that counts as improvement
+    p.add_argument('--backbone_dtype', choices=["fp32", "bf16", "fp16"], default="fp32") # storage dtype of the frozen backbone, the prompt and mapping stay fp32
+    p.add_argument('--text_dtype', choices=["fp32", "bf16", "fp16"], default="fp32") # CLIP text embeddings
+    p.add_argument('--activation_checkpoint', choices=["none", "default", "stage", "block"], default="none") # recompute backbone activations in backward to save memory
+    p.add_argument('--distributed', type=int, choices=[0, 1], default=0) # data-parallel prompt training (gloo), launch with torchrun
+    p.add_argument('--co_train_configs', type=str, default=None) # path to a JSON file holding the list of configurations co-trained on one backbone, see README
+    p.add_argument('--background_eval', type=int, choices=[0, 1], default=0) # validate a snapshot while the next epoch trains
+    p.add_argument('--num_workers', type=int, default=-1) # DataLoader workers, -1: default (2)
+    p.add_argument('--prefetch_factor', type=int, default=-1) # batches prefetched per worker, -1: default (2)
+    p.add_argument('--pin_memory', type=int, choices=[-1, 0, 1], default=-1) # -1: on with CUDA
+    p.add_argument('--tensor_store', type=str, default=None) # directory of decoded image stores (file-backed datasets), None: decode every epoch
+    p.add_argument('--uint8_pipeline', type=int, choices=[0, 1], default=0) # 1: loaders return uint8 at the model's input size, the model converts/normalizes the batch
+    p.add_argument('--loader_tune', type=int, choices=[0, 1, 2], default=0) # probe workers / prefetch depth, 1: reuse the cached result, 2: probe again
+    p.add_argument('--loader_cache', type=str, default=LOADER_TUNING_CACHE) # tuned loader settings per host and dataset
+    p.add_argument('--profile_stages', type=int, choices=[0, 1], default=0) # per-stage forward/backward time and allocations in the log
+    p.add_argument('--trace_dir', type=str, default=None) # export a torch.profiler Chrome trace here
+    p.add_argument('--trace_start', type=int, default=10) # first traced training step
+    p.add_argument('--trace_steps', type=int, default=5) # number of traced steps
 
     start_time = time.time()
 
@@ -58,8 +90,17 @@ if __name__ == '__main__':
     set_seed(args.seed)
 
     # device setting
-    device, list_ids = setup_device(1)
+    if(args.distributed > 0):
+        Setup_Distributed("gloo")
+        device, list_ids = torch.device("cpu"), []
+    else:
+        device, list_ids = setup_device(1)
     print("device: ", device)
+    if(device.type == "cpu"):
+        num_threads = args.num_threads
+        if(args.distributed > 0 and num_threads < 1):
+            num_threads = Local_CPU_Threads()
+        Setup_CPU_Threads(num_threads, args.num_interop_threads)
 
     # Create datapath directory
     isExist = os.path.exists(args.datapath)
@@ -124,12 +165,19 @@ if __name__ == '__main__':
     else:
         wild_dataset = False
 
+    if(args.compile > 0):
+        compile_cache_dir = os.path.abspath(args.compile_cache_dir)
+    else:
+        compile_cache_dir = None
+
     # Tune parameter
     file_name = f"results_auto_vp/{args.dataset}_log_1_{args.scalibility_rio}.txt"
-    f = open(file_name,  "w+")
+    if(Is_Main_Process() == False): # data-parallel run: only rank 0 writes the log
+        file_name = os.devnull
+    f = open(file_name,  "a" if args.resume != None else "w+") # a resumed run continues the interrupted run's log
     if(param_tune == True):
         print("Warning: If you turn on param_tune, then the arguments will be ignored!")
-        mapping_method, num_map, freqmap_interval, scale, set_train_resize, pretrained_model = Parameter_Tune(dataset=args.dataset, data_path=args.datapath, download=download, scalibility_rio=args.scalibility_rio, scalibility_mode=args.scalibility_mode, wild_dataset=wild_dataset)
+        mapping_method, num_map, freqmap_interval, scale, set_train_resize, pretrained_model = Parameter_Tune(dataset=args.dataset, data_path=args.datapath, download=download, scalibility_rio=args.scalibility_rio, scalibility_mode=args.scalibility_mode, wild_dataset=wild_dataset, compile_cache_dir=compile_cache_dir, backbone_dtype=args.backbone_dtype, text_dtype=args.text_dtype)
         print(f"Ray Tune result: mapping_method={mapping_method}, num_map={num_map}, freqmap_interval={freqmap_interval}, scale={scale}, set_train_resize={set_train_resize}, pretrained_model={pretrained_model}")
         f.write(f"Ray Tune result: mapping_method={mapping_method}, num_map={num_map}, freqmap_interval={freqmap_interval}, scale={scale}, set_train_resize={set_train_resize}, pretrained_model={pretrained_model}\n")
     else:
@@ -137,7 +185,7 @@ if __name__ == '__main__':
     
     # LR/WD Tuning
     if(LR_WD_tune == True):
-        lr, weight_decay = Parameter_Tune_LRWD(dataset=args.dataset, data_path=args.datapath, mapping_method=mapping_method, num_map=num_map, freqmap_interval=freqmap_interval, scale=scale, set_train_resize=set_train_resize, pretrained_model=pretrained_model, download=download, scalibility_rio=args.scalibility_rio, scalibility_mode=args.scalibility_mode, wild_dataset=wild_dataset)
+        lr, weight_decay = Parameter_Tune_LRWD(dataset=args.dataset, data_path=args.datapath, mapping_method=mapping_method, num_map=num_map, freqmap_interval=freqmap_interval, scale=scale, set_train_resize=set_train_resize, pretrained_model=pretrained_model, download=download, scalibility_rio=args.scalibility_rio, scalibility_mode=args.scalibility_mode, wild_dataset=wild_dataset, compile_cache_dir=compile_cache_dir, backbone_dtype=args.backbone_dtype, text_dtype=args.text_dtype)
         f.write(f"LR/WD Ray Tune result: lr={lr}, weight_decay={weight_decay}\n")
     else:
         lr = args.lr
@@ -149,10 +197,38 @@ if __name__ == '__main__':
 
     
     # Load or build a reprogramming model
-    reprogram_model = Load_Reprogramming_Model(args.dataset, device, file_path=file_path, mapping_method=mapping_method, set_train_resize=set_train_resize, pretrained_model=pretrained_model, mapping=None, scale=scale, num_map=num_map, weightinit=weightinit)
+    execution_policy = Execution_Policy(device, precision=Precision_Policy(args.backbone_dtype, args.text_dtype))
+    co_models = None
+    if(args.co_train_configs != None):
+        # K prompt configurations over one backbone; each entry overrides the arguments above
+        with open(args.co_train_configs) as cf:
+            co_configs = json.load(cf)
+        co_models, co_lrs, co_intervals = [], [], []
+        for c in co_configs:
+            set_seed(c.get("seed", args.seed))
+            co_models.append(Load_Reprogramming_Model(args.dataset, device, mapping_method=c.get("mapping_method", mapping_method), set_train_resize=(c.get("train_resize", int(set_train_resize)) > 0),
+                                                      pretrained_model=pretrained_model, mapping=None, scale=c.get("img_scale", scale), num_map=c.get("out_map_num", num_map), weightinit=weightinit,
+                                                      shared_backbone=(co_models[0] if len(co_models) > 0 else None), execution_policy=execution_policy))
+            co_lrs.append(c.get("lr", lr))
+            interval = c.get("freqmap_interval", freqmap_interval)
+            co_intervals.append(interval if interval != None and interval > 0 else None)
+        set_seed(args.seed)
+        reprogram_model = co_models[0]
+    else:
+        reprogram_model = Load_Reprogramming_Model(args.dataset, device, file_path=file_path, mapping_method=mapping_method, set_train_resize=set_train_resize, pretrained_model=pretrained_model, mapping=None, scale=scale, num_map=num_map, weightinit=weightinit, execution_policy=execution_policy)
     Trainable_Parameter_Size(reprogram_model, file_name)
+    if(args.activation_checkpoint != "none"):
+        # the co-trained configurations share this backbone
+        reprogram_model.Activation_Checkpointing(None if args.activation_checkpoint == "default" else args.activation_checkpoint)
+    if(compile_cache_dir != None and co_models != None):
+        print("Warning: compile is ignored in co-training, Co_Forward runs the prompt, backbone and mappings eagerly")
+    elif(compile_cache_dir != None):
+        reprogram_model.Compile(cache_dir=compile_cache_dir)
     
-    if(reprogram_model.model_name[0:4] == "clip"):
+    if(args.uint8_pipeline > 0):
+        # resized once, in the workers, to the size the prompt network expects
+        clip_transform = Uint8_Transform(reprogram_model.Input_Size(), clip=(reprogram_model.model_name[0:4] == "clip"))
+    elif(reprogram_model.model_name[0:4] == "clip"):
         clip_transform = reprogram_model.clip_preprocess
     else:
         clip_transform = None
@@ -164,20 +240,44 @@ if __name__ == '__main__':
             img_resize = 224
 
     # Dataloader
+    loader_config = {"num_workers": args.num_workers if args.num_workers >= 0 else None,
+                     "prefetch_factor": args.prefetch_factor if args.prefetch_factor > 0 else None,
+                     "pin_memory": bool(args.pin_memory) if args.pin_memory >= 0 else None}
     trainloader, testloader, class_names, trainset = DataPrepare(dataset_name=args.dataset, dataset_dir=args.datapath, target_size=(
-        img_resize, img_resize), mean=NETMEAN[reprogram_model.model_name], std=NETSTD[reprogram_model.model_name], download=download, batch_size=BATCH_SIZE[args.dataset], random_state=random_state, clip_transform=clip_transform)
+        img_resize, img_resize), mean=NETMEAN[reprogram_model.model_name], std=NETSTD[reprogram_model.model_name], download=download, batch_size=BATCH_SIZE[args.dataset], random_state=random_state, clip_transform=clip_transform, loader_config=loader_config, tensor_store=args.tensor_store)
     
     if(args.scalibility_rio != 1):
-        trainloader = Data_Scalability(trainset, args.scalibility_rio, BATCH_SIZE[args.dataset], mode=args.scalibility_mode, random_state=random_state, wild_dataset=wild_dataset) 
+        trainloader = Data_Scalability(trainset, args.scalibility_rio, BATCH_SIZE[args.dataset], mode=args.scalibility_mode, random_state=random_state, wild_dataset=wild_dataset, loader=trainloader, dataset_name=args.dataset) 
+
+    if(args.loader_tune > 0):
+        # the winner is cached per host, dataset, backbone, batch size and input pipeline (transform, store, resize target)
+        trainloader, loader_config = Auto_Tune_Loader(trainloader, args.dataset, pretrained_model, step_fn=Probe_Step(reprogram_model, device), cache_path=args.loader_cache, retune=(args.loader_tune == 2),
+                                                      pipeline=("uint8" if args.uint8_pipeline > 0 else "float"), tensor_store=(args.tensor_store != None),
+                                                      target_size=(reprogram_model.Input_Size() if args.uint8_pipeline > 0 else img_resize))
+        testloader = Configure_Loader(testloader, loader_config)
 
     # Training
-    fname = f"results_auto_vp/{args.dataset}_log_1_{args.scalibility_rio}.txt"
-    if(pretrained_model[0:4] == "clip"):
-        CLIP_Training(args.dataset, fname, reprogram_model, trainloader, testloader, class_names, args.epoch, lr, weight_decay, device, freqmap_interval=freqmap_interval, wild_dataset=wild_dataset) # , convergence=True 
+    fname = file_name
+    validation_size = args.validation_size if args.validation_size > 0 else None
+    patience = args.patience if args.patience > 0 else None
+    if(co_models != None):
+        if(args.distributed > 0):
+            print("Warning: co-training runs in a single process, every rank trains on the whole data")
+        unsupported = {"resume": args.resume != None, "resume_interval": args.resume_interval > 0, "validation_size": validation_size != None,
+                       "background_eval": args.background_eval > 0, "patience": patience != None, "profile_stages": args.profile_stages > 0, "trace_dir": args.trace_dir != None}
+        for flag, is_set in unsupported.items():
+            if(is_set == True):
+                print(f"Warning: {flag} is not supported in co-training and is ignored")
+        Co_Training(args.dataset, fname, co_models, trainloader, testloader, class_names, args.epoch, co_lrs, weight_decay, device, freqmap_interval=co_intervals, wild_dataset=wild_dataset)
+    elif(pretrained_model[0:4] == "clip"):
+        CLIP_Training(args.dataset, fname, reprogram_model, trainloader, testloader, class_names, args.epoch, lr, weight_decay, device, freqmap_interval=freqmap_interval, wild_dataset=wild_dataset, resume_path=args.resume, resume_interval=args.resume_interval, seed=args.seed, validation_size=validation_size, background_eval=(args.background_eval == 1), patience=patience, min_delta=args.min_delta,
+                      profile_stages=(args.profile_stages == 1), trace_dir=args.trace_dir, trace_start=args.trace_start, trace_steps=args.trace_steps) # , convergence=True 
     else:
-        Training(args.dataset, fname, reprogram_model, trainloader, testloader, class_names, args.epoch, lr,  weight_decay, device, freqmap_interval=freqmap_interval, wild_dataset=wild_dataset)
+        Training(args.dataset, fname, reprogram_model, trainloader, testloader, class_names, args.epoch, lr,  weight_decay, device, freqmap_interval=freqmap_interval, wild_dataset=wild_dataset, resume_path=args.resume, resume_interval=args.resume_interval, seed=args.seed, validation_size=validation_size, background_eval=(args.background_eval == 1), patience=patience, min_delta=args.min_delta,
+                 profile_stages=(args.profile_stages == 1), trace_dir=args.trace_dir, trace_start=args.trace_start, trace_steps=args.trace_steps)
 
     f = open(file_name,  "a")
     f.write(f"Total Exection Time (second) : %s" % (time.time() - start_time))
     f.close()
+    Cleanup_Distributed()
 
@@ -0,0 +1,41 @@
+from auto_vp.robustness import Evaluate_CIFAR10_C, Corruption_Table, Save_Corruption_Table
+from auto_vp.load_model import Load_Reprogramming_Model
+from auto_vp.const import BATCH_SIZE, CIFAR10_C_CORRUPTIONS
+from auto_vp.utilities import setup_device
+import auto_vp.datasets as datasets
+
+import argparse
+import os
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--datapath', type=str, required=True) # directory of the CIFAR-10-C .npy files
+    p.add_argument('--checkpoint', type=str, required=True) # result_*.pth of a CIFAR10 / CIFAR10-C run
+    p.add_argument('--corruptions', nargs="+", choices=CIFAR10_C_CORRUPTIONS, default=CIFAR10_C_CORRUPTIONS)
+    p.add_argument('--batch_size', type=int, default=BATCH_SIZE["CIFAR10-C"])
+    p.add_argument('--num_workers', type=int, default=-1) # -1: default loader settings
+    p.add_argument('--cpu', type=int, choices=[0, 1], default=0)
+    p.add_argument('--output', type=str, default=None) # CSV table, default: next to the checkpoint
+    args = p.parse_args()
+
+    if(args.cpu > 0):
+        device = "cpu"
+    else:
+        device, list_ids = setup_device(1)
+
+    # one model load for every corruption and severity
+    reprogram_model = Load_Reprogramming_Model("CIFAR10-C", device, file_path=args.checkpoint)
+    if(reprogram_model.model_name[0:4] == "clip"):
+        class_names = datasets.CIFAR10_C(download=False, data_path=args.datapath, mode=args.corruptions[0]).classes
+        reprogram_model.CLIP_Text_Embedding(class_names, 0) # default template
+
+    loader_config = {"num_workers": args.num_workers if args.num_workers >= 0 else None}
+    results = Evaluate_CIFAR10_C(reprogram_model, args.datapath, device, corruptions=args.corruptions, batch_size=args.batch_size, loader_config=loader_config)
+
+    print(Corruption_Table(results), end="")
+    output = args.output
+    if(output == None):
+        output = os.path.splitext(args.checkpoint)[0] + "_cifar10c.csv"
+    Save_Corruption_Table(results, output)
+    print(f"Table: {output}")